@@ -0,0 +1,206 @@
+import time
+
+import numpy as np
+
+from collections import namedtuple
+from sqlalchemy import select
+# local packages
+from fx import fx_rates
+from models import db, Stock, Transaction
+
+# seconds per year (money-weighted return)
+YEAR = 365.25 * 24 * 3600
+
+# ledger of a user as arrays (prices & amounts in USD), sorted by date (stock is an index in symbols)
+Ledger = namedtuple("Ledger", ["stock", "quantity", "price", "amount", "time", "symbols", "names"])
+
+def load_ledger(user_id):
+    """Load the trades of a user into NumPy arrays (one query), converted to USD at the rates of the trade dates"""
+    rows = db.session.execute(select(Transaction.stock_id, Transaction.quantity, Transaction.price, Transaction.amount, \
+        Transaction.currency, Transaction.created_on, Stock.stock, Stock.name) \
+        .join(Stock, Stock.id == Transaction.stock_id) \
+        .where(Transaction.user_id == user_id) \
+        .order_by(Transaction.created_on, Transaction.id)).all()
+
+    if not rows:
+        empty = np.empty(0)
+        return Ledger(empty.astype(np.int64), empty, empty, empty, empty, [], [])
+
+    stock_ids, quantity, price, amount, currencies, created_on, symbols, names = zip(*rows)
+    # map the stock ids to 0..n-1
+    unique_ids, first, stock = np.unique(np.array(stock_ids), return_index=True, return_inverse=True)
+    created_on = np.array(created_on, dtype="datetime64[us]")
+    seconds = created_on.astype(np.int64) / 1e6
+    # USD per unit of the listing currency of each trade (one vectorized pass)
+    rates = fx_rates.convert_on(np.ones(len(rows)), [currency or "USD" for currency in currencies], created_on)
+
+    return Ledger(stock.astype(np.int64), np.array(quantity, dtype=float), np.array(price, dtype=float) * rates,
+        np.array(amount, dtype=float) * rates, seconds, [symbols[i] for i in first], [names[i] for i in first])
+
+def analyze(ledger, prices, cash=0.0, now=None):
+    """
+    Compute the portfolio analytics of a ledger with vectorized operations.
+
+    prices holds the latest price of each symbol of the ledger (NaN if unknown, the last
+    traded price is used instead). Returns positions (quantity, value, allocation weight,
+    average-cost & FIFO basis, realized & unrealized P&L), totals and returns.
+    """
+    n = len(ledger.symbols)
+    if n == 0:
+        return {"positions": [], "totals": _totals(np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0), cash),
+            "returns": {"time_weighted": None, "money_weighted": None}}
+
+    # trades grouped by stock, by date within a stock
+    order = np.lexsort((np.arange(len(ledger.stock)), ledger.stock))
+    stock = ledger.stock[order]
+    q = ledger.quantity[order]
+    p = ledger.price[order]
+    amount = ledger.amount[order]
+    group_start = np.r_[True, stock[1:] != stock[:-1]]
+    last = np.r_[group_start[1:], True]
+
+    buys = q > 0
+    buy_quantity = np.where(buys, q, 0)
+    buy_cost = np.where(buys, amount, 0)
+    sold = np.where(buys, 0, -q)
+
+    q_after = _segmented_cumsum(q, group_start)
+    q_before = q_after - q
+
+    # average cost: the cost C of the position follows C[t] = C[t-1] * r[t] + buy_cost[t]
+    # (r = share of the position kept by a sell), solved within each stretch between two flat positions:
+    # C[t] = G[t] * sum(buy_cost[s] / G[s], s <= t) with G the cumulative product of r (computed in log space)
+    closed = q_after == 0
+    ratio = np.where(~buys & (q_before > 0) & ~closed, q_after / np.where(q_before > 0, q_before, 1), 1)
+    segment_start = group_start | np.r_[True, closed[:-1]]
+    log_growth = _segmented_cumsum(np.log(ratio), segment_start)
+    with np.errstate(divide="ignore"):
+        log_cost = np.log(buy_cost) - log_growth
+    cost = np.exp(log_growth + _segmented_logcumsumexp(log_cost, segment_start))
+    cost[closed] = 0
+    cost_before = np.r_[0, cost[:-1]]
+    cost_before[segment_start] = 0
+    avg_before = np.divide(cost_before, q_before, out=np.zeros_like(cost_before), where=q_before > 0)
+    realized_avg = sold * (p - avg_before)
+
+    # FIFO: the cost of the units sold is read on the cumulative buy cost curve of the stock
+    # (curves of every stock laid end to end with an offset so that a single interpolation is enough)
+    cum_bought = _segmented_cumsum(buy_quantity, group_start)
+    cum_cost = _segmented_cumsum(buy_cost, group_start)
+    cum_sold = _segmented_cumsum(sold, group_start)
+    offset = stock * (cum_bought.max() + 1)
+    xp = np.r_[np.unique(offset), (offset + cum_bought)[buys]]
+    fp = np.r_[np.zeros(n), cum_cost[buys]]
+    curve = np.argsort(xp, kind="stable")
+    xp, fp = xp[curve], fp[curve]
+    fifo_cost_sold = np.interp(offset + cum_sold, xp, fp) - np.interp(offset + cum_sold - sold, xp, fp)
+    realized_fifo = np.where(sold > 0, sold * p - fifo_cost_sold, 0)
+
+    # per stock figures
+    quantity = q_after[last]
+    last_price = p[last]
+    price = np.where(np.isnan(prices), last_price, prices)
+    value = quantity * price
+    avg_basis = cost[last]
+    fifo_basis = cum_cost[last] - np.bincount(stock, weights=fifo_cost_sold, minlength=n)
+    realized = {"average": np.bincount(stock, weights=realized_avg, minlength=n),
+        "fifo": np.bincount(stock, weights=realized_fifo, minlength=n)}
+
+    total = value.sum() + cash
+    weights = value / total if total else np.zeros(n)
+    positions = [{
+        "symbol": ledger.symbols[i],
+        "name": ledger.names[i],
+        "quantity": int(quantity[i]),
+        "price": float(price[i]),
+        "value": float(value[i]),
+        "weight": float(weights[i]),
+        "cost_basis": {"average": float(avg_basis[i]), "fifo": float(fifo_basis[i])},
+        "realized_pl": {"average": float(realized["average"][i]), "fifo": float(realized["fifo"][i])},
+        "unrealized_pl": {"average": float(value[i] - avg_basis[i]), "fifo": float(value[i] - fifo_basis[i])}
+    } for i in range(n)]
+
+    # back to date order for the returns
+    by_date = np.empty_like(order)
+    by_date[order] = np.arange(len(order))
+    previous_price = np.where(group_start, p, np.r_[p[0], p[:-1]])
+
+    return {
+        "positions": positions,
+        "totals": _totals(value, avg_basis, fifo_basis, realized["average"], realized["fifo"], cash),
+        "returns": {
+            "time_weighted": _time_weighted_return(q[by_date], p[by_date], q_before[by_date], previous_price[by_date], value.sum()),
+            "money_weighted": _money_weighted_return(ledger.amount, ledger.time, value.sum(), now)
+        }
+    }
+
+def portfolio_analytics(ledger, cash, prices):
+    """Analytics of a ledger, prices maps the symbols to their latest quote (see lookup_many), valued in USD"""
+    quotes = [prices.get(symbol.upper()) for symbol in ledger.symbols]
+    latest = fx_rates.convert([quote["price"] if quote is not None else np.nan for quote in quotes], \
+        [(quote.get("currency") if quote is not None else None) or "USD" for quote in quotes], "USD")
+    return analyze(ledger, latest, cash=cash, now=time.time())
+
+def _segmented_cumsum(values, starts):
+    """Cumulative sum restarting at each start flag"""
+    total = np.cumsum(values)
+    # value of the cumulative sum just before each segment, broadcast to the segment
+    before = (total - values)[starts]
+    return total - before[np.cumsum(starts) - 1]
+
+def _segmented_logcumsumexp(values, starts):
+    """log(cumsum(exp(values))) restarting at each start flag, without overflow"""
+    finite = values[np.isfinite(values)]
+    if not len(finite):
+        return values
+    # shift each segment far enough above the previous ones for them to vanish from the sum
+    shift = (finite.max() - finite.min() + 1000) * (np.cumsum(starts) - 1)
+    return np.logaddexp.accumulate(values + shift) - shift
+
+def _time_weighted_return(quantity, price, quantity_before, previous_price, value_now):
+    """
+    Time-weighted return, the portfolio being valued at the last traded prices
+    between two trades (and at the latest prices at the end).
+    """
+    # value after each trade: previous value + price change of the traded stock + cash flow
+    value_after = np.cumsum(quantity_before * (price - previous_price) + quantity * price)
+    value_before = value_after - quantity * price
+    previous_value = np.r_[0, value_after[:-1]]
+    # ignore the rounding residue left by closed positions
+    held = previous_value > 1e-6
+    growth = np.prod(value_before[held] / previous_value[held])
+    if value_after[-1] > 1e-6:
+        growth *= value_now / value_after[-1]
+    return float(growth - 1)
+
+def _money_weighted_return(amount, time, value_now, now=None, iterations=50):
+    """Money-weighted return (annualized internal rate of return of the cash flows, Newton's method)"""
+    # cash flows seen from the investor: buys are outflows, sells inflows, the holdings are sold now
+    flows = np.r_[-amount, value_now]
+    end = now if now is not None else time[-1]
+    years = (np.r_[time, max(end, time[-1])] - time[0]) / YEAR
+    if years[-1] <= 0 or not (flows > 0).any() or not (flows < 0).any():
+        return None
+
+    rate = 0.1
+    for _ in range(iterations):
+        discount = (1 + rate) ** -years
+        npv = np.sum(flows * discount)
+        derivative = np.sum(-years * flows * discount / (1 + rate))
+        if derivative == 0:
+            return None
+        step = npv / derivative
+        rate = max(rate - step, -0.9999)
+        if abs(step) < 1e-10:
+            return float(rate)
+    return None
+
+def _totals(value, avg_basis, fifo_basis, realized_avg, realized_fifo, cash):
+    return {
+        "value": float(value.sum()),
+        "cash": float(cash),
+        "total": float(value.sum() + cash),
+        "cash_weight": float(cash / (value.sum() + cash)) if value.sum() + cash else 0.0,
+        "realized_pl": {"average": float(realized_avg.sum()), "fifo": float(realized_fifo.sum())},
+        "unrealized_pl": {"average": float(value.sum() - avg_basis.sum()), "fifo": float(value.sum() - fifo_basis.sum())}
+    }
@@ -1,13 +1,15 @@
+import hashlib
 import os
+import queue
 import sys
 import logging
 import requests
 
 # from cs50 import SQL
-from flask import Flask, flash, json, jsonify, redirect, render_template, request, session
+from flask import Flask, Response, flash, json, jsonify, redirect, render_template, request, session, \
+    stream_template, stream_with_context
 from flask.logging import default_handler
-from flask_session import Session
-from tempfile import mkdtemp
+from datetime import timedelta
 from werkzeug.exceptions import default_exceptions, HTTPException, InternalServerError
 from werkzeug.security import check_password_hash, generate_password_hash
 from sqlalchemy import select
@@ -15,7 +17,22 @@ from sqlalchemy.sql import func
 from logging import Formatter
 # local packages
 from models import *
-from helpers import apology, login_required, lookup, usd, percentage
+from analytics import load_ledger, portfolio_analytics
+import commands
+import trading
+import database
+import sessions
+import ledger_io
+import portfolio
+from pricestore import FREQUENCIES, price_store
+from valuation import equity_curves
+from streaming import price_fanout
+from symbols import symbol_master
+from fx import CURRENCIES, RateUnavailable, fx_rates
+from orderbook import trigger_engine
+from reporting import reports
+from instrumentation import instrumentation
+from helpers import admin_required, apology, login_required, lookup, lookup_many, quote_bridge, quote_cache, quote_provider, money, usd, percentage, parse_date
 
 # configure application
 app = Flask(__name__)
@@ -29,9 +46,11 @@ app.logger.addHandler(default_handler)
 # ensure templates are auto-reloaded
 app.config["TEMPLATES_AUTO_RELOAD"] = True
 
-# ensure responses aren't cached
+# ensure responses aren't cached (unless they carry their own validator or caching policy, like the conditional API responses)
 @app.after_request
 def after_request(response):
+    if "ETag" in response.headers or "Cache-Control" in response.headers:
+        return response
     response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     response.headers["Expires"] = 0
     response.headers["Pragma"] = "no-cache"
@@ -41,19 +60,21 @@ def after_request(response):
 # https://cs50.stackexchange.com/questions/34720/pset8-2019-jinja-env-filters-error
 app.jinja_env.filters["usd"] = usd
 app.jinja_env.filters["percentage"] = percentage
-
-# configure session to use filesystem (instead of signed cookies)
-app.config["SESSION_FILE_DIR"] = mkdtemp()
-app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
+app.jinja_env.filters["money"] = money
 
 # configure CS50 library to use SQLite database
 # db = SQL("sqlite:///finance.db")
 
 # configure DB to interact with Flask
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///finance.db"
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///finance.db")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# engine settings: SQLite busy timeout (seconds) & page cache (KiB), connection pool of client/server databases
+app.config["DB_BUSY_TIMEOUT"] = float(os.environ.get("DB_BUSY_TIMEOUT", 5))
+app.config["DB_CACHE_SIZE"] = int(os.environ.get("DB_CACHE_SIZE", 64 * 1024))
+app.config["DB_POOL_SIZE"] = int(os.environ.get("DB_POOL_SIZE", 10))
+app.config["DB_MAX_OVERFLOW"] = int(os.environ.get("DB_MAX_OVERFLOW", 20))
+app.config["DB_POOL_RECYCLE"] = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+database.init_app(app)
 # initialize app
 app.logger.debug("Initializing the Flask application...")
 # https://stackoverflow.com/questions/9692962/flask-sqlalchemy-import-context-issue/9695045#9695045
@@ -65,66 +86,148 @@ app.app_context().push()
 # get models & create corresponding DB tables if necessary
 app.logger.debug("Creating/Updating the application model...")
 db.create_all()
-
-# make sure API key is set
+add_missing_columns()
+create_indexes()
+Holding.ensure_built()
+# configure the session storage: filesystem, cookie (signed with SECRET_KEY), sqlalchemy or redis
+app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY")
+app.config["SESSION_BACKEND"] = os.environ.get("SESSION_BACKEND", "filesystem")
+app.config["SESSION_PERMANENT"] = False
+app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(seconds=int(os.environ.get("SESSION_LIFETIME", 31 * 86400)))
+app.config["SESSION_FILE_DIR"] = os.environ.get("SESSION_FILE_DIR", os.path.join(app.instance_path, "sessions"))
+app.config["SESSION_REDIS_URL"] = os.environ.get("SESSION_REDIS_URL", "redis://localhost:6379/0")
+app.config["SESSION_REDIS_POOL_SIZE"] = int(os.environ.get("SESSION_REDIS_POOL_SIZE", 10))
+# sweep expired sessions every N requests on average (otherwise with flask session_cleanup)
+if os.environ.get("SESSION_CLEANUP_N_REQUESTS"):
+    app.config["SESSION_CLEANUP_N_REQUESTS"] = int(os.environ.get("SESSION_CLEANUP_N_REQUESTS"))
+sessions.init_app(app, db)
+
+# register the command line interface (flask holdings ...)
+commands.init_app(app)
+
+# instrument the requests (SQL statements, quote lookups), Server-Timing header in debug mode by default
+app.config["INSTRUMENTATION_N_PLUS_ONE"] = int(os.environ.get("INSTRUMENTATION_N_PLUS_ONE", 5))
+app.config["INSTRUMENTATION_HEADER"] = os.environ.get("INSTRUMENTATION_HEADER", "1" if app.debug else "0") == "1"
+instrumentation.init_app(app)
+
+# select the quote provider: iex, simulator (offline random walks), replay or record (from/to QUOTE_REPLAY_DIR)
+app.config["QUOTE_PROVIDER"] = os.environ.get("QUOTE_PROVIDER", "iex")
+app.config["QUOTE_REPLAY_DIR"] = os.environ.get("QUOTE_REPLAY_DIR", os.path.join(app.instance_path, "quotes"))
+app.config["QUOTE_SIMULATOR_SEED"] = int(os.environ.get("QUOTE_SIMULATOR_SEED", 0))
+app.config["QUOTE_SIMULATOR_VOLATILITY"] = float(os.environ.get("QUOTE_SIMULATOR_VOLATILITY", 0.02))
+app.config["QUOTE_SIMULATOR_SYMBOLS"] = [symbol.strip().upper() for symbol in os.environ.get("QUOTE_SIMULATOR_SYMBOLS", "").split(",") if symbol.strip()]
+
+# make sure API key is set (IEX only)
 if os.environ.get("API_KEY"):
-    api_token = os.environ.get("API_KEY")
-    api_url_base = "https://cloud.iexapis.com/stable/stock/"
-    api_url_suffix = "/quote?token=" + api_token
-else:
+    app.config["QUOTE_API_TOKEN"] = os.environ.get("API_KEY")
+elif app.config["QUOTE_PROVIDER"] in ("iex", "record"):
     raise RuntimeError("API_KEY not set")
 
+# configure the quote provider client (timeouts & backoff in seconds), built once for the application
+app.config["QUOTE_API_URL"] = os.environ.get("QUOTE_API_URL", "https://cloud-sse.iexapis.com/stable")
+app.config["QUOTE_API_CONNECT_TIMEOUT"] = float(os.environ.get("QUOTE_API_CONNECT_TIMEOUT", 3.05))
+app.config["QUOTE_API_READ_TIMEOUT"] = float(os.environ.get("QUOTE_API_READ_TIMEOUT", 5))
+app.config["QUOTE_API_MAX_RETRIES"] = int(os.environ.get("QUOTE_API_MAX_RETRIES", 2))
+app.config["QUOTE_API_BACKOFF"] = float(os.environ.get("QUOTE_API_BACKOFF", 0.2))
+app.config["QUOTE_API_POOL_SIZE"] = int(os.environ.get("QUOTE_API_POOL_SIZE", 10))
+app.config["QUOTE_API_FAILURE_THRESHOLD"] = int(os.environ.get("QUOTE_API_FAILURE_THRESHOLD", 5))
+app.config["QUOTE_API_RESET_TIMEOUT"] = float(os.environ.get("QUOTE_API_RESET_TIMEOUT", 30))
+quote_provider.init_app(app)
+# optional asyncio layer coalescing concurrent fetches of the same symbols (requires httpx)
+app.config["QUOTE_ASYNC"] = os.environ.get("QUOTE_ASYNC", "0") == "1"
+# wait for the async layer longer than the provider's retry budget (every attempt timing out, plus the backoff delays)
+quote_api_budget = (app.config["QUOTE_API_MAX_RETRIES"] + 1) * (app.config["QUOTE_API_CONNECT_TIMEOUT"] + app.config["QUOTE_API_READ_TIMEOUT"]) \
+    + app.config["QUOTE_API_BACKOFF"] * (2 ** app.config["QUOTE_API_MAX_RETRIES"] - 1)
+app.config["QUOTE_ASYNC_TIMEOUT"] = float(os.environ.get("QUOTE_ASYNC_TIMEOUT", quote_api_budget + 5))
+quote_bridge.init_app(app, quote_provider)
+# exchange rates (iex or simulator, the quote provider's by default) cached for FX_CACHE_TTL seconds
+app.config["FX_PROVIDER"] = os.environ.get("FX_PROVIDER", "simulator" if app.config["QUOTE_PROVIDER"] in ("simulator", "replay") else "iex")
+app.config["FX_CACHE_TTL"] = float(os.environ.get("FX_CACHE_TTL", 300))
+fx_rates.init_app(app, quote_provider)
+
+# configure the historical price store (memory-mapped files)
+app.config["PRICE_STORE_DIR"] = os.environ.get("PRICE_STORE_DIR", os.path.join(app.instance_path, "prices"))
+price_store.init_app(app)
+
+# configure the live price feed (polling interval & keep-alive in seconds)
+app.config["PRICE_STREAM_INTERVAL"] = float(os.environ.get("PRICE_STREAM_INTERVAL", 5))
+app.config["PRICE_STREAM_KEEPALIVE"] = float(os.environ.get("PRICE_STREAM_KEEPALIVE", 15))
+price_fanout.init_app(app)
+
+# configure the process-wide quote cache (TTL & stale delay in seconds, stale quotes only served to the display paths)
+app.config["QUOTE_CACHE_TTL"] = float(os.environ.get("QUOTE_CACHE_TTL", 60))
+app.config["QUOTE_CACHE_SIZE"] = int(os.environ.get("QUOTE_CACHE_SIZE", 1024))
+app.config["QUOTE_CACHE_STALE_WHILE_REVALIDATE"] = os.environ.get("QUOTE_CACHE_STALE_WHILE_REVALIDATE", "1") == "1"
+app.config["QUOTE_CACHE_MAX_STALE"] = float(os.environ.get("QUOTE_CACHE_MAX_STALE", 300))
+quote_cache.init_app(app)
+
+# preload the symbol master data (stock ids & reference symbols, see flask symbols load)
+app.config["SYMBOLS_SUGGEST_LIMIT"] = int(os.environ.get("SYMBOLS_SUGGEST_LIMIT", 10))
+symbol_master.init_app(app)
+
+# cached portfolio valuations (number of users), revalued by the live price feed
+app.config["PORTFOLIO_CACHE_SIZE"] = int(os.environ.get("PORTFOLIO_CACHE_SIZE", 10000))
+portfolio.valuations.init_app(app)
+price_fanout.add_listener(portfolio.valuations.reprice)
+
+# fill the resting limit & stop orders from the live price feed in this process
+app.config["ORDERS_ENGINE"] = os.environ.get("ORDERS_ENGINE", "1") == "1"
+trigger_engine.init_app(app, price_fanout)
+
+# administrators (comma separated usernames) & refresh interval of the reporting rollups (seconds, 0: flask reports refresh)
+app.config["ADMIN_USERS"] = [username.strip().lower() for username in os.environ.get("ADMIN_USERS", "").split(",") if username.strip()]
+app.config["REPORTS_REFRESH_INTERVAL"] = float(os.environ.get("REPORTS_REFRESH_INTERVAL", 0))
+# how long the ids missing below the rollup watermark (transactions not committed yet) are looked up again (seconds)
+app.config["REPORTS_GAP_WINDOW"] = float(os.environ.get("REPORTS_GAP_WINDOW", 600))
+reports.init_app(app)
+
+# number of transactions per history page (default & maximum)
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
+
 @app.route("/")
 @login_required
 def index():
     """Show portfolio of stocks"""
     app.logger.debug("Index")
 
-    # get current user's balance
-    user_db = User.get_by_id(session["user_id"])
-    # get all the stocks currently available
-    stocks_db = Stock.get_all(user_id=user_db.id)
-    # lookup for current price/calculate the grand total
-    grand_total = user_db.cash
-    # convert object to array for template proccessing
-    transaction = {}
-    transactions = []
-
-    # https://stackoverflow.com/questions/16279212/how-to-use-dot-notation-for-dict-in-python
-    valid_stocks_db = (stock_db for stock_db in stocks_db if stock_db.quantity > 0)
-
-    for transaction_db in valid_stocks_db:
-        transaction["stock"] = transaction_db.stock
-        transaction["name"] = transaction_db.name
-        transaction["quantity"] = transaction_db.quantity
-        # lookup for current price
-        api_response = lookup(transaction_db.stock)
-        price = float(api_response["price"])
-        transaction["price"] = price
-        # define a comparison indicator on the price (latest) vs average price (DB)
-        avg_price = float(transaction_db.amount / transaction_db.quantity)
-
-        avg_price_5 = round(avg_price, 5)
-        price_5 = round(price, 5)
-
-        if price_5 > avg_price_5:
-            transaction["price_indicator"] = "table-success"
-        elif price_5 < avg_price_5:
-            transaction["price_indicator"] = "table-danger"
-        else:
-            transaction["price_indicator"] = "table-secondary"
+    # positions valued with one batched lookup (one round-trip whatever the number of stocks)
+    figures = portfolio.load(session["user_id"])
 
-        # the price variation is calculated based on historical average vs latest price
-        transaction["variation"] = ((price - avg_price) / avg_price)
-        # the amount is valuated based on the latest price
-        amount = float(transaction_db.quantity * price)
-        transaction["amount"] = amount
-        transactions.append(transaction.copy())
+    app.logger.debug("Render Index view")
+    return render_template("index.html", positions=figures["positions"], cash=figures["cash"], grand_total=figures["grand_total"], \
+        partial=figures["partial"], base_currency=figures["base_currency"])
 
-        grand_total += amount
+@app.route("/api/v1/portfolio")
+@login_required
+def api_portfolio():
+    """Positions, cash & grand total of the user (JSON, conditional GET)"""
+    app.logger.debug("API portfolio")
+    return conditional_json(portfolio.load(session["user_id"]))
 
-    app.logger.debug("Render Index view")
-    return render_template("index.html", transactions=transactions, cash=user_db.cash, grand_total=grand_total)
+@app.route("/api/v1/positions/<symbol>")
+@login_required
+def api_position(symbol):
+    """Position of the user in one stock (JSON, conditional GET), ?format=html for the table row"""
+    app.logger.debug("API position")
+
+    position = portfolio.load_position(User.get_by_id(session["user_id"]), symbol.upper())
+    if position is None or position["quantity"] <= 0:
+        return jsonify({"message": "position not found"}), 404
+    if request.args.get("format") == "html":
+        return conditional_response(portfolio.render_row(position), "text/html")
+    return conditional_json(position)
+
+def conditional_json(payload):
+    return conditional_response(json.dumps(payload), "application/json")
+
+def conditional_response(body, mimetype):
+    """Response tagged with a hash of its body, 304 Not Modified if the client has the same version"""
+    response = Response(body, mimetype=mimetype)
+    response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+    # revalidated on every use
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response.make_conditional(request)
 
 @app.route("/quote", methods=["GET", "POST"])
 @login_required
@@ -139,8 +242,9 @@ def quote():
 
     # user reached route via POST (as by submitting a form via POST)
     if request.method == "POST":
-        # consume the API to get the latest price
-        api_response = lookup(request.form.get("stock"))
+        symbol = request.form.get("stock", "").strip()
+        # unknown tickers are rejected locally (reference list), the others are quoted by the API
+        api_response = lookup(symbol) if symbol_master.known(symbol) is not False else None
         # check for potential errors
         if api_response is None:
             # add an explicit message to the page
@@ -154,12 +258,44 @@ def quote():
             amount = api_response["price"]
 
             app.logger.debug("Render Quote view from POST")
-            return render_template("quote_response.html", stock=api_response["symbol"], name=api_response["name"], amount=amount)
+            return render_template("quote_response.html", stock=api_response["symbol"], name=api_response["name"], amount=amount, \
+                currency=api_response.get("currency") or "USD")
     # user reached route via GET (as by clicking a link or via redirect)
     else:
         app.logger.debug("Render Quote view from GET")
         return render_template("quote_request.html")
 
+@app.route("/settings", methods=["GET", "POST"])
+@login_required
+def settings():
+    """Select the base currency of the portfolio & history views"""
+    app.logger.debug("Settings")
+
+    user_db = User.get_by_id(session["user_id"])
+    # user reached route via POST
+    if request.method == "POST":
+        currency = request.form.get("currency")
+        if currency not in CURRENCIES:
+            flash("currency not supported")
+            return redirect("/settings")
+        user_db.base_currency = currency
+        # commit changes
+        db.session.commit()
+        flash("Saved!")
+        app.logger.debug("Redirect to Index view from POST")
+        return redirect("/")
+
+    # user reached route via GET (as by clicking a link or via redirect)
+    else:
+        app.logger.debug("Render Settings view from GET")
+        return render_template("settings.html", currencies=CURRENCIES, base_currency=user_db.base_currency)
+
+@app.route("/symbols/suggest")
+@login_required
+def symbols_suggest():
+    """Typeahead: reference symbols matching the beginning of a ticker or company name (?q=...)"""
+    return jsonify(symbol_master.suggest(request.args.get("q", "")))
+
 @app.route("/buy", methods=["GET", "POST"])
 @login_required
 def buy():
@@ -169,8 +305,9 @@ def buy():
     # user reached route via POST
     if request.method == "POST":
         validated = True
-        # consume the API to get the latest price
-        api_response = lookup(request.form.get("symbol"))
+        symbol = request.form.get("symbol", "").strip()
+        # consume the API to get the latest price (unless the reference list doesn't know the ticker), never a stale quote
+        api_response = lookup(symbol, fresh=True) if symbol_master.known(symbol) is not False else None
         # check for potential errors
         if api_response is None:
             validated = False
@@ -179,39 +316,16 @@ def buy():
             # return to same page for full rendering
             return redirect("/buy")
         else:
-            # calculate the transaction amount to check whether the user can afford to purchase these stocks
-            amount = float(request.form.get("shares")) * float(api_response["price"])
-            # query the DB to get the cash available for the user
-            user_db = User.get_by_id(session["user_id"])
-            if user_db.cash < amount:
+            try:
+                # check the balance, update the stock, transaction & user tables in one DB transaction
+                trading.buy(session["user_id"], api_response, request.form.get("shares", type=int))
+            except trading.TradeError as e:
                 validated = False
                 # add an explicit message to the page
-                flash("balance too low")
+                flash(e.message)
                 # return to same page for full rendering
                 return redirect("/buy")
             else:
-                # update the transaction & the stock tables
-                stock_db_exists = Stock.exist_by_name(name=api_response["name"])
-
-                if stock_db_exists is False:
-                    # add the stock to the master data
-                    stock_db = Stock(stock=api_response["symbol"], name=api_response["name"])
-                    # post the master data
-                    db.session.add(stock_db)
-                    # commit changes to get an Id for the stock
-                    db.session.commit()
-
-                stock_db = Stock.get_by_name(name=api_response["name"])
-                # add the transaction to the transaction data
-                transaction_db = Transaction(stock_id=stock_db.id, user_id=session["user_id"], \
-                    quantity=int(request.form.get("shares")), price=float(api_response["price"]), amount=amount)
-                # post the transaction data
-                db.session.add(transaction_db)
-                # subtract the amount of the transaction to the user's cash
-                user_db.cash -= amount
-                # commit changes to validate the transaction
-                db.session.commit()
-
                 # add an explicit message to the page
                 flash("Bought!")
                 # redirect user to home page
@@ -247,7 +361,7 @@ def sell():
         validated = True
         # get the values entered by the user
         stock = request.form.get("symbol")
-        quantity = int(request.form.get("shares"))
+        quantity = request.form.get("shares", type=int)
 
         # return the DB row for the selected stock
         stock_db = next((stock_db for stock_db in valid_stocks_db if stock_db.stock == stock), None)
@@ -257,31 +371,21 @@ def sell():
             flash("stock does not exist")
             # return to same page for full rendering
             return redirect("/sell")
-        else:
-            if stock_db.quantity < quantity:
-                validated = False
+
+        if validated == True:
+            # consume the API to get the latest price, never a stale quote
+            api_response = lookup(stock, fresh=True)
+            try:
+                if api_response is None:
+                    raise trading.TradeError("quote not available")
+                # check the quantity held, update the transaction & user tables in one DB transaction
+                trading.sell(session["user_id"], api_response, quantity)
+            except trading.TradeError as e:
                 # add an explicit message to the page
-                flash("quantity is too high")
+                flash(e.message)
                 # return to same page for full rendering
                 return redirect("/sell")
 
-        if validated == True:
-            # consume the API to get the latest price
-            api_response = lookup(stock)
-            price = float(api_response["price"])
-            # calculate the corresponding amount
-            amount = quantity * price
-            # add the transaction to the transaction data
-            transaction_db = Transaction(stock_id=stock_db.id, user_id=session["user_id"], \
-                quantity=-1*quantity, price=price, amount=-1*amount)
-            # post the transaction data
-            db.session.add(transaction_db)
-            # add the amount of the transaction to the user's cash
-            user_db = User.query.get(session["user_id"])
-            user_db.cash += amount
-            # commit changes to validate the transaction
-            db.session.commit()
-
             # add an explicit message to the page
             flash("Sold!")
             # redirect user to home page
@@ -299,161 +403,350 @@ def sell():
 @app.route("/history")
 @login_required
 def history():
-    """Show history of transactions"""
+    """
+    Show history of transactions
+
+    the transactions are paginated with a keyset cursor on (created_on, id) (?after=<id>&page_size=...),
+    or streamed in one response (?stream=1), optionally filtered by date & symbol
+    """
     app.logger.debug("History")
 
-    # get current user
-    user_db = User.get_by_id(session["user_id"])
-    # get all the transactions for the user
-    transactions_db = Transaction.get_all(user_id=user_db.id)
-    # format the price
-    transaction = {}
-    transactions = []
-
-    for transaction_db in transactions_db:
-        transaction["stock"] = transaction_db.stock
-        transaction["name"] = transaction_db.name
-        transaction["quantity"] = transaction_db.quantity
-        transaction["price"] = transaction_db.price
-        transaction["transacted"] = transaction_db.created_on
-        transactions.append(transaction.copy())
+    # get the filters (pushed down to the DB)
+    symbol = request.args.get("symbol", "").strip().upper() or None
+    start = parse_date(request.args.get("start"))
+    end = parse_date(request.args.get("end"))
+    filters = {
+        "symbol": symbol,
+        "start": start,
+        # the end date is included
+        "end": end + timedelta(days=1) if end is not None else None
+    }
+    # amounts converted to the base currency of the user (one pass per page)
+    base = User.get_by_id(session["user_id"]).base_currency
+    # keep the filters in the pagination links
+    args = {"symbol": symbol, "start": request.args.get("start") if start else None, "end": request.args.get("end") if end else None}
+
+    if request.args.get("stream") == "1":
+        # get all the transactions for the user, rendered while they are fetched page by page
+        transactions_db = Transaction.iter_all(user_id=session["user_id"], **filters)
+        app.logger.debug("Stream History view")
+        return stream_template("history.html", transactions=fx_rates.convert_rows(transactions_db, base), args=args, next_cursor=None, \
+            base_currency=base)
+
+    page_size = max(1, min(request.args.get("page_size", HISTORY_PAGE_SIZE, type=int), HISTORY_MAX_PAGE_SIZE))
+    # get one page of transactions for the user (one more to know whether there is a next page)
+    transactions_db = Transaction.get_page(user_id=session["user_id"], after=request.args.get("after", type=int), \
+        limit=page_size + 1, **filters)
+
+    next_cursor = None
+    if len(transactions_db) > page_size:
+        transactions_db = transactions_db[:page_size]
+        next_cursor = transactions_db[-1].id
+        args["page_size"] = page_size if page_size != HISTORY_PAGE_SIZE else None
 
     app.logger.debug("Render History view")
-    return render_template("history.html", transactions=transactions)
+    return render_template("history.html", transactions=list(fx_rates.convert_rows(transactions_db, base)), args=args, \
+        next_cursor=next_cursor, base_currency=base)
 
-# routes for Ajax requests
-@app.route("/buy_1", methods=["POST"])
+@app.route("/analytics")
 @login_required
-def buy_1():
-    """Buy 1 share of stock"""
-    app.logger.debug("Buy 1 share from Button")
+def analytics():
+    """Show analytics of the portfolio"""
+    app.logger.debug("Analytics")
 
-    # user reached route via form POST
-    validated = True
-    message = None
-    # replace single quotes with double quotes if necessary to get valid JSON
-    transaction = json.loads(request.form.get("transaction").replace("\'", "\""))
-    dis_total = float(json.loads(request.form.get("grand_total").replace("\'", "\"")))
-    # consume the API to get the latest price
-    api_response = lookup(transaction["stock"])
-    # check for potential errors
-    if api_response is None:
-        validated = False
-        message = "stock does not exist"
-    else:
-        # check whether the user can afford to purchase an additional stock
-        cur_price = float(api_response["price"])
-        # query the DB to get the cash available for the user
-        user_db = User.get_by_id(session["user_id"])
-        if user_db.cash < cur_price:
-            validated = False
-            message = "balance too low"
+    report = portfolio_report(session["user_id"])
+
+    app.logger.debug("Render Analytics view")
+    return render_template("analytics.html", report=report)
+
+@app.route("/api/analytics")
+@login_required
+def analytics_api():
+    """Analytics of the portfolio as JSON"""
+    app.logger.debug("Analytics API")
+    return jsonify(portfolio_report(session["user_id"]))
+
+def portfolio_report(user_id):
+    """Load the ledger of the user once, price it with one batched lookup & compute the analytics"""
+    user_db = User.get_by_id(user_id)
+    ledger = load_ledger(user_db.id)
+    return portfolio_analytics(ledger, cash=user_db.cash, prices=lookup_many(ledger.symbols))
+
+@app.route("/prices/<symbol>")
+@login_required
+def prices(symbol):
+    """Historical bars of a stock as JSON (served from the local price store)"""
+    app.logger.debug("Prices")
+
+    frequency = request.args.get("frequency", "daily")
+    if frequency not in FREQUENCIES:
+        return jsonify({"success": False, "message": "unknown frequency"}), 400
+    bars = price_store.range(symbol, start=parse_date(request.args.get("start")), end=parse_date(request.args.get("end")), \
+        frequency=frequency)
+    return jsonify({"success": True, "symbol": symbol.upper(), "frequency": frequency, \
+        "bars": {name: bars[name].tolist() for name in bars.dtype.names}})
+
+@app.route("/equity")
+@login_required
+def equity():
+    """Daily valuation of the portfolio as JSON (equity curve)"""
+    app.logger.debug("Equity")
+    return jsonify(equity_curves.get(session["user_id"]).to_dict())
+
+@app.route("/equity/chart")
+@login_required
+def equity_chart():
+    """Show the equity curve"""
+    app.logger.debug("Render Equity view")
+    return render_template("equity.html")
+
+@app.route("/export")
+@login_required
+def export():
+    """Download the transactions or holdings of the user (csv or parquet)"""
+    app.logger.debug("Export")
+
+    data = request.args.get("data", "transactions")
+    format = request.args.get("format", "csv")
+    if data not in ("transactions", "holdings") or format not in ledger_io.FORMATS:
+        return apology("invalid export", 400)
+
+    # the file is streamed chunk by chunk
+    chunks = ledger_io.export_chunks(data, format, user_id=session["user_id"])
+    return Response(stream_with_context(chunks), mimetype=ledger_io.FORMATS[format], \
+        headers={"Content-Disposition": f"attachment; filename={data}.{format}"})
+
+# routes for Server-Sent Events
+@app.route("/stream/prices")
+@login_required
+def stream_prices():
+    """Push the price changes of the stocks held by the user (text/event-stream)"""
+    app.logger.debug("Stream prices")
+
+    # get all the stocks currently held (the page is reloaded when this changes)
+    symbols = [stock_db.stock for stock_db in Stock.get_all(user_id=session["user_id"]) if stock_db.quantity > 0]
+    keepalive = app.config["PRICE_STREAM_KEEPALIVE"]
+    user_db = User.get_by_id(session["user_id"])
+    user_id = user_db.id
+    # the totals of the valuation cache are in USD, not sent while the base currency has no rate
+    try:
+        to_base = fx_rates.rate("USD", user_db.base_currency)
+    except RateUnavailable:
+        to_base = None
+
+    def events():
+        subscription = price_fanout.subscribe(symbols)
+        try:
+            # reconnection delay for the browser (ms)
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    prices = subscription.get(timeout=keepalive)
+                    yield f"event: prices\ndata: {json.dumps(prices)}\n\n"
+                    # grand total of the valuation cache, revalued at these prices by the feed
+                    total = portfolio.valuations.total(user_id)
+                    if total is not None and to_base is not None:
+                        yield f"event: total\ndata: {json.dumps({'grand_total': total * to_base})}\n\n"
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+        finally:
+            price_fanout.unsubscribe(subscription)
+
+    return Response(events(), mimetype="text/event-stream", headers={"X-Accel-Buffering": "no"})
+
+@app.route("/orders", methods=["GET", "POST"])
+@login_required
+def orders():
+    """Place & list the resting limit and stop orders"""
+    app.logger.debug("Orders")
+
+    # user reached route via POST
+    if request.method == "POST":
+        symbol = request.form.get("symbol", "").strip()
+        # the quote validates the symbol (name of the stock)
+        api_response = lookup(symbol) if symbol_master.known(symbol) is not False else None
+        try:
+            if api_response is None:
+                raise trading.UnknownStock()
+            order_db = trading.place_order(session["user_id"], api_response, request.form.get("side"), request.form.get("kind"), \
+                request.form.get("shares", type=int), request.form.get("price", type=float))
+        except trading.TradeError as e:
+            # add an explicit message to the page
+            flash(e.message)
         else:
-            stock_db = Stock.get_by_name(name=api_response["name"])
-            # add the transaction to the transaction data
-            transaction_db = Transaction(stock_id=stock_db.id, user_id=session["user_id"], \
-                quantity=1, price=cur_price, amount=cur_price)
-            # post the transaction data
-            db.session.add(transaction_db)
-            # subtract the amount of the transaction to the user's cash
-            user_db.cash -= cur_price
-            # commit changes to validate the transaction
-            db.session.commit()
+            trigger_engine.add(order_db)
+            flash("Order placed!")
+        # return to same page for full rendering
+        app.logger.debug("Redirect to Orders view from POST")
+        return redirect("/orders")
 
-        if validated == True:
-            # recalculate the figures for the selected stock
-            transaction_db = Transaction.get_by_symbol(user_id=user_db.id, symbol=api_response["symbol"])
-            # define a comparison indicator on the price (latest) vs average price (DB)
-            avg_price = float(transaction_db.amount / transaction_db.quantity)
-            dis_price = float(transaction["price"])
-            amount = float(transaction_db.quantity * cur_price)
-            variation = (cur_price - avg_price) / avg_price
-
-            # update the figures from the existing one (raw data not converted)
-            transaction["quantity"] = transaction_db.quantity
-            transaction["price"] = cur_price
-            transaction["amount"] = amount
-            transaction["variation"] = variation
-            if (variation < 0):
-                transaction["price_indicator"] = "table-danger"
-            elif (variation == 0):
-                transaction["price_indicator"] = "table-secondary"
-            else:
-                transaction["price_indicator"] = "table-success"
+    # user reached route via GET (as by clicking a link or via redirect)
+    else:
+        app.logger.debug("Render Orders view from GET")
+        return render_template("orders.html", orders=Order.get_all(session["user_id"]))
+
+@app.route("/orders/<int:order_id>/cancel", methods=["POST"])
+@login_required
+def cancel_order(order_id):
+    """Cancel an open order"""
+    app.logger.debug("Cancel order")
+
+    order_db = Order.query.get(order_id)
+    if order_db is not None and trading.cancel_order(session["user_id"], order_id):
+        trigger_engine.remove(order_id, order_db.symbol)
+        flash("Order cancelled!")
+    else:
+        flash("order not open")
+    return redirect("/orders")
 
-            grand_total = dis_total - dis_price + cur_price
-            # server-side rendering for filtered values
-            return jsonify({"success": True, "transaction": transaction, "cash": usd(user_db.cash), "price": usd(cur_price), \
-                "amount": usd(amount), "variation": percentage(variation), "grand_total": usd(grand_total)})
+@app.route("/orders/batch", methods=["POST"])
+@login_required
+def orders_batch():
+    """
+    Execute several orders in one round-trip (JSON)
+
+    {"orders": [{"symbol": "AAPL", "shares": 10, "side": "buy"}, ...]} or {"targets": {"AAPL": 0.6, ...}}
+    (fractions of the portfolio value, held symbols missing from the targets are sold)
+    """
+    app.logger.debug("Batch orders")
+
+    # retried request (same Idempotency-Key): send the response of the executed orders back
+    idempotency_key = request.headers.get("Idempotency-Key")
+    if idempotency_key and (response := IdempotencyKey.get_response(session["user_id"], idempotency_key)) is not None:
+        return jsonify(response)
+
+    payload = request.get_json(silent=True) or {}
+    try:
+        if "targets" in payload:
+            targets = {symbol.upper(): float(weight) for symbol, weight in payload["targets"].items()}
+            held = [stock_db.stock for stock_db in Stock.get_all(user_id=session["user_id"])]
+            # price everything in one batched quote fetch
+            quotes = lookup_many(list(targets) + held, fresh=True)
+            orders = trading.plan_rebalance(session["user_id"], targets, quotes)
         else:
-            return jsonify({"success": False, "message": message})
+            orders = {}
+            for order in payload.get("orders", []):
+                symbol = str(order.get("symbol", "")).upper()
+                shares = order.get("shares")
+                if not isinstance(shares, int) or shares <= 0 or order.get("side", "buy") not in ("buy", "sell"):
+                    raise trading.InvalidQuantity(f"{symbol}: invalid order")
+                orders[symbol] = orders.get(symbol, 0) + (shares if order.get("side", "buy") == "buy" else -shares)
+            # price everything in one batched quote fetch
+            quotes = lookup_many(orders, fresh=True)
+        trades = trading.execute_batch(session["user_id"], orders, quotes, idempotency_key=idempotency_key)
+    except trading.DuplicateOrder as e:
+        return jsonify({"success": False, "message": e.message}), 409
+    except trading.TradeError as e:
+        return jsonify({"success": False, "message": e.message}), 400
+    except (AttributeError, TypeError, ValueError):
+        return jsonify({"success": False, "message": "invalid orders"}), 400
+
+    user_db = User.get_by_id(session["user_id"])
+    response = {"success": True, "cash": usd(user_db.cash), "orders": [dict(trade, symbol=symbol) for symbol, trade in sorted(trades.items())]}
+    if idempotency_key:
+        IdempotencyKey.store(session["user_id"], idempotency_key, response)
+    return jsonify(response)
+
+# routes for Ajax requests
+@app.route("/buy_1", methods=["POST"])
+@login_required
+def buy_1():
+    """Buy 1 share of stock"""
+    app.logger.debug("Buy 1 share from Button")
+    return trade_1(trading.buy)
 
 @app.route("/sell_1", methods=["POST"])
 @login_required
 def sell_1():
     """Sell 1 share of stock"""
     app.logger.debug("Sell 1 share from Button")
+    return trade_1(trading.sell)
 
-    # user reached route via form POST
-    validated = True
-    message = None
-    # replace single quotes with double quotes if necessary to get valid JSON
-    transaction = json.loads(request.form.get("transaction").replace("\'", "\""))
-    dis_total = float(json.loads(request.form.get("grand_total").replace("\'", "\"")))
-    # consume the API to get the latest price
-    api_response = lookup(transaction["stock"])
+def trade_1(trade):
+    """
+    Trade 1 share of the posted symbol, send the new figures back (JSON).
+
+    The position is recalculated server-side, the grand total comes from the cached valuation
+    of the portfolio. The response carries the raw figures, the formatted values & the
+    rendered table row.
+    """
+    # retried request (same Idempotency-Key): send the response of the executed order back
+    idempotency_key = request.headers.get("Idempotency-Key")
+    if idempotency_key and (response := IdempotencyKey.get_response(session["user_id"], idempotency_key)) is not None:
+        return jsonify(response)
+
+    symbol = request.form.get("symbol", "").upper()
+    # consume the API to get the latest price, never a stale quote
+    api_response = lookup(symbol, fresh=True) if symbol else None
     # check for potential errors
     if api_response is None:
-        validated = False
-        message = "stock does not exist"
-    else:
-        cur_price = float(api_response["price"])
-        # query the DB to get the cash available for the user
-        user_db = User.get_by_id(session["user_id"])
-        # check whether the quantity for this stock is enough
-        stock_db = Transaction.get_by_symbol(user_id=user_db.id, symbol=api_response["symbol"])
-
-        if stock_db.quantity < 1:
-            validated = False
-            message = "no more stock to sell"
-        else:
-            # add the transaction to the transaction data
-            transaction_db = Transaction(stock_id=stock_db.id, user_id=session["user_id"], \
-                quantity=-1, price=cur_price, amount=-cur_price)
-            # post the transaction data
-            db.session.add(transaction_db)
-            # add the amount of the transaction to the user's cash
-            user_db.cash += cur_price
-            # commit changes to validate the transaction
-            db.session.commit()
-
-        if validated == True:
-            # recalculate the figures for the selected stock
-            transaction_db = Transaction.get_by_symbol(user_id=user_db.id, symbol=api_response["symbol"])
-            # define a comparison indicator on the price (latest) vs average price (DB)
-            avg_price = float(transaction_db.amount / transaction_db.quantity) if transaction_db.quantity > 0 else 0
-            dis_price = float(transaction["price"])
-            amount = float(transaction_db.quantity * cur_price)
-            variation = (cur_price - avg_price) / avg_price if avg_price > 0 else 0
-
-            # update the figures from the existing one (raw data not converted)
-            transaction["quantity"] = transaction_db.quantity
-            transaction["price"] = cur_price
-            transaction["amount"] = amount
-            transaction["variation"] = variation
-            if (variation < 0):
-                transaction["price_indicator"] = "table-danger"
-            elif (variation == 0):
-                transaction["price_indicator"] = "table-secondary"
-            else:
-                transaction["price_indicator"] = "table-success"
+        return jsonify({"success": False, "message": "stock does not exist"})
+    cur_price = float(api_response["price"])
+    try:
+        # check the balance or quantity held & update the tables in one DB transaction
+        trade(session["user_id"], api_response, 1, idempotency_key=idempotency_key)
+    except trading.DuplicateOrder as e:
+        return jsonify({"success": False, "message": e.message}), 409
+    except (trading.InsufficientShares, trading.UnknownStock):
+        return jsonify({"success": False, "message": "no more stock to sell"})
+    except trading.TradeError as e:
+        return jsonify({"success": False, "message": e.message})
 
-            grand_total = dis_total + dis_price - cur_price
-            # server-side rendering for filtered values
-            return jsonify({"success": True, "transaction": transaction, "cash": usd(user_db.cash), "price": usd(cur_price), \
-                "amount": usd(amount), "variation": percentage(variation), "grand_total": usd(grand_total)})
-        else:
-            return jsonify({"success": False, "message": message})
+    user_db = User.get_by_id(session["user_id"])
+    # the trade is committed: figures in USD if the base currency has no rate
+    base, to_base = portfolio.display_currency(user_db)
+    # recalculate the figures for the selected stock
+    position = portfolio.load_position(user_db, api_response["symbol"], quote=api_response)
+    quantity = position["quantity"] if position is not None else 0
+    # authoritative grand total from the valuation cache (updated by the trade)
+    grand_total = portfolio.grand_total(user_db, to_base)
+    cash = user_db.cash * to_base
+
+    # server-side rendering for filtered values
+    response = {"success": True, "position": position, "row": portfolio.render_row(position) if quantity > 0 else None, \
+        "cash": money(cash, base), "price": money(cur_price, api_response.get("currency") or "USD"), \
+        "amount": money(position["value"] if position else 0, base), \
+        "variation": percentage(position["variation"] if position else 0), "grand_total": money(grand_total, base), \
+        "totals": {"cash": cash, "grand_total": grand_total}}
+    if idempotency_key:
+        IdempotencyKey.store(session["user_id"], idempotency_key, response)
+    return jsonify(response)
+
+# quote layer counters exported along with the request metrics
+instrumentation.register("finance_quote_cache_total", "counter", "Quote cache events", \
+    lambda: {"event": {key: value for key, value in quote_cache.stats().items() if key != "size"}})
+instrumentation.register("finance_quote_cache_size", "gauge", "Cached quotes", lambda: quote_cache.stats()["size"])
+instrumentation.register("finance_quote_provider_circuit_open", "gauge", "Whether the quote provider circuit is open", \
+    lambda: int(quote_provider.breaker is not None and quote_provider.breaker.state == "open"))
+instrumentation.register("finance_quote_coalescing_total", "counter", "Coalesced quote fetches (async layer)", \
+    lambda: {"event": dict(quote_bridge.flight.stats)})
+
+@app.route("/admin/reports")
+@admin_required
+def admin_reports():
+    """Firm-wide views from the rollup tables: top portfolios, most held stocks & daily traded volume"""
+    app.logger.debug("Admin reports")
+
+    limit = min(request.args.get("k", 20, type=int), 500)
+    state_db = db.session.get(RollupState, "transactions")
+    app.logger.debug("Render Admin reports view")
+    return render_template("admin_reports.html", portfolios=PortfolioRollup.top(limit), symbols=SymbolRollup.top(limit), \
+        volumes=DailyVolume.latest(30), refreshed_on=state_db.refreshed_on if state_db is not None else None)
+
+@app.route("/admin/reports/refresh", methods=["POST"])
+@admin_required
+def admin_reports_refresh():
+    """Refresh the rollup tables now"""
+    app.logger.debug("Admin reports refresh")
+
+    stats = reports.refresh()
+    flash(f"Refreshed: {stats['transactions']} new transactions, {stats['symbols']} stocks priced")
+    return redirect("/admin/reports")
+
+@app.route("/metrics")
+def metrics():
+    """Expose the application metrics (Prometheus text format)"""
+    return Response(instrumentation.render(), mimetype="text/plain; version=0.0.4")
 
 # routes for user management
 @app.route("/login", methods=["GET", "POST"])
@@ -0,0 +1,195 @@
+import asyncio
+import concurrent.futures
+import random
+import threading
+import urllib.parse
+
+try:
+    import httpx
+except ImportError:
+    # the async layer is optional
+    httpx = None
+
+# local packages
+from providers import BATCH_SIZE, MAX_WORKERS, RETRY_STATUSES, IEXProvider, ProviderUnavailable
+
+class SingleFlight:
+    """
+    Coalesce concurrent requests per key.
+
+    A key already being fetched is not fetched again: later callers await the result
+    of the call in flight. Keys not in flight are fetched together in one call.
+    Must be used from a single event loop.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self.stats = {"calls": 0, "keys": 0, "coalesced": 0}
+
+    async def fetch_many(self, keys, fetch):
+        """Results for keys ({key: result}, None when missing), fetch(keys) being called for the keys not in flight"""
+        loop = asyncio.get_running_loop()
+        futures = {}
+        leading = []
+        for key in keys:
+            future = self._inflight.get(key)
+            if future is None:
+                future = self._inflight[key] = loop.create_future()
+                leading.append(key)
+            else:
+                self.stats["coalesced"] += 1
+            futures[key] = future
+
+        if leading:
+            self.stats["calls"] += 1
+            self.stats["keys"] += len(leading)
+            results = {}
+            try:
+                results = await fetch(leading)
+            except Exception:
+                # the waiting callers get no quote, like for an unknown symbol
+                pass
+            finally:
+                for key in leading:
+                    future = self._inflight.pop(key)
+                    if not future.done():
+                        future.set_result(results.get(key))
+
+        return {key: await future for key, future in futures.items()}
+
+class AsyncIEXProvider:
+    """
+    asyncio client for the IEX cloud API (httpx).
+
+    Shares the settings & circuit breaker of the synchronous provider it wraps.
+    """
+
+    def __init__(self, provider, max_connections=20):
+        if httpx is None:
+            raise RuntimeError("the async quote layer requires httpx")
+        self.provider = provider
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(provider.timeout[1], connect=provider.timeout[0]),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections))
+        self._semaphore = asyncio.Semaphore(MAX_WORKERS)
+
+    async def fetch(self, symbols):
+        """Fetch quotes for several symbols (batch endpoint, concurrent single calls as a fallback)"""
+        quotes = {}
+
+        for start in range(0, len(symbols), BATCH_SIZE):
+            chunk = symbols[start:start + BATCH_SIZE]
+            try:
+                data = await self.get("stock/market/batch", symbols=",".join(chunk), types="quote")
+                batch = {symbol: self._parse(data.get(symbol, {}).get("quote")) for symbol in chunk}
+            except ProviderUnavailable:
+                break
+            except (httpx.HTTPError, ValueError, AttributeError):
+                batch = dict(zip(chunk, await asyncio.gather(*(self._fetch_one(symbol) for symbol in chunk))))
+            quotes.update((symbol, quote) for symbol, quote in batch.items() if quote is not None)
+
+        return quotes
+
+    async def _fetch_one(self, symbol):
+        async with self._semaphore:
+            try:
+                return self._parse(await self.get(f"stock/{urllib.parse.quote_plus(symbol)}/quote"))
+            except (ProviderUnavailable, httpx.HTTPError, ValueError):
+                return None
+
+    async def get(self, path, **params):
+        """Call an API endpoint and return the decoded JSON payload (retries & circuit breaker)."""
+        provider = self.provider
+        if not provider.breaker.allow():
+            raise ProviderUnavailable("circuit open")
+
+        params["token"] = provider.token
+        url = f"{provider.base_url}/{path}"
+
+        for attempt in range(provider.max_retries + 1):
+            try:
+                response = await self.client.get(url, params=params)
+            except httpx.RequestError as e:
+                # transport errors, broken or undecodable responses, redirect loops...
+                error = e
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    provider.breaker.record_success()
+                    response.raise_for_status()
+                    return response.json()
+                error = httpx.HTTPStatusError(f"{response.status_code} from provider", request=response.request, response=response)
+
+            if attempt < provider.max_retries:
+                # exponential backoff with full jitter
+                await asyncio.sleep(random.uniform(0, provider.backoff * 2 ** attempt))
+
+        provider.breaker.record_failure()
+        raise error
+
+    def _parse(self, quote):
+        try:
+            return self.provider._parse_quote(quote)
+        except (KeyError, TypeError, ValueError):
+            return None
+
+class AsyncExecutorProvider:
+    """Run the fetches of a synchronous provider (simulator, replay...) in the loop's executor"""
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    async def fetch(self, symbols):
+        return await asyncio.get_running_loop().run_in_executor(None, self.provider.fetch, symbols)
+
+class AsyncQuoteBridge:
+    """
+    Run the async quote layer on a background event loop.
+
+    Synchronous callers (Flask worker threads) block on fetch() for at most timeout seconds;
+    every request goes through the same loop, so concurrent requests for a symbol share a
+    single upstream call whatever the calling thread.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.timeout = 10
+        self.flight = SingleFlight()
+        self._loop = None
+        self._client = None
+
+    def init_app(self, app, provider):
+        """Start the event loop if the async layer is enabled (QUOTE_ASYNC)."""
+        self.enabled = app.config.get("QUOTE_ASYNC", False)
+        self.timeout = app.config.get("QUOTE_ASYNC_TIMEOUT", self.timeout)
+        if not self.enabled or self._loop is not None:
+            return
+
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="quote-loop", daemon=True).start()
+
+        # configured provider: wrap the selected backend
+        backend = getattr(provider, "backend", provider)
+
+        async def create_client():
+            if not isinstance(backend, IEXProvider):
+                return AsyncExecutorProvider(backend)
+            # the client (connection pool) belongs to the loop
+            return AsyncIEXProvider(backend, max_connections=app.config.get("QUOTE_API_POOL_SIZE", 20))
+
+        self._client = asyncio.run_coroutine_threadsafe(create_client(), self._loop).result()
+
+    def fetch(self, symbols):
+        """Fetch quotes from a synchronous caller, no quote ({}) if the upstream is slower than the timeout"""
+        future = self._submit(symbols)
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            # like the synchronous provider on failure: the symbols are left out
+            future.cancel()
+            return {}
+
+    def _submit(self, symbols):
+        async def fetch():
+            results = await self.flight.fetch_many(symbols, self._client.fetch)
+            return {symbol: quote for symbol, quote in results.items() if quote is not None}
+        return asyncio.run_coroutine_threadsafe(fetch(), self._loop)
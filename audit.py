@@ -0,0 +1,73 @@
+from sqlalchemy import event
+# local packages
+from models import db, DailyVolume, FxRate, Holding, Order, PortfolioRollup, Stock, SymbolRollup, Transaction, User
+
+def model_queries(user_id=1, symbol="AAPL", name="Apple Inc."):
+    """Queries issued by the application through the model methods (name, callable[, plan fragment it must use])"""
+    return [
+        ("User.get_by_id", lambda: User.get_by_id(user_id)),
+        ("User.get_by_username", lambda: User.get_by_username("audit")),
+        ("User.exist_by_username", lambda: User.exist_by_username("audit")),
+        ("Stock.get_all", lambda: Stock.get_all(user_id=user_id)),
+        ("Stock.get_by_name", lambda: Stock.get_by_name(name=name)),
+        ("Stock.exist_by_name", lambda: Stock.exist_by_name(name=name)),
+        ("Transaction.get_all", lambda: Transaction.get_all(user_id=user_id)),
+        # keyset pages start with an index range, not at the first row of the user
+        ("Transaction.get_page", lambda: Transaction.get_page(user_id=user_id, after=1), "created_on>?"),
+        ("Transaction.get_by_symbol", lambda: Transaction.get_by_symbol(user_id=user_id, symbol=symbol)),
+        ("Transaction.get_page (symbol)", lambda: Transaction.get_page(user_id=user_id, after=1, symbol=symbol), "created_on>?"),
+        ("Holding.get", lambda: Holding.query.get((user_id, 1))),
+        ("Holding.apply_many", lambda: Holding.apply_many(user_id, {1: (1, 1.0), 2: (1, 1.0)})),
+        ("Order.get_all", lambda: Order.get_all(user_id)),
+        ("Order.get_open", lambda: Order.get_open()),
+        ("FxRate.latest", lambda: FxRate.latest(["EUR", "GBP"])),
+        ("FxRate.history", lambda: FxRate.history("GBP")),
+        ("PortfolioRollup.top", lambda: PortfolioRollup.top()),
+        ("SymbolRollup.top", lambda: SymbolRollup.top()),
+        ("DailyVolume.latest", lambda: DailyVolume.latest()),
+    ]
+
+def capture_statements(query):
+    """Run a query and return the SQL statements it sent to the DB"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        query()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+        db.session.rollback()
+    return statements
+
+def explain_queries(queries=None):
+    """
+    Run EXPLAIN QUERY PLAN on each model query (SQLite only).
+
+    Returns a list of dicts with the query name, statement, plan lines, the tables
+    read with a full scan (instead of an index search) and the expected plan fragments
+    missing from the plan.
+    """
+    if db.engine.dialect.name != "sqlite":
+        raise RuntimeError("query plan audit is only available for SQLite")
+
+    tables = set(db.metadata.tables)
+    reports = []
+
+    for name, query, *expected in queries or model_queries():
+        for statement, parameters in capture_statements(query):
+            with db.engine.connect() as conn:
+                plan = [row[-1] for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)]
+            # plan lines look like "SCAN transactions" or "SEARCH stocks USING INDEX ix_stocks_name (name=?)"
+            scans = [line for line in plan if line.startswith("SCAN ") and line.split()[1] in tables \
+                and not _top_k(line, statement, plan)]
+            missing = [fragment for fragment in expected if not any(fragment in line for line in plan)]
+            reports.append({"name": name, "statement": statement, "plan": plan, "scans": scans, "missing": missing})
+
+    return reports
+
+def _top_k(line, statement, plan):
+    """Whether a scan walks an index in the order of the query & stops at its LIMIT (leaderboards)"""
+    return " USING INDEX " in line and " LIMIT " in statement and not any("TEMP B-TREE" in other for other in plan)
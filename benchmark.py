@@ -0,0 +1,221 @@
+"""
+End-to-end benchmark of the trading routes.
+
+Seeds a scratch database with N users x M trades, serves quotes from the local simulator and
+drives the routes through the Flask test client at several concurrency levels. Reports the
+latency percentiles, throughput & SQL statements per request of each route, and compares them
+with a saved baseline.
+
+    python benchmark.py --users 50 --trades 500 --concurrency 1,8 --save baseline.json
+    python benchmark.py --users 50 --trades 500 --concurrency 1,8 --compare baseline.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from datetime import datetime, timedelta
+
+ROUTES = ("index", "api_portfolio", "history", "buy", "sell", "buy_1", "sell_1")
+PASSWORD = "benchmark"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the trading routes")
+    parser.add_argument("--users", type=int, default=20, help="number of seeded users")
+    parser.add_argument("--trades", type=int, default=200, help="number of seeded trades per user")
+    parser.add_argument("--symbols", type=int, default=50, help="number of traded symbols")
+    parser.add_argument("--requests", type=int, default=200, help="number of requests per route & concurrency level")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma separated concurrency levels")
+    parser.add_argument("--routes", default=",".join(ROUTES), help="comma separated routes")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated data")
+    parser.add_argument("--save", metavar="FILE", help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results with a baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="tolerated p95 slowdown (0.2 = 20%%)")
+    return parser.parse_args()
+
+def configure(directory):
+    """Point the application at a scratch database & the offline quote simulator (before importing it)"""
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(directory, "benchmark.db")
+    os.environ["PRICE_STORE_DIR"] = os.path.join(directory, "prices")
+    os.environ["QUOTE_PROVIDER"] = "simulator"
+    os.environ.setdefault("SESSION_FILE_DIR", os.path.join(directory, "sessions"))
+    os.environ.setdefault("QUOTE_SIMULATOR_SEED", "0")
+
+def symbol_names(count):
+    """Symbols AAA, AAB... (known to the simulator)"""
+    letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    return [letters[i // 676 % 26] + letters[i // 26 % 26] + letters[i % 26] for i in range(count)]
+
+def seed(users, trades, symbols, rng):
+    """Insert users, stocks & trades in bulk, then build the holdings"""
+    from werkzeug.security import generate_password_hash
+    from models import db, Holding, Stock, Transaction, User
+
+    # one cheap hash for everybody, hashing is not what is benchmarked
+    hash = generate_password_hash(PASSWORD, method="pbkdf2:sha256:1")
+    db.session.execute(db.insert(User), [{"username": f"user{i}", "hash": hash, "cash": 1e9} for i in range(users)])
+    db.session.execute(db.insert(Stock), [{"stock": symbol, "name": f"{symbol} Inc."} for symbol in symbols])
+    user_ids = [row.id for row in db.session.execute(db.select(User.id).order_by(User.id))]
+    stock_ids = [row.id for row in db.session.execute(db.select(Stock.id).order_by(Stock.id))]
+
+    start = datetime.utcnow() - timedelta(days=730)
+    for user_id in user_ids:
+        held = {}
+        rows = []
+        for i in range(trades):
+            stock_id = rng.choice(stock_ids)
+            price = round(rng.uniform(10, 500), 2)
+            # mostly buys, sells never exceed the holding
+            quantity = rng.randint(1, 100)
+            if held.get(stock_id, 0) > quantity and rng.random() < 0.3:
+                quantity = -quantity
+            held[stock_id] = held.get(stock_id, 0) + quantity
+            rows.append({"user_id": user_id, "stock_id": stock_id, "quantity": quantity, "price": price,
+                "amount": quantity * price, "created_on": start + timedelta(minutes=i * 1051920 // max(trades, 1))})
+        db.session.execute(db.insert(Transaction), rows)
+    db.session.commit()
+    Holding.rebuild()
+    return user_ids
+
+def login(app, user):
+    client = app.test_client()
+    response = client.post("/login", data={"username": f"user{user}", "password": PASSWORD})
+    if response.status_code != 302:
+        raise RuntimeError(f"cannot log in as user{user}")
+    return client
+
+def call(client, route, symbol):
+    """Send one request to a route, return the response"""
+    if route == "index":
+        return client.get("/")
+    if route == "history":
+        return client.get("/history")
+    if route in ("buy", "sell"):
+        return client.post(f"/{route}", data={"symbol": symbol, "shares": "1"})
+    if route == "api_portfolio":
+        return client.get("/api/v1/portfolio")
+    # one share trades from the portfolio page
+    return client.post(f"/{route}", data={"symbol": symbol})
+
+def run(app, route, concurrency, requests, users, symbols, counter):
+    """Drive a route from concurrency threads, return the latencies (seconds) & the statements per request"""
+    clients = [login(app, i % users) for i in range(concurrency)]
+    latencies = []
+    statements = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(index, client):
+        rng = random.Random(index)
+        local_latencies = []
+        local_statements = []
+        for _ in range(requests // concurrency + (index < requests % concurrency)):
+            symbol = rng.choice(symbols)
+            counter.reset()
+            started = time.perf_counter()
+            response = call(client, route, symbol)
+            local_latencies.append(time.perf_counter() - started)
+            local_statements.append(counter.count)
+            if response.status_code >= 400 or (response.is_json and response.json.get("success") is False):
+                errors.append(response.status_code)
+        with lock:
+            latencies.extend(local_latencies)
+            statements.extend(local_statements)
+
+    threads = [threading.Thread(target=worker, args=(i, client)) for i, client in enumerate(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return latencies, statements, elapsed, len(errors)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+class StatementCounter(threading.local):
+    """SQL statements executed by the current thread"""
+    count = 0
+
+    def reset(self):
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+
+def compare(results, baseline, threshold):
+    """Print the routes slower (p95) or issuing more statements than the baseline, return their number"""
+    regressions = 0
+    for route, levels in results.items():
+        for level, result in levels.items():
+            reference = baseline.get(route, {}).get(level)
+            if reference is None:
+                continue
+            if result["p95_ms"] > reference["p95_ms"] * (1 + threshold):
+                regressions += 1
+                print(f"REGRESSION {route} x{level}: p95 {reference['p95_ms']:.2f}ms -> {result['p95_ms']:.2f}ms")
+            if result["queries"] > reference["queries"]:
+                regressions += 1
+                print(f"REGRESSION {route} x{level}: queries/request {reference['queries']:.1f} -> {result['queries']:.1f}")
+    if not regressions:
+        print("no regression against the baseline")
+    return regressions
+
+def main():
+    args = parse_args()
+    directory = tempfile.mkdtemp(prefix="finance-benchmark-")
+    configure(directory)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    from sqlalchemy import event
+    import application
+    from models import db
+
+    app = application.app
+    app.logger.setLevel("WARNING")
+    symbols = symbol_names(args.symbols)
+    started = time.perf_counter()
+    seed(args.users, args.trades, symbols, random.Random(args.seed))
+    print(f"seeded {args.users} users x {args.trades} trades in {time.perf_counter() - started:.1f}s ({directory})")
+
+    counter = StatementCounter()
+    event.listen(db.engine, "before_cursor_execute", counter)
+
+    results = {}
+    print(f"{'route':<14}{'threads':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}{'queries':>9}{'errors':>8}")
+    for route in args.routes.split(","):
+        if route not in ROUTES:
+            raise SystemExit(f"unknown route: {route}")
+        for concurrency in (int(level) for level in args.concurrency.split(",")):
+            latencies, statements, elapsed, errors = run(app, route, concurrency, args.requests, args.users, symbols, counter)
+            result = {
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+                "throughput": len(latencies) / elapsed,
+                "queries": sum(statements) / len(statements),
+                "errors": errors
+            }
+            results.setdefault(route, {})[str(concurrency)] = result
+            print(f"{route:<14}{concurrency:>8}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+                f"{result['throughput']:>10.1f}{result['queries']:>9.1f}{errors:>8}")
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({"settings": {"users": args.users, "trades": args.trades, "symbols": args.symbols,
+                "requests": args.requests}, "results": results}, file, indent=2)
+        print(f"baseline saved to {args.save}")
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if compare(results, baseline["results"], args.threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import click
+import csv
+
+from datetime import datetime, timedelta, timezone
+from flask.cli import AppGroup
+# local packages
+import ledger_io
+from audit import explain_queries
+from helpers import quote_provider
+from models import Holding, IdempotencyKey, User
+from pricestore import FREQUENCIES, price_store
+from reporting import reports
+from symbols import symbol_master
+
+# flask holdings ...
+holdings_cli = AppGroup("holdings", help="Maintain the materialized holdings table.")
+
+@holdings_cli.command("rebuild")
+def holdings_rebuild():
+    """Recompute the holdings from the transactions ledger."""
+    count = Holding.rebuild()
+    click.echo(f"{count} holdings rebuilt")
+
+@holdings_cli.command("verify")
+def holdings_verify():
+    """Check the holdings against the transactions ledger."""
+    mismatches = Holding.verify()
+    for mismatch in mismatches:
+        click.echo(f"user {mismatch['user_id']} stock {mismatch['stock_id']}: "
+            f"expected {mismatch['expected']}, found {mismatch['actual']}")
+    if mismatches:
+        raise click.ClickException(f"{len(mismatches)} holdings out of sync, run 'flask holdings rebuild'")
+    click.echo("holdings are in sync")
+
+# flask trades ...
+trades_cli = AppGroup("trades", help="Maintain the order execution tables.")
+
+@trades_cli.command("purge-keys")
+@click.option("--days", type=int, default=1, show_default=True, help="Keep the keys of the last days.")
+def trades_purge_keys(days):
+    """Delete the old idempotency keys (retries come within seconds)."""
+    count = IdempotencyKey.purge(datetime.utcnow() - timedelta(days=days))
+    click.echo(f"{count} idempotency keys deleted")
+
+# flask symbols ...
+symbols_cli = AppGroup("symbols", help="Maintain the symbol master data.")
+
+@symbols_cli.command("load")
+def symbols_load():
+    """Load the reference list of symbols from the quote provider."""
+    count = symbol_master.refresh(quote_provider)
+    click.echo(f"{count} reference symbols loaded")
+
+# flask reports ...
+reports_cli = AppGroup("reports", help="Maintain the reporting rollups.")
+
+@reports_cli.command("refresh")
+def reports_refresh():
+    """Aggregate the new transactions & revalue the portfolios at the latest prices."""
+    stats = reports.refresh()
+    click.echo(f"{stats['transactions']} new transactions, {stats['symbols']} stocks priced, {stats['portfolios']} portfolios valued")
+
+# flask audit ...
+audit_cli = AppGroup("audit", help="Check the DB access paths.")
+
+@audit_cli.command("plans")
+@click.option("--verbose", is_flag=True, help="Print the plan of every query.")
+def audit_plans(verbose):
+    """Run EXPLAIN QUERY PLAN on the model queries, fail on full table scans or missing index ranges."""
+    reports = explain_queries()
+    failures = [report for report in reports if report["scans"] or report["missing"]]
+    for report in reports:
+        if verbose or report in failures:
+            status = "SCAN" if report["scans"] else f"MISSING {', '.join(report['missing'])}" if report["missing"] else "ok"
+            click.echo(f"{report['name']}: {status}")
+            for line in report["plan"]:
+                click.echo(f"    {line}")
+    if failures:
+        raise click.ClickException(f"{len(failures)} queries fall back to a table scan or miss their index range")
+    click.echo(f"{len(reports)} queries use indexes")
+
+# flask ledger ...
+ledger_cli = AppGroup("ledger", help="Bulk export/import of the transactions ledger.")
+
+@ledger_cli.command("export")
+@click.argument("output", type=click.Path(dir_okay=False, writable=True))
+@click.option("--data", type=click.Choice(["transactions", "holdings"]), default="transactions")
+@click.option("--format", type=click.Choice(list(ledger_io.FORMATS)), default="csv")
+@click.option("--username", help="Export a single user (all the users by default).")
+def ledger_export(output, data, format, username):
+    """Export the transactions or holdings to OUTPUT."""
+    user_id = None
+    if username is not None:
+        user_db = User.get_by_username(username=username.lower())
+        if user_db is None:
+            raise click.ClickException(f"unknown user {username}")
+        user_id = user_db.id
+    with open(output, "w" if format == "csv" else "wb") as file:
+        for chunk in ledger_io.export_chunks(data, format, user_id=user_id):
+            file.write(chunk)
+    click.echo(f"{data} exported to {output}")
+
+@ledger_cli.command("import")
+@click.argument("input", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", type=click.Choice(list(ledger_io.FORMATS)), default="csv")
+@click.option("--batch-size", type=int, default=ledger_io.CHUNK_SIZE, show_default=True)
+def ledger_import(input, format, batch_size):
+    """Import the transactions of INPUT (cash & holdings are updated accordingly)."""
+    try:
+        stats = ledger_io.import_transactions(input, format=format, batch_size=batch_size)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"{stats['rows']} transactions imported for {stats['users']} users in {stats['seconds']}s ({stats['batches']} batches)")
+
+# flask prices ...
+prices_cli = AppGroup("prices", help="Maintain the historical price store.")
+
+@prices_cli.command("fetch")
+@click.argument("symbols", nargs=-1, required=True)
+@click.option("--range", "range_", default="1y", show_default=True, help="Provider range (1d for minute bars).")
+def prices_fetch(symbols, range_):
+    """Fetch historical bars for SYMBOLS from the quote provider."""
+    frequency = "intraday" if range_ == "1d" else "daily"
+    for symbol in symbols:
+        try:
+            count = price_store.append(symbol, quote_provider.chart(symbol, range_), frequency)
+        except Exception as e:
+            raise click.ClickException(f"{symbol}: {e}")
+        click.echo(f"{symbol}: {count} {frequency} bars appended")
+
+@prices_cli.command("ingest")
+@click.argument("symbol")
+@click.argument("input", type=click.Path(exists=True, dir_okay=False))
+@click.option("--frequency", type=click.Choice(FREQUENCIES), default="daily", show_default=True)
+def prices_ingest(symbol, input, frequency):
+    """Append the bars of a csv file (time/date, open, high, low, close, volume) to SYMBOL."""
+    with open(input, newline="") as file:
+        rows = [dict(row, time=row.get("time") or row.get("date")) for row in csv.DictReader(file)]
+    rows = [{name: value if name == "time" else float(value or 0) for name, value in row.items()} for row in rows]
+    click.echo(f"{symbol}: {price_store.append(symbol, rows, frequency)} {frequency} bars appended")
+
+@prices_cli.command("show")
+@click.argument("symbol")
+@click.option("--start", help="First date (included).")
+@click.option("--end", help="Last date (excluded).")
+@click.option("--frequency", type=click.Choice(FREQUENCIES), default="daily", show_default=True)
+def prices_show(symbol, start, end, frequency):
+    """Print the stored bars of SYMBOL."""
+    for bar in price_store.range(symbol, start, end, frequency):
+        click.echo(f"{datetime.fromtimestamp(int(bar['time']), timezone.utc):%Y-%m-%d %H:%M} "
+            f"{bar['open']:.2f} {bar['high']:.2f} {bar['low']:.2f} {bar['close']:.2f} {bar['volume']}")
+
+def init_app(app):
+    """Register the command line interface of the application"""
+    app.cli.add_command(holdings_cli)
+    app.cli.add_command(trades_cli)
+    app.cli.add_command(symbols_cli)
+    app.cli.add_command(reports_cli)
+    app.cli.add_command(audit_cli)
+    app.cli.add_command(ledger_cli)
+    app.cli.add_command(prices_cli)
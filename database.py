@@ -0,0 +1,54 @@
+import sqlite3
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+
+# pragmas applied to every new SQLite connection
+SQLITE_PRAGMAS = {
+    # readers don't block the writer (and the other way around)
+    "journal_mode": "WAL",
+    # durable at checkpoints, safe from corruption in WAL mode
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+}
+# pragmas of the configured application (with the timeout & sizes)
+_pragmas = dict(SQLITE_PRAGMAS)
+
+def init_app(app):
+    """
+    Configure the engine for the database (SQLALCHEMY_DATABASE_URI) before db.init_app().
+
+    SQLite: WAL journal, busy timeout (DB_BUSY_TIMEOUT) & pragmas (DB_CACHE_SIZE, DB_MMAP_SIZE)
+    on every connection, so that trades & portfolio reads from several workers wait for the
+    lock instead of failing. Other databases (Postgres): pool of DB_POOL_SIZE connections plus
+    DB_MAX_OVERFLOW, checked before use (pre-ping) & recycled every DB_POOL_RECYCLE seconds.
+    """
+    url = app.config["SQLALCHEMY_DATABASE_URI"]
+    # postgres:// urls (Heroku style) are not recognized by SQLAlchemy
+    if url.startswith("postgres://"):
+        url = app.config["SQLALCHEMY_DATABASE_URI"] = "postgresql://" + url[len("postgres://"):]
+
+    options = app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {})
+    if make_url(url).get_backend_name() == "sqlite":
+        pragmas = dict(busy_timeout=int(app.config.get("DB_BUSY_TIMEOUT", 5) * 1000),
+            cache_size=-int(app.config.get("DB_CACHE_SIZE", 64 * 1024)), mmap_size=int(app.config.get("DB_MMAP_SIZE", 256 * 1024 ** 2)))
+        # the driver waits for locks too (seconds)
+        options.setdefault("connect_args", {}).setdefault("timeout", app.config.get("DB_BUSY_TIMEOUT", 5))
+        _pragmas.update(pragmas)
+        if not event.contains(Engine, "connect", _set_sqlite_pragmas):
+            event.listen(Engine, "connect", _set_sqlite_pragmas)
+    else:
+        options.setdefault("pool_size", app.config.get("DB_POOL_SIZE", 10))
+        options.setdefault("max_overflow", app.config.get("DB_MAX_OVERFLOW", 20))
+        options.setdefault("pool_timeout", app.config.get("DB_POOL_TIMEOUT", 30))
+        options.setdefault("pool_recycle", app.config.get("DB_POOL_RECYCLE", 1800))
+        options.setdefault("pool_pre_ping", True)
+    app.logger.debug(f"Database engine options: {options}")
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in _pragmas.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
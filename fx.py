@@ -0,0 +1,193 @@
+import math
+import random
+import threading
+import time
+
+import numpy as np
+
+from datetime import date
+# local packages
+from models import FxRate
+
+# currencies offered as base currency of the views
+CURRENCIES = ("USD", "EUR", "GBP", "JPY", "CHF", "CAD")
+# USD per unit of currency, starting points of the simulator
+SIMULATOR_RATES = {"EUR": 1.08, "GBP": 1.27, "JPY": 0.0067, "CHF": 1.12, "CAD": 0.73}
+
+class RateUnavailable(Exception):
+    """Raised when no exchange rate is known for a currency"""
+
+class IEXRates:
+    """Latest exchange rates from the IEX cloud API (through the quote provider's client)"""
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def fetch(self, currencies):
+        """USD per unit of each currency ({currency: rate}), unknown currencies are left out"""
+        rows = self.provider.get("fx/latest", symbols=",".join(f"{currency}USD" for currency in sorted(currencies)))
+        return {row["symbol"][:3]: float(row["rate"]) for row in rows if row.get("rate")}
+
+class SimulatedRates:
+    """Exchange rates moving by a small log-normal step on each fetch (offline runs)"""
+
+    def __init__(self, seed=0, volatility=0.002):
+        self.seed = seed
+        self.volatility = volatility
+        self._rates = {}
+        self._lock = threading.Lock()
+
+    def fetch(self, currencies):
+        rates = {}
+        with self._lock:
+            for currency in currencies:
+                if currency not in SIMULATOR_RATES:
+                    continue
+                walk = self._rates.get(currency)
+                if walk is None:
+                    walk = self._rates[currency] = [random.Random(f"{self.seed}:fx:{currency}"), SIMULATOR_RATES[currency]]
+                else:
+                    walk[1] *= math.exp(walk[0].gauss(0, self.volatility))
+                rates[currency] = walk[1]
+        return rates
+
+class FXRates:
+    """
+    Exchange rates with a local cache & history.
+
+    Rates (USD per unit of currency) are cached for FX_CACHE_TTL seconds, the missing ones fetched
+    in one call. The first rate of each day is stored in the fx_rates table, which also serves
+    the last known rates while the source is unavailable. Conversions of many amounts look the
+    rates up once per currency & multiply arrays (NumPy).
+    """
+
+    def __init__(self, ttl=300, source=None):
+        self.ttl = ttl
+        self.source = source
+        self._rates = {}
+        self._recorded = set()
+        self._lock = threading.Lock()
+
+    def init_app(self, app, quote_provider):
+        """Select the source of the rates (FX_PROVIDER: iex or simulator) & read the cache TTL."""
+        self.ttl = app.config.get("FX_CACHE_TTL", self.ttl)
+        name = app.config.get("FX_PROVIDER", "iex")
+        if name == "iex":
+            self.source = IEXRates(quote_provider)
+        elif name == "simulator":
+            self.source = SimulatedRates(app.config.get("QUOTE_SIMULATOR_SEED", 0))
+        else:
+            raise RuntimeError(f"unknown FX provider: {name} (expected iex or simulator)")
+        self._rates = {}
+        app.logger.debug(f"Exchange rates from {name}")
+
+    def rates(self, currencies):
+        """USD per unit of each currency ({currency: rate}), currencies without any known rate left out"""
+        currencies = set(currencies)
+        rates = {"USD": 1.0}
+        now = time.monotonic()
+        with self._lock:
+            for currency in currencies - {"USD"}:
+                cached = self._rates.get(currency)
+                if cached is not None and now - cached[0] < self.ttl:
+                    rates[currency] = cached[1]
+        missing = currencies - rates.keys()
+        if missing:
+            rates.update(self._fetch(missing))
+        return rates
+
+    def rate(self, source, target="USD"):
+        """Units of target per unit of source"""
+        if source == target:
+            return 1.0
+        rates = self.rates((source, target))
+        if source not in rates or target not in rates:
+            raise RateUnavailable(f"no exchange rate for {source if source not in rates else target}")
+        return rates[source] / rates[target]
+
+    def convert(self, amounts, currencies, target):
+        """Convert amounts (array-like) in currencies (one per amount) to target, NaN without a rate"""
+        amounts = np.asarray(amounts, dtype=float)
+        if not len(amounts):
+            return amounts
+        codes, index = np.unique(np.asarray(currencies, dtype=object).astype(str), return_inverse=True)
+        rates = self.rates(set(codes) | {target})
+        if target not in rates:
+            return np.full(len(amounts), np.nan)
+        factors = np.array([rates.get(code, np.nan) for code in codes]) / rates[target]
+        return amounts * factors[index]
+
+    def convert_on(self, amounts, currencies, days, target="USD"):
+        """
+        Convert amounts (array-like) in currencies to target at the rates of their days (trade dates)
+
+        The rate of a day is the one recorded that day, or the last one recorded before it (the
+        first one for older days, today's rate for a currency without history). NaN without a rate.
+        """
+        amounts = np.asarray(amounts, dtype=float)
+        if not len(amounts):
+            return amounts
+        currencies = np.asarray(currencies, dtype=object).astype(str)
+        days = np.asarray(days, dtype="datetime64[D]")
+        return amounts * self._rates_on(currencies, days) / self._rates_on(np.full(len(amounts), target), days)
+
+    def _rates_on(self, currencies, days):
+        """USD per unit of each currency on each day, one history query per currency"""
+        codes, index = np.unique(currencies, return_inverse=True)
+        # today's rates first (recorded in the history if new)
+        current = self.rates(set(codes))
+        rates = np.full(len(currencies), np.nan)
+        for position, code in enumerate(codes):
+            selected = index == position
+            if code == "USD":
+                rates[selected] = 1.0
+                continue
+            history = FxRate.history(code)
+            if not history:
+                rates[selected] = current.get(code, np.nan)
+                continue
+            recorded = np.array([row.day for row in history], dtype="datetime64[D]")
+            values = np.array([row.rate for row in history])
+            rates[selected] = values[np.maximum(np.searchsorted(recorded, days[selected], side="right") - 1, 0)]
+        return rates
+
+    def convert_rows(self, rows, target, batch=500):
+        """Rows (amount, currency & created_on attributes) as dicts with their value in target at the trade date, converted batch by batch"""
+        chunk = []
+        for row in rows:
+            chunk.append(row._asdict() if hasattr(row, "_asdict") else dict(row))
+            if len(chunk) >= batch:
+                yield from self._convert_chunk(chunk, target)
+                chunk = []
+        if chunk:
+            yield from self._convert_chunk(chunk, target)
+
+    def _convert_chunk(self, chunk, target):
+        values = self.convert_on([row["amount"] for row in chunk], [row["currency"] or "USD" for row in chunk], \
+            [row["created_on"] or date.today() for row in chunk], target)
+        for row, value in zip(chunk, values):
+            row["value"] = float(value)
+            yield row
+
+    def _fetch(self, currencies):
+        try:
+            rates = self.source.fetch(currencies)
+        except Exception:
+            # source unavailable: last recorded rates
+            return FxRate.latest(currencies)
+        now = time.monotonic()
+        with self._lock:
+            for currency, rate in rates.items():
+                self._rates[currency] = (now, rate)
+        self._record(rates)
+        return rates
+
+    def _record(self, rates):
+        today = date.today()
+        new = {currency: rate for currency, rate in rates.items() if (today, currency) not in self._recorded}
+        if new:
+            FxRate.record(today, new)
+            self._recorded.update((today, currency) for currency in new)
+
+# process-wide exchange rates, configured by the application
+fx_rates = FXRates()
@@ -1,9 +1,15 @@
-import os
-import requests
-import urllib.parse
+import threading
+import time
 
-from flask import redirect, render_template, request, session
+from collections import OrderedDict
+from datetime import datetime
+from flask import current_app, redirect, render_template, request, session
 from functools import wraps
+# local packages
+from async_quotes import AsyncQuoteBridge
+from instrumentation import instrumentation
+from models import User
+from providers import ConfiguredProvider
 
 def apology(message, code=400):
     """Render message as an apology to user."""
@@ -32,32 +38,176 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-def lookup(symbol):
-    """Look up quote for symbol."""
+def admin_required(f):
+    """
+    Decorate routes to require a user listed in ADMIN_USERS.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if session.get("user_id") is None:
+            return redirect("/login")
+        user_db = User.get_by_id(session["user_id"])
+        if user_db is None or user_db.username not in current_app.config.get("ADMIN_USERS", ()):
+            return apology("admin only", 403)
+        return f(*args, **kwargs)
+    return decorated_function
 
-    # contact API
-    try:
-        api_key = os.environ.get("API_KEY")
-        response = requests.get(f"https://cloud-sse.iexapis.com/stable/stock/{urllib.parse.quote_plus(symbol)}/quote?token={api_key}")
-        response.raise_for_status()
-    except requests.RequestException as e:
+class QuoteCache:
+    """
+    Process-wide TTL cache for quotes, bounded in size (least recently used quotes are evicted).
+
+    With stale-while-revalidate enabled, an expired quote younger than max_stale seconds
+    is returned right away and refreshed in a background thread (display paths only, the
+    trade paths ask for fresh quotes).
+    """
+
+    def __init__(self, ttl=60, maxsize=1024, stale_while_revalidate=False, max_stale=300):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.stale_while_revalidate = stale_while_revalidate
+        self.max_stale = max_stale
+        self._quotes = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stale": 0, "refreshes": 0, "evictions": 0}
+
+    def init_app(self, app):
+        """Read the cache settings from the application configuration."""
+        self.ttl = app.config.get("QUOTE_CACHE_TTL", self.ttl)
+        self.maxsize = app.config.get("QUOTE_CACHE_SIZE", self.maxsize)
+        self.stale_while_revalidate = app.config.get("QUOTE_CACHE_STALE_WHILE_REVALIDATE", self.stale_while_revalidate)
+        self.max_stale = app.config.get("QUOTE_CACHE_MAX_STALE", self.max_stale)
+
+    def get_many(self, symbols, fetch, fresh=False):
+        """Return the quotes for symbols, calling fetch(symbols) for the ones missing from the cache (or expired if fresh)."""
+        quotes, missing = self.get_cached(symbols, fetch, fresh)
+
+        if missing:
+            fetched = fetch(missing)
+            self.put_many(fetched)
+            quotes.update(fetched)
+
+        return quotes
+
+    def get_cached(self, symbols, fetch, fresh=False):
+        """Return the cached quotes for symbols and the missing symbols (stale quotes are refreshed with fetch, or missing if fresh)."""
+        quotes = {}
+        missing = []
+        stale = []
+        now = time.monotonic()
+
+        with self._lock:
+            for symbol in symbols:
+                entry = self._quotes.get(symbol)
+                age = now - entry[0] if entry is not None else None
+                if age is not None and age < self.ttl:
+                    self._quotes.move_to_end(symbol)
+                    self._stats["hits"] += 1
+                    quotes[symbol] = entry[1]
+                elif age is not None and self.stale_while_revalidate and not fresh and age < self.ttl + self.max_stale:
+                    self._quotes.move_to_end(symbol)
+                    self._stats["stale"] += 1
+                    quotes[symbol] = entry[1]
+                    # refresh each stale quote only once at a time
+                    if symbol not in self._refreshing:
+                        self._refreshing.add(symbol)
+                        stale.append(symbol)
+                else:
+                    self._stats["misses"] += 1
+                    missing.append(symbol)
+
+        if stale:
+            threading.Thread(target=self._refresh, args=(stale, fetch), daemon=True).start()
+
+        return quotes, missing
+
+    def put_many(self, quotes):
+        """Store freshly fetched quotes."""
+        if self.ttl <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for symbol, quote in quotes.items():
+                self._quotes[symbol] = (now, quote)
+                self._quotes.move_to_end(symbol)
+            while len(self._quotes) > self.maxsize:
+                self._quotes.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def clear(self):
+        """Drop every cached quote."""
+        with self._lock:
+            self._quotes.clear()
+
+    def stats(self):
+        """Return the cache counters."""
+        with self._lock:
+            return dict(self._stats, size=len(self._quotes))
+
+    def _refresh(self, symbols, fetch):
+        """Refresh stale quotes (run in a background thread)."""
+        try:
+            self.put_many(fetch(symbols))
+        finally:
+            with self._lock:
+                self._stats["refreshes"] += 1
+                self._refreshing.difference_update(symbols)
+
+# process-wide quote cache & quote provider (optionally behind the async layer), configured by the application
+quote_cache = QuoteCache()
+quote_provider = ConfiguredProvider()
+quote_bridge = AsyncQuoteBridge()
+
+def fetch_quotes(symbols):
+    """Fetch quotes from the provider, through the async layer (coalesced) when enabled."""
+    with instrumentation.timed("upstream"):
+        if quote_bridge.enabled:
+            return quote_bridge.fetch(symbols)
+        return quote_provider.fetch(symbols)
+
+def lookup(symbol, fresh=False):
+    """Look up quote for symbol."""
+    if not symbol:
         return None
+    return lookup_many([symbol], fresh).get(symbol.upper())
+
+def lookup_many(symbols, fresh=False):
+    """
+    Look up quotes for several symbols at once.
 
-    # parse response
+    Quotes are served from the process-wide quote cache when possible, the other
+    symbols are fetched in one go from the quote provider. With fresh set (prices of
+    trades), expired quotes are fetched again instead of served stale.
+    Returns a dict keyed by upper-case symbol, unknown symbols are left out.
+    """
+    # deduplicate while keeping the caller's order
+    symbols = list(dict.fromkeys(symbol.upper() for symbol in symbols if symbol))
+    with instrumentation.timed("lookup"):
+        return quote_cache.get_many(symbols, fetch_quotes, fresh)
+
+def parse_date(value):
+    """Parse a YYYY-MM-DD date, None if it is invalid."""
     try:
-        quote = response.json()
-        return {
-            "name": quote["companyName"],
-            "price": float(quote["latestPrice"]),
-            "symbol": quote["symbol"]
-        }
-    except (KeyError, TypeError, ValueError):
+        return datetime.strptime(value, "%Y-%m-%d")
+    except (TypeError, ValueError):
         return None
 
 def usd(value):
     """Format value as USD."""
     return f"${value:,.2f}"
 
+# symbols & decimals of the displayed currencies (ISO code otherwise)
+CURRENCY_FORMATS = {"USD": ("$", 2), "EUR": ("€", 2), "GBP": ("£", 2), "JPY": ("¥", 0), "CHF": ("CHF ", 2), "CAD": ("CA$", 2)}
+
+def money(value, currency="USD"):
+    """Format value in a currency."""
+    if value is None or value != value:
+        return "n/a"
+    symbol, decimals = CURRENCY_FORMATS.get(currency, (f"{currency} ", 2))
+    return f"{'-' if value < 0 else ''}{symbol}{abs(value):,.{decimals}f}"
+
 def percentage(value):
     """Format value as percentage."""
+    if value is None:
+        return "n/a"
     return f"{value:+.2%}"
\ No newline at end of file
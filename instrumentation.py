@@ -0,0 +1,171 @@
+import threading
+import time
+
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# request duration histogram buckets (seconds)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# timed operations besides the SQL statements
+KINDS = ("lookup", "upstream")
+
+class RequestStats:
+    """Breakdown of one request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = Counter()
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.calls = Counter()
+        self.seconds = defaultdict(float)
+
+class Instrumentation:
+    """
+    Per-request instrumentation.
+
+    Times every route, counts & times the SQL statements (engine events) and the timed operations
+    (quote lookups & upstream calls), and flags the requests repeating a statement n_plus_one
+    times or more (N+1 pattern). Totals are exported in the Prometheus text format, the breakdown
+    of each request can be sent back in a Server-Timing header.
+    """
+
+    def __init__(self, n_plus_one=5, header=False):
+        self.n_plus_one = n_plus_one
+        self.header = header
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._requests = defaultdict(lambda: [0] * (len(BUCKETS) + 1))
+        self._durations = defaultdict(float)
+        self._totals = defaultdict(lambda: defaultdict(float))
+        self._flagged = Counter()
+        self._collectors = []
+        self._logger = None
+
+    def init_app(self, app):
+        """Read the settings from the application configuration & hook the request events."""
+        self.n_plus_one = app.config.get("INSTRUMENTATION_N_PLUS_ONE", self.n_plus_one)
+        self.header = app.config.get("INSTRUMENTATION_HEADER", self.header)
+        self._logger = app.logger
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        # every engine (application & commands)
+        if not event.contains(Engine, "before_cursor_execute", self._before_cursor_execute):
+            event.listen(Engine, "before_cursor_execute", self._before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", self._after_cursor_execute)
+
+    def register(self, name, kind, help, collect):
+        """Export another metric, collect() returns a value or a {label value: value} dict"""
+        self._collectors.append((name, kind, help, collect))
+
+    @contextmanager
+    def timed(self, kind):
+        """Count & time an operation in the current request"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats = getattr(self._local, "stats", None)
+            if stats is not None:
+                stats.calls[kind] += 1
+                stats.seconds[kind] += time.perf_counter() - started
+
+    def render(self):
+        """Metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            lines += _header("finance_request_duration_seconds", "histogram", "Duration of the requests per route")
+            for route, buckets in sorted(self._requests.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), buckets):
+                    cumulative += count
+                    lines.append(f'finance_request_duration_seconds_bucket{{route="{route}",le="{bound}"}} {cumulative}')
+                lines.append(f'finance_request_duration_seconds_sum{{route="{route}"}} {self._durations[route]}')
+                lines.append(f'finance_request_duration_seconds_count{{route="{route}"}} {cumulative}')
+
+            for name, help in (("sql_statements", "SQL statements executed"), ("sql_seconds", "Time spent in SQL statements")) \
+                    + tuple((f"{kind}_calls", f"Number of {kind} calls") for kind in KINDS) \
+                    + tuple((f"{kind}_seconds", f"Time spent in {kind} calls") for kind in KINDS):
+                lines += _header(f"finance_{name}_total", "counter", f"{help} per route")
+                for route, totals in sorted(self._totals.items()):
+                    lines.append(f'finance_{name}_total{{route="{route}"}} {totals[name]}')
+
+            lines += _header("finance_n_plus_one_total", "counter", "Requests repeating a SQL statement (N+1) per route")
+            for route, count in sorted(self._flagged.items()):
+                lines.append(f'finance_n_plus_one_total{{route="{route}"}} {count}')
+
+        for name, kind, help, collect in self._collectors:
+            lines += _header(name, kind, help)
+            value = collect()
+            if isinstance(value, dict):
+                label, values = next(iter(value.items()))
+                for label_value, sample in values.items():
+                    lines.append(f'{name}{{{label}="{label_value}"}} {sample}')
+            else:
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _before_request(self):
+        self._local.stats = g.request_stats = RequestStats()
+
+    def _after_request(self, response):
+        stats = getattr(self._local, "stats", None)
+        if stats is None:
+            return response
+        duration = time.perf_counter() - stats.started
+        route = request.endpoint or "unknown"
+        repeated = [(statement, count) for statement, count in stats.statements.items() if count >= self.n_plus_one]
+
+        with self._lock:
+            self._requests[route][_bucket(duration)] += 1
+            self._durations[route] += duration
+            totals = self._totals[route]
+            totals["sql_statements"] += stats.sql_count
+            totals["sql_seconds"] += stats.sql_seconds
+            for kind in KINDS:
+                totals[f"{kind}_calls"] += stats.calls[kind]
+                totals[f"{kind}_seconds"] += stats.seconds[kind]
+            if repeated:
+                self._flagged[route] += 1
+
+        for statement, count in repeated:
+            self._logger.warning(f"N+1 in {route}: {count} x {' '.join(statement.split())[:200]}")
+
+        if self.header:
+            timings = [f"app;dur={duration * 1000:.1f}",
+                f'sql;dur={stats.sql_seconds * 1000:.1f};desc="{stats.sql_count} statements"']
+            timings += [f'{kind};dur={stats.seconds[kind] * 1000:.1f};desc="{stats.calls[kind]} calls"' for kind in KINDS]
+            response.headers["Server-Timing"] = ", ".join(timings)
+        return response
+
+    def _teardown_request(self, exception=None):
+        self._local.stats = None
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        stats = getattr(self._local, "stats", None)
+        if stats is not None:
+            stats.statements[statement] += 1
+            stats.sql_count += 1
+            conn.info.setdefault("instrumentation_started", []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        stats = getattr(self._local, "stats", None)
+        started = conn.info.get("instrumentation_started")
+        if stats is not None and started:
+            stats.sql_seconds += time.perf_counter() - started.pop()
+
+def _bucket(duration):
+    for index, bound in enumerate(BUCKETS):
+        if duration <= bound:
+            return index
+    return len(BUCKETS)
+
+def _header(name, kind, help):
+    return [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+
+# process-wide instrumentation, configured by the application
+instrumentation = Instrumentation()
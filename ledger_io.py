@@ -0,0 +1,296 @@
+import csv
+import io
+import itertools
+import time
+
+import numpy as np
+
+from collections import defaultdict
+from datetime import datetime, timezone
+from sqlalchemy import and_, bindparam, insert, select
+# local packages
+from fx import fx_rates
+from models import db, Holding, Stock, Transaction, User
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # parquet support is optional
+    pyarrow = None
+
+# rows per chunk (export) or per batch (import)
+CHUNK_SIZE = 10000
+
+# exported columns (name, parquet type)
+TRANSACTION_COLUMNS = [("id", "int64"), ("user_id", "int64"), ("username", "string"), ("symbol", "string"), ("name", "string"),
+    ("quantity", "int64"), ("price", "float64"), ("amount", "float64"), ("currency", "string"), ("created_on", "timestamp[us]")]
+HOLDING_COLUMNS = [("user_id", "int64"), ("username", "string"), ("symbol", "string"), ("name", "string"),
+    ("quantity", "int64"), ("amount", "float64")]
+
+FORMATS = {
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet"
+}
+
+def iter_transactions(user_id=None, chunk_size=CHUNK_SIZE):
+    """Transactions of a user (or of all the users) as chunks of rows, cash movements included"""
+    query = select(Transaction.id, Transaction.user_id, User.username, Stock.stock, Stock.name, Transaction.quantity, \
+        Transaction.price, Transaction.amount, Transaction.currency, Transaction.created_on) \
+        .join(User, User.id == Transaction.user_id) \
+        .outerjoin(Stock, Stock.id == Transaction.stock_id) \
+        .order_by(Transaction.id)
+    if user_id is not None:
+        query = query.where(Transaction.user_id == user_id)
+    return _iter_chunks(query, chunk_size)
+
+def iter_holdings(user_id=None, chunk_size=CHUNK_SIZE):
+    """Holdings of a user (or of all the users) as chunks of rows"""
+    query = select(Holding.user_id, User.username, Stock.stock, Stock.name, Holding.quantity, Holding.amount) \
+        .join(User, User.id == Holding.user_id) \
+        .join(Stock, Stock.id == Holding.stock_id) \
+        .where(Holding.quantity != 0) \
+        .order_by(Holding.user_id, Stock.stock)
+    if user_id is not None:
+        query = query.where(Holding.user_id == user_id)
+    return _iter_chunks(query, chunk_size)
+
+def export_chunks(data, format, user_id=None, chunk_size=CHUNK_SIZE):
+    """Serialize the transactions or holdings chunk by chunk (str for csv, bytes for parquet)"""
+    if data == "transactions":
+        chunks, columns = iter_transactions(user_id, chunk_size), TRANSACTION_COLUMNS
+    elif data == "holdings":
+        chunks, columns = iter_holdings(user_id, chunk_size), HOLDING_COLUMNS
+    else:
+        raise ValueError(f"unknown data: {data}")
+
+    if format == "csv":
+        return _write_csv(chunks, columns)
+    elif format == "parquet":
+        return _write_parquet(chunks, columns)
+    else:
+        raise ValueError(f"unknown format: {format}")
+
+def import_transactions(path, format="csv", batch_size=CHUNK_SIZE):
+    """
+    Bulk import transactions from a csv or parquet file.
+
+    Rows need a username (or user_id), and either a symbol, quantity & price (trade)
+    or only an amount (cash movement). Each batch is inserted with executemany and
+    committed together with the matching cash & holdings updates (cash in USD, at the
+    rates of the transaction dates).
+    """
+    started = time.perf_counter()
+    stocks = {stock: id for id, stock in db.session.execute(select(Stock.id, Stock.stock))}
+    stats = {"rows": 0, "batches": 0, "users": set()}
+
+    for batch in _read_batches(path, format, batch_size):
+        rows = [_normalize(row) for row in batch]
+        users = _resolve_users(rows)
+        _resolve_stocks(rows, stocks)
+        # amounts in USD (the cash currency), one vectorized conversion per batch
+        usd_amounts = fx_rates.convert_on([row["amount"] for row in rows], [row["currency"] for row in rows], \
+            [row["created_on"] for row in rows])
+        if np.isnan(usd_amounts).any():
+            unknown = sorted({row["currency"] for row, usd_amount in zip(rows, usd_amounts) if np.isnan(usd_amount)})
+            raise ValueError(f"no exchange rate for {', '.join(unknown)}")
+
+        transactions = []
+        cash = defaultdict(float)
+        holdings = defaultdict(lambda: [0, 0.0])
+
+        for row, usd_amount in zip(rows, usd_amounts):
+            user_id = users[row["user"]]
+            stock_id = stocks[row["symbol"]] if row["symbol"] else None
+            transactions.append({"user_id": user_id, "stock_id": stock_id, "quantity": row["quantity"], "price": row["price"],
+                "amount": row["amount"], "currency": row["currency"], "created_on": row["created_on"], "visible": stock_id is not None})
+            if stock_id is None:
+                # cash movement
+                cash[user_id] += float(usd_amount)
+            else:
+                cash[user_id] -= float(usd_amount)
+                holdings[(user_id, stock_id)][0] += row["quantity"]
+                holdings[(user_id, stock_id)][1] += row["amount"]
+
+        db.session.execute(insert(Transaction.__table__), transactions)
+        _update_cash(cash)
+        _update_holdings(holdings)
+        # commit the batch (ledger, cash & holdings stay consistent)
+        db.session.commit()
+
+        stats["rows"] += len(rows)
+        stats["batches"] += 1
+        stats["users"].update(cash)
+
+    stats["users"] = len(stats["users"])
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    return stats
+
+def _iter_chunks(query, chunk_size):
+    """Stream the result of a query by chunks of rows (server-side cursor)"""
+    result = db.session.execute(query.execution_options(yield_per=chunk_size))
+    for partition in result.partitions():
+        yield partition
+
+def _write_csv(chunks, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(name for name, _ in columns)
+    for chunk in chunks:
+        writer.writerows(chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # header only if there was no row
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def _write_parquet(chunks, columns):
+    if pyarrow is None:
+        raise RuntimeError("parquet export requires pyarrow")
+
+    schema = pyarrow.schema([(name, pyarrow.type_for_alias(type)) for name, type in columns])
+    sink = _ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    try:
+        for chunk in chunks:
+            # one row group per chunk
+            table = pyarrow.Table.from_arrays([pyarrow.array(values, type=field.type)
+                for values, field in zip(zip(*chunk), schema)], schema=schema)
+            writer.write_table(table)
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+class _ChunkSink:
+    """Write-only file object handing over the bytes written so far (parquet streaming)"""
+
+    def __init__(self):
+        self.closed = False
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+def _read_batches(path, format, batch_size):
+    """Read a csv or parquet file by batches of dicts"""
+    if format == "csv":
+        with open(path, newline="") as file:
+            reader = csv.DictReader(file)
+            while True:
+                batch = list(itertools.islice(reader, batch_size))
+                if not batch:
+                    return
+                yield batch
+    elif format == "parquet":
+        if pyarrow is None:
+            raise RuntimeError("parquet import requires pyarrow")
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=batch_size):
+            yield batch.to_pylist()
+    else:
+        raise ValueError(f"unknown format: {format}")
+
+def _normalize(row):
+    """Convert a csv/parquet row to typed values"""
+    def value(name, cast):
+        raw = row.get(name)
+        return cast(raw) if raw not in (None, "") else None
+
+    symbol = (row.get("symbol") or "").strip().upper() or None
+    quantity = value("quantity", int)
+    price = value("price", float)
+    amount = value("amount", float)
+    created_on = row.get("created_on")
+    if isinstance(created_on, str):
+        created_on = datetime.fromisoformat(created_on) if created_on else None
+    if symbol is not None and (quantity is None or price is None):
+        raise ValueError(f"trade without quantity or price: {row}")
+    if amount is None:
+        if symbol is None:
+            raise ValueError(f"cash movement without amount: {row}")
+        amount = quantity * price
+
+    return {
+        "user": (row.get("username") or "").lower() or value("user_id", int),
+        "symbol": symbol,
+        "name": row.get("name") or symbol,
+        "quantity": quantity,
+        "price": price,
+        "amount": amount,
+        "currency": row.get("currency") or "USD",
+        # same default as the DB (UTC)
+        "created_on": created_on or datetime.now(timezone.utc).replace(tzinfo=None)
+    }
+
+def _resolve_users(rows):
+    """Map the usernames/user ids of the rows to user ids"""
+    usernames = {row["user"] for row in rows if isinstance(row["user"], str)}
+    ids = {row["user"] for row in rows if isinstance(row["user"], int)}
+    users = {}
+    if usernames:
+        users.update(db.session.execute(select(User.username, User.id).where(User.username.in_(usernames))).all())
+    if ids:
+        users.update((id, id) for id in db.session.execute(select(User.id).where(User.id.in_(ids))).scalars())
+    unknown = (usernames | ids) - users.keys()
+    if unknown:
+        raise ValueError(f"unknown users: {', '.join(map(str, sorted(unknown, key=str)))}")
+    return users
+
+def _resolve_stocks(rows, stocks):
+    """Add the stocks missing from the master data (stocks maps symbols to ids)"""
+    missing = {}
+    for row in rows:
+        if row["symbol"] and row["symbol"] not in stocks:
+            missing.setdefault(row["symbol"], row["name"])
+    if missing:
+        # added since the import started (stocks are identified by symbol only)
+        stocks.update(db.session.execute(select(Stock.stock, Stock.id).where(Stock.stock.in_(missing))).all())
+        new = [{"stock": stock, "name": name} for stock, name in missing.items() if stock not in stocks]
+        if new:
+            db.session.execute(insert(Stock), new)
+            stocks.update(db.session.execute(select(Stock.stock, Stock.id).where(Stock.stock.in_([row["stock"] for row in new]))).all())
+
+def _update_cash(cash):
+    """Add the cash deltas to the users' balances"""
+    users = User.__table__
+    db.session.execute(users.update().where(users.c.id == bindparam("user_id_")).values(cash=users.c.cash + bindparam("delta")),
+        [{"user_id_": user_id, "delta": delta} for user_id, delta in cash.items()])
+
+def _update_holdings(holdings):
+    """Add the quantity & amount deltas to the holdings (created if necessary)"""
+    if not holdings:
+        return
+    table = Holding.__table__
+    existing = set(tuple(row) for row in db.session.execute(select(Holding.user_id, Holding.stock_id) \
+        .where(Holding.user_id.in_({user_id for user_id, _ in holdings}))))
+
+    updates = [{"user_id_": user_id, "stock_id_": stock_id, "quantity_": quantity, "amount_": amount}
+        for (user_id, stock_id), (quantity, amount) in holdings.items() if (user_id, stock_id) in existing]
+    inserts = [{"user_id": user_id, "stock_id": stock_id, "quantity": quantity, "amount": amount}
+        for (user_id, stock_id), (quantity, amount) in holdings.items() if (user_id, stock_id) not in existing]
+
+    if updates:
+        db.session.execute(table.update() \
+            .where(and_(table.c.user_id == bindparam("user_id_"), table.c.stock_id == bindparam("stock_id_"))) \
+            .values(quantity=table.c.quantity + bindparam("quantity_"), amount=table.c.amount + bindparam("amount_")), updates)
+    if inserts:
+        db.session.execute(insert(Holding), inserts)
@@ -1,8 +1,39 @@
+import json
+
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import relationship
 
 db = SQLAlchemy()
 
+def create_indexes():
+    """Create the indexes missing from an existing DB (create_all only creates missing tables), rebuild the ones whose uniqueness changed"""
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        unique = {index["name"]: bool(index["unique"]) for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in unique and unique[index.name] != bool(index.unique):
+                index.drop(bind=db.engine)
+            index.create(bind=db.engine, checkfirst=True)
+
+def add_missing_columns():
+    """Add the columns missing from the tables of an existing DB (create_all only creates missing tables)"""
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=db.engine.dialect)}"
+            # existing rows get the server default (required by NOT NULL)
+            if column.server_default is not None:
+                ddl += f" DEFAULT '{column.server_default.arg}'"
+                if not column.nullable:
+                    ddl += " NOT NULL"
+            db.session.execute(db.text(ddl))
+    # commit changes
+    db.session.commit()
+
 class User(db.Model):
     """Master Data Table for Users"""
     __tablename__ = "users"
@@ -11,6 +42,8 @@ class User(db.Model):
     username = db.Column(db.Text, unique=True, nullable=False)
     hash = db.Column(db.Text, nullable=False)
     cash = db.Column(db.Float, nullable=False, default=10000.00)
+    # currency of the portfolio & history views (cash is held in USD)
+    base_currency = db.Column(db.Text, nullable=False, default="USD", server_default="USD")
 
     # additional methods to access User model
     @staticmethod
@@ -43,6 +76,11 @@ class User(db.Model):
 class Stock(db.Model):
     """Master Data Table for Stocks"""
     __tablename__ = "stocks"
+    __table_args__ = (
+        # symbols & names are looked up individually (several symbols may share a company name, e.g. GOOG & GOOGL)
+        db.Index("ix_stocks_stock", "stock", unique=True),
+        db.Index("ix_stocks_name", "name"),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     stock = db.Column(db.Text, nullable=False)
@@ -52,10 +90,9 @@ class Stock(db.Model):
     @staticmethod
     def get_all(user_id):
         # user_id is always used to restrict selection
-        return db.session.query(Stock.id, Stock.stock, Stock.name, \
-            db.func.sum(Transaction.quantity).label("quantity"), db.func.sum(Transaction.amount).label("amount")) \
-            .filter(Transaction.stock_id == Stock.id, Transaction.user_id == user_id) \
-            .group_by("stock_id").order_by("stock") \
+        return db.session.query(Stock.id, Stock.stock, Stock.name, Holding.quantity, Holding.amount) \
+            .filter(Holding.stock_id == Stock.id, Holding.user_id == user_id) \
+            .order_by(Stock.stock) \
             .all()
 
     @staticmethod
@@ -71,9 +108,36 @@ class Stock(db.Model):
         else:
             return True
 
+class ReferenceSymbol(db.Model):
+    """Reference Data Table for the symbols supported by the quote provider"""
+    __tablename__ = "reference_symbols"
+
+    symbol = db.Column(db.Text, primary_key=True)
+    name = db.Column(db.Text, nullable=False)
+
+    # additional methods to access ReferenceSymbol model
+    @staticmethod
+    def get_all():
+        return db.session.execute(db.select(ReferenceSymbol.symbol, ReferenceSymbol.name)).all()
+
+    @staticmethod
+    def replace_all(rows):
+        """Replace the reference list ({symbol, name} dicts) in one DB transaction"""
+        db.session.execute(db.delete(ReferenceSymbol))
+        if rows:
+            db.session.execute(db.insert(ReferenceSymbol.__table__), rows)
+        # commit changes
+        db.session.commit()
+        return len(rows)
+
 class Transaction(db.Model):
     """Transactional Table for Stock Inventory"""
     __tablename__ = "transactions"
+    __table_args__ = (
+        # transactions are always selected per user, then per stock (holdings) or by date (history)
+        db.Index("ix_transactions_user_stock", "user_id", "stock_id"),
+        db.Index("ix_transactions_user_created", "user_id", "created_on"),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     created_on = db.Column(db.DateTime, server_default=db.func.now())
@@ -108,11 +172,369 @@ class Transaction(db.Model):
             .order_by("created_on") \
             .all()
 
+    @staticmethod
+    def get_page(user_id, after=None, limit=50, start=None, end=None, symbol=None):
+        """
+        Page of transactions per user (keyset pagination)
+
+        after is the id of the last transaction of the previous page (the page continues
+        after its (created_on, id) position), start/end restrict the creation date (end excluded)
+        and symbol the stock.
+        """
+        # user_id is always used to restrict selection
+        query = db.session.query(Transaction.id, Stock.stock, Stock.name, \
+            Transaction.quantity, Transaction.price, Transaction.amount, Transaction.currency, Transaction.created_on) \
+            .filter(Transaction.stock_id == Stock.id, Transaction.user_id == user_id)
+        if symbol is not None:
+            query = query.filter(Stock.stock == symbol)
+        if start is not None:
+            query = query.filter(Transaction.created_on >= start)
+        if end is not None:
+            query = query.filter(Transaction.created_on < end)
+        if after is not None:
+            # compare with the stored creation date of the cursor row (no datetime round-trip), as a row value
+            # so that the page starts with an index range on (user_id, created_on) instead of the user's first row
+            created_on = db.session.query(Transaction.created_on).filter(Transaction.id == after).scalar_subquery()
+            query = query.filter(db.tuple_(Transaction.created_on, Transaction.id) > db.tuple_(created_on, after))
+        return query.order_by(Transaction.created_on, Transaction.id).limit(limit).all()
+
+    @staticmethod
+    def iter_all(user_id, page_size=500, **filters):
+        """Transactions per user, fetched page by page so that memory use does not depend on the history length"""
+        after = None
+        while True:
+            transactions_db = Transaction.get_page(user_id, after=after, limit=page_size, **filters)
+            yield from transactions_db
+            if len(transactions_db) < page_size:
+                return
+            after = transactions_db[-1].id
+
     @staticmethod
     def get_by_symbol(user_id, symbol):
         """Transaction per symbol"""
-        return db.session.query(Stock.id, Stock.stock, Stock.name, \
+        return db.session.query(Stock.id, Stock.stock, Stock.name, Holding.quantity, Holding.amount) \
+            .filter(Holding.stock_id == Stock.id, Stock.stock == symbol, Holding.user_id == user_id) \
+            .first()
+
+class Holding(db.Model):
+    """
+    Materialized Table for Stock Holdings
+
+    Running totals of the transactions per user & stock, updated in the same DB transaction
+    as each trade so that portfolio reads do not depend on the length of the history.
+    """
+    __tablename__ = "holdings"
+
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    stock_id = db.Column(db.Integer, db.ForeignKey("stocks.id"), primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    amount = db.Column(db.Float, nullable=False, default=0)
+
+    # additional methods to access Holding model
+    @staticmethod
+    def apply(user_id, stock_id, quantity, amount):
+        """
+        Add a trade to the running totals (committed by the caller together with the trade)
+
+        Single conditional UPDATE: a sale only applies if enough shares are held when it runs.
+        Returns False if the trade was not applied.
+        """
+        query = db.update(Holding).where(Holding.user_id == user_id, Holding.stock_id == stock_id) \
+            .values(quantity=Holding.quantity + quantity, amount=Holding.amount + amount)
+        if quantity < 0:
+            query = query.where(Holding.quantity >= -quantity)
+        if db.session.execute(query).rowcount == 1:
+            return True
+        if quantity < 0:
+            return False
+        # first purchase of the stock, in a savepoint in case of a concurrent first purchase
+        try:
+            with db.session.begin_nested():
+                db.session.add(Holding(user_id=user_id, stock_id=stock_id, quantity=quantity, amount=amount))
+        except IntegrityError:
+            return db.session.execute(query).rowcount == 1
+        return True
+
+    @staticmethod
+    def apply_many(user_id, trades):
+        """
+        Add several trades ({stock_id: (quantity, amount)}) to the running totals in two statements
+
+        Same as apply() for each trade: returns False (nothing to commit) if a sale exceeds the held
+        quantity. The caller must hold the user's lock (cash updated first) so that the holdings
+        of the user can't be created concurrently.
+        """
+        existing = set(db.session.execute(db.select(Holding.stock_id) \
+            .where(Holding.user_id == user_id, Holding.stock_id.in_(trades))).scalars())
+        if existing:
+            quantity = db.case({stock_id: trades[stock_id][0] for stock_id in existing}, value=Holding.stock_id)
+            amount = db.case({stock_id: trades[stock_id][1] for stock_id in existing}, value=Holding.stock_id)
+            query = db.update(Holding).where(Holding.user_id == user_id, Holding.stock_id.in_(existing), \
+                Holding.quantity + quantity >= 0).values(quantity=Holding.quantity + quantity, amount=Holding.amount + amount) \
+                .execution_options(synchronize_session=False)
+            if db.session.execute(query).rowcount != len(existing):
+                return False
+        new = [{"user_id": user_id, "stock_id": stock_id, "quantity": quantity, "amount": amount} \
+            for stock_id, (quantity, amount) in trades.items() if stock_id not in existing]
+        if any(row["quantity"] < 0 for row in new):
+            return False
+        if new:
+            db.session.execute(db.insert(Holding.__table__), new)
+        return True
+
+    @staticmethod
+    def ledger():
+        """Running totals recomputed from the transactions"""
+        return db.session.query(Transaction.user_id, Transaction.stock_id, \
             db.func.sum(Transaction.quantity).label("quantity"), db.func.sum(Transaction.amount).label("amount")) \
-            .filter(Transaction.stock_id == Stock.id, Stock.stock == symbol, Transaction.user_id == user_id) \
-            .group_by("stock_id") \
-            .first()
\ No newline at end of file
+            .filter(Transaction.stock_id.isnot(None)) \
+            .group_by(Transaction.user_id, Transaction.stock_id)
+
+    @staticmethod
+    def rebuild():
+        """Recompute all the holdings from the transactions"""
+        db.session.query(Holding).delete()
+        db.session.execute(db.insert(Holding).from_select(["user_id", "stock_id", "quantity", "amount"], Holding.ledger()))
+        # commit changes
+        db.session.commit()
+        return Holding.query.count()
+
+    @staticmethod
+    def verify():
+        """Compare the holdings with the transactions, return the mismatches"""
+        expected = {(row.user_id, row.stock_id): (row.quantity, row.amount) for row in Holding.ledger()}
+        actual = {(row.user_id, row.stock_id): (row.quantity, row.amount) for row in Holding.query}
+        mismatches = []
+        for key in expected.keys() | actual.keys():
+            quantity, amount = expected.get(key, (0, 0.0))
+            holding = actual.get(key, (0, 0.0))
+            if quantity != holding[0] or abs(amount - holding[1]) > 1e-6:
+                mismatches.append({"user_id": key[0], "stock_id": key[1], "expected": (quantity, amount), "actual": holding})
+        return mismatches
+
+    @staticmethod
+    def ensure_built():
+        """Build the holdings of an existing DB that predates the table"""
+        if Holding.query.first() is None and Transaction.query.filter(Transaction.stock_id.isnot(None)).first() is not None:
+            Holding.rebuild()
+
+class IdempotencyKey(db.Model):
+    """
+    Keys of the orders already executed (Idempotency-Key header)
+
+    The key is inserted in the DB transaction of the order, the response sent back is stored
+    afterwards so that a retried request gets the same response without trading twice.
+    """
+    __tablename__ = "idempotency_keys"
+
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    key = db.Column(db.String(64), primary_key=True)
+    response = db.Column(db.Text, nullable=True)
+    created_on = db.Column(db.DateTime, server_default=db.func.now())
+
+    # additional methods to access IdempotencyKey model
+    @staticmethod
+    def get_response(user_id, key):
+        """Response of an executed order, None if unknown (or still running)"""
+        key_db = IdempotencyKey.query.get((user_id, key))
+        return json.loads(key_db.response) if key_db is not None and key_db.response is not None else None
+
+    @staticmethod
+    def store(user_id, key, response):
+        db.session.execute(db.update(IdempotencyKey).where(IdempotencyKey.user_id == user_id, IdempotencyKey.key == key) \
+            .values(response=json.dumps(response)))
+        # commit changes
+        db.session.commit()
+
+    @staticmethod
+    def purge(before):
+        """Delete the keys created before a date, return their number"""
+        count = IdempotencyKey.query.filter(IdempotencyKey.created_on < before).delete()
+        # commit changes
+        db.session.commit()
+        return count
+
+class Order(db.Model):
+    """
+    Resting limit & stop orders
+
+    Limit orders execute at the trigger price or better (buy when the price falls to it, sell
+    when it rises to it), stop orders once the price crosses the trigger the other way. Open
+    orders are held by the trigger engine (orderbook.py), fills are recorded as transactions.
+    """
+    __tablename__ = "orders"
+    __table_args__ = (
+        # open orders are loaded by the engine, the others listed per user
+        db.Index("ix_orders_status_symbol", "status", "symbol"),
+        db.Index("ix_orders_user_created", "user_id", "created_on"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    created_on = db.Column(db.DateTime, server_default=db.func.now())
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    symbol = db.Column(db.Text, nullable=False)
+    name = db.Column(db.Text, nullable=False)
+    # buy or sell, limit or stop
+    side = db.Column(db.Text, nullable=False)
+    kind = db.Column(db.Text, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    trigger_price = db.Column(db.Float, nullable=False)
+    currency = db.Column(db.Text, nullable=False, default="USD", server_default="USD")
+    # open, filled, cancelled or rejected (message)
+    status = db.Column(db.Text, nullable=False, default="open")
+    message = db.Column(db.Text, nullable=True)
+    transaction_id = db.Column(db.Integer, db.ForeignKey("transactions.id"), nullable=True)
+    closed_on = db.Column(db.DateTime, nullable=True)
+
+    # additional methods to access Order model
+    @staticmethod
+    def get_all(user_id, limit=100):
+        """Latest orders of a user, open or not"""
+        return Order.query.filter_by(user_id=user_id).order_by(Order.id.desc()).limit(limit).all()
+
+    @staticmethod
+    def get_open():
+        """Every open order (loaded by the trigger engine)"""
+        return db.session.execute(db.select(Order.id, Order.symbol, Order.side, Order.kind, Order.trigger_price) \
+            .where(Order.status == "open")).all()
+
+    @staticmethod
+    def close(order_id, status, user_id=None, message=None, transaction_id=None):
+        """Close an open order (not yet filled or cancelled concurrently), return whether it was open"""
+        query = db.update(Order).where(Order.id == order_id, Order.status == "open") \
+            .values(status=status, message=message, transaction_id=transaction_id, closed_on=db.func.now())
+        if user_id is not None:
+            query = query.where(Order.user_id == user_id)
+        return db.session.execute(query).rowcount == 1
+
+class RollupState(db.Model):
+    """Watermarks of the rollup tables (last transaction aggregated, see reporting.py)"""
+    __tablename__ = "rollup_state"
+
+    name = db.Column(db.Text, primary_key=True)
+    last_id = db.Column(db.Integer, nullable=False, default=0)
+    refreshed_on = db.Column(db.DateTime, nullable=True)
+    # ids below the watermark not committed yet (JSON {id: first missed, epoch seconds})
+    gaps = db.Column(db.Text, nullable=False, default="{}", server_default="{}")
+
+    # additional methods to access RollupState model
+    @staticmethod
+    def get(name):
+        """Watermark of a rollup, created at 0 if needed"""
+        state_db = db.session.get(RollupState, name)
+        if state_db is None:
+            state_db = RollupState(name=name, last_id=0, gaps="{}")
+            db.session.add(state_db)
+        return state_db
+
+    def get_gaps(self):
+        """Ids missed below the watermark ({id: first missed})"""
+        return {int(id): missed for id, missed in json.loads(self.gaps or "{}").items()}
+
+    def set_gaps(self, gaps):
+        self.gaps = json.dumps({str(id): missed for id, missed in sorted(gaps.items())})
+
+class PortfolioRollup(db.Model):
+    """Rollup Table for Portfolio Values (cash & holdings at the last price snapshot)"""
+    __tablename__ = "rollup_portfolios"
+    __table_args__ = (
+        # leaderboard: top k by value
+        db.Index("ix_rollup_portfolios_value", "value"),
+    )
+
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    cash = db.Column(db.Float, nullable=False)
+    holdings = db.Column(db.Float, nullable=False)
+    value = db.Column(db.Float, nullable=False)
+
+    # additional methods to access PortfolioRollup model
+    @staticmethod
+    def top(limit=10):
+        return db.session.execute(db.select(User.username, PortfolioRollup.cash, PortfolioRollup.holdings, PortfolioRollup.value) \
+            .join(User, User.id == PortfolioRollup.user_id) \
+            .order_by(PortfolioRollup.value.desc()).limit(limit)).all()
+
+class SymbolRollup(db.Model):
+    """Rollup Table for Holdings per Stock (holders, shares & value at the last price snapshot)"""
+    __tablename__ = "rollup_symbols"
+    __table_args__ = (
+        # most held symbols: top k by number of holders
+        db.Index("ix_rollup_symbols_holders", "holders"),
+    )
+
+    stock_id = db.Column(db.Integer, db.ForeignKey("stocks.id"), primary_key=True)
+    holders = db.Column(db.Integer, nullable=False, default=0)
+    shares = db.Column(db.Integer, nullable=False, default=0)
+    price = db.Column(db.Float, nullable=True)
+    value = db.Column(db.Float, nullable=True)
+
+    # additional methods to access SymbolRollup model
+    @staticmethod
+    def top(limit=10):
+        return db.session.execute(db.select(Stock.stock, Stock.name, SymbolRollup.holders, SymbolRollup.shares, \
+            SymbolRollup.price, SymbolRollup.value) \
+            .join(Stock, Stock.id == SymbolRollup.stock_id) \
+            .order_by(SymbolRollup.holders.desc()).limit(limit)).all()
+
+class DailyVolume(db.Model):
+    """Rollup Table for the Traded Volume per Day"""
+    __tablename__ = "rollup_daily_volume"
+
+    day = db.Column(db.Date, primary_key=True)
+    trades = db.Column(db.Integer, nullable=False, default=0)
+    shares = db.Column(db.Integer, nullable=False, default=0)
+    amount = db.Column(db.Float, nullable=False, default=0)
+
+    # additional methods to access DailyVolume model
+    @staticmethod
+    def latest(limit=30):
+        return DailyVolume.query.order_by(DailyVolume.day.desc()).limit(limit).all()
+
+class FxRate(db.Model):
+    """History Table for the Exchange Rates (USD per unit of currency, first rate of each day)"""
+    __tablename__ = "fx_rates"
+    __table_args__ = (
+        # last rate per currency
+        db.Index("ix_fx_rates_currency_day", "currency", "day"),
+    )
+
+    day = db.Column(db.Date, primary_key=True)
+    currency = db.Column(db.Text, primary_key=True)
+    rate = db.Column(db.Float, nullable=False)
+
+    # additional methods to access FxRate model
+    @staticmethod
+    def record(day, rates):
+        """
+        Store the rates ({currency: rate}) of a day, the ones already stored are kept
+
+        Committed on a connection of its own, whatever the state of the session's transaction.
+        """
+        try:
+            with db.engine.begin() as connection:
+                existing = set(connection.execute(db.select(FxRate.currency) \
+                    .where(FxRate.day == day, FxRate.currency.in_(rates))).scalars())
+                rows = [{"day": day, "currency": currency, "rate": rate} for currency, rate in rates.items() if currency not in existing]
+                if rows:
+                    connection.execute(db.insert(FxRate), rows)
+        except IntegrityError:
+            # recorded concurrently
+            pass
+
+    @staticmethod
+    def latest(currencies):
+        """Last recorded rate of each currency ({currency: rate})"""
+        last = db.select(FxRate.currency, db.func.max(FxRate.day).label("day")) \
+            .where(FxRate.currency.in_(currencies)).group_by(FxRate.currency).subquery()
+        return dict(db.session.execute(db.select(FxRate.currency, FxRate.rate) \
+            .join(last, (FxRate.currency == last.c.currency) & (FxRate.day == last.c.day))).all())
+
+    @staticmethod
+    def history(currency, start=None, end=None):
+        """Recorded rates (day, rate) of a currency by date"""
+        query = db.select(FxRate.day, FxRate.rate).where(FxRate.currency == currency)
+        if start is not None:
+            query = query.where(FxRate.day >= start)
+        if end is not None:
+            query = query.where(FxRate.day < end)
+        return db.session.execute(query.order_by(FxRate.day)).all()
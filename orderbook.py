@@ -0,0 +1,161 @@
+import heapq
+import threading
+# local packages
+import trading
+from models import Order
+
+class OrderBook:
+    """
+    Open orders of one symbol, indexed by trigger price.
+
+    Orders triggered when the price falls to their trigger (buy limit, sell stop) sit in a
+    max-heap, the ones triggered when it rises (sell limit, buy stop) in a min-heap, so a tick
+    only pops the orders it crosses from the tops, O(log n) each, whatever the number of open
+    orders. Removed orders are skipped when they reach the top, and purged once they outnumber
+    the open ones.
+    """
+
+    def __init__(self):
+        self._falling = []
+        self._rising = []
+        self._orders = {}
+
+    def __len__(self):
+        return len(self._orders)
+
+    def add(self, order_id, falling, price):
+        """Index an open order, triggered at or below price if falling is set, at or above otherwise"""
+        self._orders[order_id] = (falling, price)
+        if falling:
+            heapq.heappush(self._falling, (-price, order_id))
+        else:
+            heapq.heappush(self._rising, (price, order_id))
+
+    def remove(self, order_id):
+        """Forget an order, return its (falling, price) entry if it was open"""
+        entry = self._orders.pop(order_id, None)
+        if len(self._falling) + len(self._rising) > 2 * len(self._orders) + 64:
+            self._compact()
+        return entry
+
+    def triggered(self, price):
+        """Remove & return the orders (id, entry) crossed by a price"""
+        orders = []
+        while self._falling and -self._falling[0][0] >= price:
+            order_id = heapq.heappop(self._falling)[1]
+            if order_id in self._orders:
+                orders.append((order_id, self._orders.pop(order_id)))
+        while self._rising and self._rising[0][0] <= price:
+            order_id = heapq.heappop(self._rising)[1]
+            if order_id in self._orders:
+                orders.append((order_id, self._orders.pop(order_id)))
+        return orders
+
+    def _compact(self):
+        self._falling = [(-price, order_id) for order_id, (falling, price) in self._orders.items() if falling]
+        self._rising = [(price, order_id) for order_id, (falling, price) in self._orders.items() if not falling]
+        heapq.heapify(self._falling)
+        heapq.heapify(self._rising)
+
+def is_falling(side, kind):
+    """Whether an order triggers when the price falls to its trigger (buy limit, sell stop)"""
+    return (side == "buy") == (kind == "limit")
+
+class TriggerEngine:
+    """
+    In-process trigger engine for the resting orders.
+
+    Loads the open orders into one OrderBook per symbol at startup, watches their symbols on the
+    live price feed and fills the orders crossed by each price change (trading.fill_order), or
+    by the last known price when they are placed (marketable orders, flat quotes). Every
+    process can run an engine: the fill closes the order with a conditional UPDATE, so an order
+    triggered by several engines, or cancelled meanwhile, is executed once at most.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._books = {}
+        self._lock = threading.Lock()
+        self._app = None
+        self._fanout = None
+
+    def init_app(self, app, fanout):
+        """Load the open orders & listen to the price feed (ORDERS_ENGINE)."""
+        self.enabled = app.config.get("ORDERS_ENGINE", self.enabled)
+        self._app = app
+        self._fanout = fanout
+        if not self.enabled:
+            return
+        fanout.add_listener(self.on_prices)
+        self.load()
+
+    def load(self):
+        orders = Order.get_open()
+        for order in orders:
+            self._add(order.id, order.symbol, is_falling(order.side, order.kind), order.trigger_price)
+        self._app.logger.debug(f"{len(orders)} open orders loaded in {len(self._books)} books")
+
+    def add(self, order_db):
+        """Index a new order, filled right away if the last known price already crosses its trigger"""
+        if not self.enabled:
+            return
+        self._add(order_db.id, order_db.symbol, is_falling(order_db.side, order_db.kind), order_db.trigger_price)
+        # the feed only reports changes: a marketable order would wait for the quote to move
+        price = self._fanout.last_price(order_db.symbol)
+        if price is not None:
+            self.on_prices({order_db.symbol: price})
+
+    def remove(self, order_id, symbol):
+        """Forget a cancelled order"""
+        with self._lock:
+            book = self._books.get(symbol)
+            if book is not None:
+                book.remove(order_id)
+                self._release(symbol, book)
+
+    def triggered(self, prices):
+        """Remove & return the orders ([(order_id, symbol, price)]) crossed by price changes ({symbol: price})"""
+        orders = []
+        with self._lock:
+            for symbol, price in prices.items():
+                book = self._books.get(symbol)
+                if book is None:
+                    continue
+                orders += [(order_id, symbol, price) for order_id, _ in book.triggered(price)]
+                self._release(symbol, book)
+        return orders
+
+    def on_prices(self, prices):
+        """Fill the orders crossed by price changes (price feed thread)"""
+        orders = self.triggered(prices)
+        if not orders:
+            return
+        with self._app.app_context():
+            for order_id, symbol, price in orders:
+                try:
+                    if trading.fill_order(order_id, price) is not None:
+                        self._app.logger.info(f"Order {order_id} filled: {symbol} at {price}")
+                except trading.TradeError as e:
+                    self._app.logger.info(f"Order {order_id} rejected: {e.message}")
+                except Exception:
+                    self._app.logger.exception(f"Order {order_id} not filled, retried on the next price change")
+                    order_db = Order.query.get(order_id)
+                    if order_db is not None and order_db.status == "open":
+                        self._add(order_db.id, order_db.symbol, is_falling(order_db.side, order_db.kind), order_db.trigger_price)
+
+    def _add(self, order_id, symbol, falling, price):
+        with self._lock:
+            book = self._books.get(symbol)
+            if book is None:
+                book = self._books[symbol] = OrderBook()
+                self._fanout.watch([symbol])
+            book.add(order_id, falling, price)
+
+    def _release(self, symbol, book):
+        # called with the lock held: stop watching symbols without open orders
+        if not len(book):
+            del self._books[symbol]
+            self._fanout.unwatch([symbol])
+
+# process-wide trigger engine, configured by the application
+trigger_engine = TriggerEngine()
@@ -0,0 +1,223 @@
+import math
+import threading
+
+from collections import OrderedDict, defaultdict
+from flask import current_app
+# local packages
+from fx import RateUnavailable, fx_rates
+from helpers import lookup, lookup_many
+from models import Stock, Transaction, User
+
+def position(stock_db, price, currency="USD"):
+    """Figures of a held stock (row of the portfolio table) at the latest price (None if not quoted), in the currency of the listing"""
+    avg_price = float(stock_db.amount / stock_db.quantity) if stock_db.quantity > 0 else 0
+    # define a comparison indicator on the price (latest) vs average price (DB)
+    if price is None:
+        price_indicator = "table-secondary"
+    elif round(price, 5) > round(avg_price, 5):
+        price_indicator = "table-success"
+    elif round(price, 5) < round(avg_price, 5):
+        price_indicator = "table-danger"
+    else:
+        price_indicator = "table-secondary"
+    return {
+        "stock": stock_db.stock,
+        "name": stock_db.name,
+        "quantity": stock_db.quantity,
+        "price": price,
+        "avg_price": avg_price,
+        # the price variation is calculated based on historical average vs latest price
+        "variation": ((price - avg_price) / avg_price if avg_price > 0 else 0) if price is not None else None,
+        # the amount is valuated based on the latest price
+        "amount": float(stock_db.quantity * price) if price is not None else None,
+        "currency": currency,
+        "price_indicator": price_indicator
+    }
+
+def load(user_id):
+    """Positions, cash & grand total of a user in the base currency (partial if a held stock is not quoted)"""
+    figures, held = _load(User.get_by_id(user_id))
+    return figures
+
+def load_position(user_db, symbol, quote=None):
+    """Position of a user in a stock (at the quote, or the latest one), None if not held"""
+    stock_db = Transaction.get_by_symbol(user_id=user_db.id, symbol=symbol)
+    if stock_db is None:
+        return None
+    if quote is None:
+        quote = lookup(symbol)
+    # keep the holding without a quote (price n/a)
+    row = position(stock_db, float(quote["price"]) if quote is not None else None, \
+        (quote.get("currency") if quote is not None else None) or "USD")
+    convert([row], display_currency(user_db)[0])
+    return row
+
+def display_currency(user_db):
+    """Currency of a user's figures & its units per USD: the base currency, USD while its rate is unavailable"""
+    try:
+        return user_db.base_currency, fx_rates.rate("USD", user_db.base_currency)
+    except RateUnavailable:
+        current_app.logger.warning(f"No exchange rate for {user_db.base_currency}, figures shown in USD")
+        return "USD", 1.0
+
+def convert(positions, base):
+    """
+    Value the positions in the base currency, in one vectorized pass
+
+    Adds the value, the rate (base per unit of the listing currency) & the base currency to each
+    row, returns the rates to USD of the rows (the cash currency). Rows without a rate are not
+    valued (value None), like the stocks without a quote.
+    """
+    currencies = [row["currency"] for row in positions]
+    rates = fx_rates.convert([1.0] * len(positions), currencies, base)
+    for row, rate in zip(positions, rates):
+        row["rate"] = float(rate)
+        row["value"] = row["amount"] * float(rate) if row["amount"] is not None and not math.isnan(rate) else None
+        row["base_currency"] = base
+    return fx_rates.convert([1.0] * len(positions), currencies, "USD")
+
+def valuation(user_db):
+    """Cached valuation of a user (loaded again if missing or out of date)"""
+    valuation = valuations.get(user_db.id, user_db.cash)
+    if valuation is None:
+        figures, held = _load(user_db)
+        valuation = valuations.get(user_db.id) or Valuation(user_db.cash, held)
+    return valuation
+
+def grand_total(user_db, to_base=None):
+    """Total value of a user's portfolio in the currency of its figures (units per USD: to_base), from the valuation cache"""
+    if to_base is None:
+        to_base = display_currency(user_db)[1]
+    return valuation(user_db).total * to_base
+
+def _load(user_db):
+    stocks_db = [stock_db for stock_db in Stock.get_all(user_id=user_db.id) if stock_db.quantity > 0]
+    # one batched lookup (one round-trip whatever the number of stocks)
+    api_responses = lookup_many(stock_db.stock for stock_db in stocks_db)
+    # the stocks for which no price is available are kept (price n/a), out of the grand total
+    quotes = [api_responses.get(stock_db.stock.upper()) for stock_db in stocks_db]
+    positions = [position(stock_db, float(quote["price"]) if quote is not None else None, \
+        (quote.get("currency") if quote is not None else None) or "USD") for stock_db, quote in zip(stocks_db, quotes)]
+    base, to_base = display_currency(user_db)
+    usd_rates = convert(positions, base)
+    cash = user_db.cash * to_base
+
+    # fresh figures for the valuation cache (USD)
+    held = {row["stock"]: (row["quantity"], row["price"], float(rate)) for row, rate in zip(positions, usd_rates) \
+        if row["price"] is not None and not math.isnan(rate)}
+    valuations.put(user_db.id, user_db.cash, held)
+    priced = [row["value"] for row in positions if row["value"] is not None]
+    figures = {"base_currency": base, "cash": cash, "grand_total": cash + sum(priced), \
+        "partial": len(priced) < len(positions), "positions": positions}
+    return figures, held
+
+def render_row(position):
+    """Table row of a position (<tr> fragment shared with index.html, compiled once by the Jinja cache)"""
+    return current_app.jinja_env.get_template("_position_row.html").render(position=position)
+
+class Valuation:
+    """Cash & positions ({symbol: [quantity, price, USD per unit of the price]}) of a user, with their total value (USD)"""
+    __slots__ = ("cash", "positions", "total")
+
+    def __init__(self, cash, positions):
+        self.cash = cash
+        self.positions = {symbol: [quantity, price, rate] for symbol, (quantity, price, rate) in positions.items()}
+        self.total = cash + sum(quantity * price * rate for quantity, price, rate in self.positions.values())
+
+    def reprice(self, symbol, price):
+        position = self.positions.get(symbol)
+        if position is not None:
+            self.total += position[0] * (price - position[1]) * position[2]
+            position[1] = price
+
+    def trade(self, symbol, quantity, price, rate=1.0):
+        # the cash paid & the value of the shares cancel out at the trade price
+        self.reprice(symbol, price)
+        self.cash -= quantity * price * rate
+        position = self.positions.setdefault(symbol, [0, price, rate])
+        position[0] += quantity
+        if position[0] <= 0:
+            del self.positions[symbol]
+
+class ValuationCache:
+    """
+    Portfolio valuations of the recent users, kept up to date incrementally.
+
+    A valuation is built from the DB & one batched lookup (portfolio page), then every trade of
+    the process moves its cash & positions and every price change revalues the positions of the
+    symbol (holders index), each in O(1). Reads check the cached cash against the DB balance, so
+    a trade made by another process reloads the valuation instead of serving a stale total.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._valuations = OrderedDict()
+        self._holders = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Read the number of cached users from the application configuration."""
+        self.maxsize = app.config.get("PORTFOLIO_CACHE_SIZE", self.maxsize)
+
+    def get(self, user_id, cash=None):
+        """Valuation of a user, None if not cached or if its cash differs from the DB balance"""
+        with self._lock:
+            valuation = self._valuations.get(user_id)
+            if valuation is None:
+                return None
+            if cash is not None and abs(valuation.cash - cash) > 1e-6:
+                self._discard(user_id)
+                return None
+            self._valuations.move_to_end(user_id)
+            return valuation
+
+    def put(self, user_id, cash, positions):
+        """Cache the valuation of a user ({symbol: (quantity, price, rate)})"""
+        with self._lock:
+            self._discard(user_id)
+            self._valuations[user_id] = Valuation(cash, positions)
+            for symbol in positions:
+                self._holders[symbol].add(user_id)
+            while len(self._valuations) > self.maxsize:
+                self._discard(next(iter(self._valuations)))
+
+    def trade(self, user_id, symbol, quantity, price, rate=1.0):
+        """Apply a committed trade to the user's valuation & the trade price to every holder"""
+        with self._lock:
+            self._reprice(symbol, price)
+            valuation = self._valuations.get(user_id)
+            if valuation is not None:
+                valuation.trade(symbol, quantity, price, rate)
+                if symbol in valuation.positions:
+                    self._holders[symbol].add(user_id)
+                elif symbol in self._holders:
+                    self._holders[symbol].discard(user_id)
+                    if not self._holders[symbol]:
+                        del self._holders[symbol]
+
+    def reprice(self, prices):
+        """Revalue the cached positions at new prices ({symbol: price})"""
+        with self._lock:
+            for symbol, price in prices.items():
+                self._reprice(symbol, price)
+
+    def total(self, user_id):
+        """Cached total value (USD) of a user (cash & positions), None if not cached"""
+        with self._lock:
+            valuation = self._valuations.get(user_id)
+            return valuation.total if valuation is not None else None
+
+    def _reprice(self, symbol, price):
+        for user_id in self._holders.get(symbol, ()):
+            self._valuations[user_id].reprice(symbol, price)
+
+    def _discard(self, user_id):
+        valuation = self._valuations.pop(user_id, None)
+        if valuation is not None:
+            for symbol in valuation.positions:
+                self._holders[symbol].discard(user_id)
+                if not self._holders[symbol]:
+                    del self._holders[symbol]
+
+# process-wide portfolio valuations, configured by the application
+valuations = ValuationCache()
@@ -0,0 +1,140 @@
+import os
+import threading
+
+import numpy as np
+
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError:
+    # no file locking (Windows), appends are then only safe from a single process
+    fcntl = None
+
+# one bar per record, time in seconds since epoch (UTC), files are plain arrays of records
+BAR_DTYPE = np.dtype([("time", "<i8"), ("open", "<f8"), ("high", "<f8"), ("low", "<f8"), ("close", "<f8"), ("volume", "<i8")])
+FREQUENCIES = ("daily", "intraday")
+
+class PriceStore:
+    """
+    Local historical price store.
+
+    Bars are stored per frequency & symbol in append-only files of fixed-size records sorted
+    by time. Files are read through read-only memory maps, so that every worker process shares
+    the same pages (OS page cache), and sliced by date with a binary search.
+    """
+
+    def __init__(self, root="prices"):
+        self.root = root
+        self._maps = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Read the store location from the application configuration."""
+        self.root = app.config.get("PRICE_STORE_DIR", os.path.join(app.instance_path, "prices"))
+
+    def path(self, symbol, frequency="daily"):
+        if frequency not in FREQUENCIES:
+            raise ValueError(f"unknown frequency: {frequency}")
+        return os.path.join(self.root, frequency, f"{symbol.upper()}.bars")
+
+    def symbols(self, frequency="daily"):
+        """Symbols with stored bars"""
+        directory = os.path.join(self.root, frequency)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(name[:-len(".bars")] for name in os.listdir(directory) if name.endswith(".bars"))
+
+    def bars(self, symbol, frequency="daily"):
+        """All the bars of a symbol (read-only memory map, empty array if none)"""
+        path = self.path(symbol, frequency)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return np.empty(0, dtype=BAR_DTYPE)
+        count = size // BAR_DTYPE.itemsize
+        if count == 0:
+            return np.empty(0, dtype=BAR_DTYPE)
+
+        with self._lock:
+            cached = self._maps.get(path)
+            # remap when bars have been appended (by this or another process)
+            if cached is None or cached[0] != count:
+                cached = (count, np.memmap(path, dtype=BAR_DTYPE, mode="r", shape=(count,)))
+                self._maps[path] = cached
+        return cached[1]
+
+    def range(self, symbol, start=None, end=None, frequency="daily"):
+        """Bars of a symbol between start (included) & end (excluded), dates or epoch seconds"""
+        bars = self.bars(symbol, frequency)
+        times = bars["time"]
+        first = np.searchsorted(times, _seconds(start), side="left") if start is not None else 0
+        last = np.searchsorted(times, _seconds(end), side="left") if end is not None else len(bars)
+        return bars[first:last]
+
+    def last_time(self, symbol, frequency="daily"):
+        """Time of the last stored bar, None if there is none"""
+        bars = self.bars(symbol, frequency)
+        return int(bars["time"][-1]) if len(bars) else None
+
+    def append(self, symbol, bars, frequency="daily"):
+        """
+        Append bars (structured array or dicts) to a symbol.
+
+        Bars older than (or as old as) the last stored bar are ignored, the store is append-only.
+        Returns the number of bars appended.
+        """
+        bars = to_bars(bars)
+        if not len(bars):
+            return 0
+        bars = np.sort(bars, order="time")
+        # keep the last bar of duplicated times
+        bars = bars[np.r_[bars["time"][1:] != bars["time"][:-1], True]]
+
+        path = self.path(symbol, frequency)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "ab") as file:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                # the last bar is read under the lock (another process may be appending)
+                count = os.fstat(file.fileno()).st_size // BAR_DTYPE.itemsize
+                if count:
+                    last = np.memmap(path, dtype=BAR_DTYPE, mode="r", offset=(count - 1) * BAR_DTYPE.itemsize, shape=(1,))
+                    bars = bars[bars["time"] > last["time"][0]]
+                file.seek(count * BAR_DTYPE.itemsize)
+                file.truncate()
+                file.write(bars.tobytes())
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(file, fcntl.LOCK_UN)
+        return len(bars)
+
+def to_bars(rows):
+    """Convert dicts (time as epoch seconds or date/datetime) to a bar array"""
+    if isinstance(rows, np.ndarray):
+        return rows.astype(BAR_DTYPE, copy=False)
+    rows = list(rows)
+    bars = np.zeros(len(rows), dtype=BAR_DTYPE)
+    for name in BAR_DTYPE.names:
+        if name == "time":
+            bars[name] = [_seconds(row["time"]) for row in rows]
+        else:
+            bars[name] = [row.get(name) or 0 for row in rows]
+    return bars
+
+def _seconds(value):
+    """Epoch seconds of an epoch, date, datetime or ISO string (UTC)"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return int(value.timestamp())
+    if hasattr(value, "toordinal"):
+        # date
+        return int(datetime(value.year, value.month, value.day, tzinfo=timezone.utc).timestamp())
+    return int(value)
+
+# process-wide price store, configured by the application
+price_store = PriceStore()
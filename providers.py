@@ -0,0 +1,474 @@
+import json
+import math
+import os
+import random
+import threading
+import time
+import urllib.parse
+
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from requests.adapters import HTTPAdapter
+
+# maximum number of symbols per IEX batch call
+BATCH_SIZE = 100
+# maximum number of concurrent calls when the batch endpoint is not available
+MAX_WORKERS = 8
+# HTTP statuses worth retrying (rate limiting & server side errors)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# currencies of the simulated listings by exchange suffix (VOD.L, AIR.PA...), USD without suffix
+LISTING_CURRENCIES = {"L": "GBP", "PA": "EUR", "DE": "EUR", "AS": "EUR", "SW": "CHF", "T": "JPY", "TO": "CAD"}
+# number of bars per chart range (trading days, minutes for 1d)
+CHART_RANGES = {"1d": 390, "5d": 5, "1m": 21, "3m": 63, "6m": 126, "ytd": 252, "1y": 252, "2y": 504, "5y": 1260, "max": 2520}
+
+class ProviderUnavailable(Exception):
+    """Raised when the quote provider cannot be reached (or the circuit is open)"""
+
+class CircuitBreaker:
+    """
+    Fail fast while the provider is down.
+
+    The circuit opens after failure_threshold consecutive failures, calls are then
+    rejected until reset_timeout seconds have elapsed. One trial call is let through
+    afterwards (half-open): the circuit closes if it succeeds and opens again otherwise.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Check whether a call can be attempted"""
+        with self._lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if self.state == CircuitBreaker.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                # let a single trial call through
+                self.state = CircuitBreaker.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = CircuitBreaker.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = CircuitBreaker.OPEN
+                self._opened_at = time.monotonic()
+
+class QuoteProvider:
+    """
+    Source of quotes & historical bars.
+
+    fetch(symbols) returns {symbol: {"name", "price", "symbol", "currency"}} for the known
+    (upper-case) symbols, prices in the currency of the listing, chart(symbol, range) returns bars as dicts (time, open, high, low, close, volume).
+    """
+    # circuit breaker of remote providers
+    breaker = None
+
+    def init_app(self, app):
+        """Read the provider settings from the application configuration."""
+
+    def fetch(self, symbols):
+        raise NotImplementedError
+
+    def chart(self, symbol, range="1y"):
+        raise NotImplementedError
+
+    def symbols(self):
+        """Reference list of the tradable symbols (dicts with symbol & name), empty if not available"""
+        return []
+
+class IEXProvider(QuoteProvider):
+    """
+    Client for the IEX cloud API.
+
+    All the calls share a keep-alive connection pool, use separate connect & read
+    timeouts, are retried with a jittered exponential backoff and go through a
+    circuit breaker.
+
+    https://iexcloud.io/docs/api/
+    """
+
+    def __init__(self, base_url="https://cloud-sse.iexapis.com/stable", token=None, connect_timeout=3.05, read_timeout=5,
+                 max_retries=2, backoff=0.2, pool_size=10, failure_threshold=5, reset_timeout=30):
+        self.base_url = base_url
+        self.token = token
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.session = self._create_session(pool_size)
+
+    def init_app(self, app):
+        """Read the provider settings from the application configuration."""
+        self.base_url = app.config.get("QUOTE_API_URL", self.base_url)
+        self.token = app.config.get("QUOTE_API_TOKEN", self.token)
+        self.timeout = (app.config.get("QUOTE_API_CONNECT_TIMEOUT", self.timeout[0]),
+            app.config.get("QUOTE_API_READ_TIMEOUT", self.timeout[1]))
+        self.max_retries = app.config.get("QUOTE_API_MAX_RETRIES", self.max_retries)
+        self.backoff = app.config.get("QUOTE_API_BACKOFF", self.backoff)
+        self.breaker = CircuitBreaker(app.config.get("QUOTE_API_FAILURE_THRESHOLD", self.breaker.failure_threshold),
+            app.config.get("QUOTE_API_RESET_TIMEOUT", self.breaker.reset_timeout))
+        self.session = self._create_session(app.config.get("QUOTE_API_POOL_SIZE", 10))
+
+    def fetch(self, symbols):
+        """
+        Fetch quotes for several (upper-case) symbols.
+
+        The symbols are fetched through the batch endpoint (100 symbols per call),
+        falling back to concurrent single-symbol calls if the batch call fails.
+        Returns a dict keyed by symbol, unknown symbols are left out.
+
+        https://iexcloud.io/docs/api/#batch-requests
+        """
+        quotes = {}
+
+        for start in range(0, len(symbols), BATCH_SIZE):
+            chunk = symbols[start:start + BATCH_SIZE]
+            try:
+                batch = self._fetch_batch(chunk)
+            except ProviderUnavailable:
+                # no point in trying symbol by symbol
+                break
+            except (requests.RequestException, ValueError):
+                # batch endpoint unavailable, query the symbols one by one (concurrently)
+                with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(chunk))) as executor:
+                    batch = dict(zip(chunk, executor.map(self._fetch_one, chunk)))
+            quotes.update((symbol, quote) for symbol, quote in batch.items() if quote is not None)
+
+        return quotes
+
+    def chart(self, symbol, range="1y"):
+        """
+        Fetch historical bars for a symbol (daily bars, or minute bars for the 1d range).
+
+        https://iexcloud.io/docs/api/#historical-prices
+        """
+        bars = []
+        for bar in self.get(f"stock/{urllib.parse.quote_plus(symbol)}/chart/{range}"):
+            # minute bars have a separate time of day
+            stamp = f"{bar['date']}T{bar['minute']}" if bar.get("minute") else bar["date"]
+            bars.append({"time": stamp, "open": bar.get("open"), "high": bar.get("high"), "low": bar.get("low"),
+                "close": bar.get("close"), "volume": bar.get("volume")})
+        return bars
+
+    def symbols(self):
+        """
+        Fetch the reference list of the symbols supported by IEX.
+
+        https://iexcloud.io/docs/api/#symbols
+        """
+        return [{"symbol": row["symbol"], "name": row.get("name") or row["symbol"]}
+            for row in self.get("ref-data/symbols") if row.get("isEnabled", True)]
+
+    def _fetch_one(self, symbol):
+        """Fetch quote for a single symbol, None if not available."""
+        try:
+            return self._parse_quote(self.get(f"stock/{urllib.parse.quote_plus(symbol)}/quote"))
+        except (ProviderUnavailable, requests.RequestException, KeyError, TypeError, ValueError):
+            return None
+
+    def _fetch_batch(self, symbols):
+        """Fetch quotes for up to BATCH_SIZE symbols in one call."""
+        data = self.get("stock/market/batch", symbols=",".join(symbols), types="quote")
+
+        # parse response, symbols missing from the payload are unknown
+        quotes = {}
+        for symbol in symbols:
+            try:
+                quotes[symbol] = self._parse_quote(data[symbol]["quote"])
+            except (KeyError, TypeError, ValueError):
+                quotes[symbol] = None
+        return quotes
+
+    def get(self, path, **params):
+        """Call an API endpoint and return the decoded JSON payload."""
+        if not self.breaker.allow():
+            raise ProviderUnavailable("circuit open")
+
+        params["token"] = self.token
+        url = f"{self.base_url}/{path}"
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+            except requests.RequestException as e:
+                # connection errors, timeouts, broken or undecodable responses, redirect loops...
+                error = e
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    # the provider answered: client errors (unknown symbol...) are not provider failures
+                    self.breaker.record_success()
+                    response.raise_for_status()
+                    return response.json()
+                error = requests.HTTPError(f"{response.status_code} from provider", response=response)
+
+            if attempt < self.max_retries:
+                # exponential backoff with full jitter
+                time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+        self.breaker.record_failure()
+        raise error
+
+    @staticmethod
+    def _parse_quote(quote):
+        """Convert an IEX quote payload to the format used by the application."""
+        return {
+            "name": quote["companyName"],
+            "price": float(quote["latestPrice"]),
+            "symbol": quote["symbol"],
+            "currency": quote.get("currency") or "USD"
+        }
+
+    @staticmethod
+    def _create_session(pool_size):
+        """Create an HTTP session with a keep-alive connection pool."""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+class SimulatedProvider(QuoteProvider):
+    """
+    Local market simulator (random walks), to run the application & benchmarks offline.
+
+    Each symbol starts at a price derived from its name and moves by a log-normal step every time
+    it is fetched. Walks are seeded by the seed & the symbol, so a given sequence of calls always
+    yields the same prices. Any alphabetic symbol of up to 5 letters is known, optionally listed
+    abroad with an exchange suffix (LISTING_CURRENCIES), unless a symbol universe is given.
+    """
+
+    def __init__(self, seed=0, volatility=0.02, symbols=None):
+        self.seed = seed
+        self.volatility = volatility
+        self.universe = frozenset(symbols) if symbols else None
+        self._walks = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Read the simulator settings from the application configuration."""
+        self.seed = app.config.get("QUOTE_SIMULATOR_SEED", self.seed)
+        self.volatility = app.config.get("QUOTE_SIMULATOR_VOLATILITY", self.volatility)
+        symbols = app.config.get("QUOTE_SIMULATOR_SYMBOLS")
+        self.universe = frozenset(symbols) if symbols else None
+        self._walks = {}
+
+    def known(self, symbol):
+        if self.universe is not None:
+            return symbol in self.universe
+        base, _, suffix = symbol.partition(".")
+        return base.isalpha() and len(base) <= 5 and (not suffix or suffix in LISTING_CURRENCIES)
+
+    @staticmethod
+    def currency(symbol):
+        return LISTING_CURRENCIES.get(symbol.partition(".")[2], "USD")
+
+    def fetch(self, symbols):
+        quotes = {}
+        with self._lock:
+            for symbol in symbols:
+                if not self.known(symbol):
+                    continue
+                walk = self._walks.get(symbol)
+                if walk is None:
+                    # [generator, unrounded price]
+                    walk = self._walks[symbol] = [self._random(symbol), self._start_price(symbol)]
+                else:
+                    walk[1] = max(0.01, walk[1] * math.exp(walk[0].gauss(0, self.volatility)))
+                quotes[symbol] = {"name": f"{symbol} Inc.", "price": round(walk[1], 2), "symbol": symbol, "currency": self.currency(symbol)}
+        return quotes
+
+    def symbols(self):
+        """The symbol universe (none without a universe, any short symbol is known)"""
+        return [{"symbol": symbol, "name": f"{symbol} Inc."} for symbol in sorted(self.universe or ())]
+
+    def chart(self, symbol, range="1y"):
+        """Bars ending yesterday (weekdays), or minute bars of today's session for the 1d range"""
+        symbol = symbol.upper()
+        if not self.known(symbol):
+            raise ValueError(f"unknown symbol: {symbol}")
+        if range not in CHART_RANGES:
+            raise ValueError(f"unknown range: {range}")
+
+        stamps = self._stamps(CHART_RANGES[range], intraday=range == "1d")
+        rng = self._random(f"{symbol}:{range}")
+        volatility = self.volatility if range != "1d" else self.volatility / 20
+        close = self._start_price(symbol)
+        bars = []
+        for stamp in stamps:
+            open_ = close
+            close = max(0.01, open_ * math.exp(rng.gauss(0, volatility)))
+            spread = abs(rng.gauss(0, volatility / 2))
+            bars.append({"time": stamp, "open": round(open_, 2), "high": round(max(open_, close) * (1 + spread), 2),
+                "low": round(min(open_, close) * (1 - spread), 2), "close": round(close, 2),
+                "volume": rng.randint(10_000, 5_000_000)})
+        return bars
+
+    @staticmethod
+    def _stamps(count, intraday=False):
+        """Times of the last count weekdays, or of the first count minutes of today's session"""
+        if intraday:
+            return [f"{date.today()}T{9 + (30 + minute) // 60:02d}:{(30 + minute) % 60:02d}" for minute in range(count)]
+        days = []
+        day = date.today()
+        while len(days) < count:
+            day -= timedelta(days=1)
+            if day.weekday() < 5:
+                days.append(str(day))
+        return days[::-1]
+
+    def _random(self, key):
+        # string seeds are hashed deterministically (unlike hash())
+        return random.Random(f"{self.seed}:{key}")
+
+    def _start_price(self, symbol):
+        return 10 + self._random(f"{symbol}:start").random() * 490
+
+class ReplayProvider(QuoteProvider):
+    """
+    Serve quotes & bars recorded on disk.
+
+    Recordings are stored per symbol under directory: quotes/<SYMBOL>.jsonl (one quote per line)
+    and chart/<SYMBOL>-<range>.json. Each fetch of a symbol serves its next recorded quote,
+    starting over after the last one. With a source provider, calls are forwarded to the source
+    and its responses are appended to the recordings instead (record mode).
+    """
+
+    def __init__(self, directory="quotes", source=None):
+        self.directory = directory
+        self.source = source
+        self._quotes = {}
+        self._positions = {}
+        self._lock = threading.Lock()
+
+    @property
+    def breaker(self):
+        return self.source.breaker if self.source is not None else None
+
+    def init_app(self, app):
+        """Read the recordings location from the application configuration."""
+        self.directory = app.config.get("QUOTE_REPLAY_DIR", os.path.join(app.instance_path, "quotes"))
+        if self.source is not None:
+            self.source.init_app(app)
+        self._quotes = {}
+        self._positions = {}
+
+    def fetch(self, symbols):
+        if self.source is not None:
+            quotes = self.source.fetch(symbols)
+            with self._lock:
+                os.makedirs(os.path.join(self.directory, "quotes"), exist_ok=True)
+                for symbol, quote in quotes.items():
+                    with open(self._path("quotes", f"{symbol}.jsonl"), "a") as file:
+                        file.write(json.dumps(quote) + "\n")
+            return quotes
+
+        quotes = {}
+        with self._lock:
+            for symbol in symbols:
+                recorded = self._recorded(symbol)
+                if recorded:
+                    position = self._positions.get(symbol, 0)
+                    quotes[symbol] = recorded[position % len(recorded)]
+                    self._positions[symbol] = position + 1
+        return quotes
+
+    def chart(self, symbol, range="1y"):
+        path = self._path("chart", f"{symbol.upper()}-{range}.json")
+        if self.source is not None:
+            bars = self.source.chart(symbol, range)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as file:
+                json.dump(bars, file)
+            return bars
+
+        try:
+            with open(path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            raise ValueError(f"no recorded {range} bars for {symbol.upper()}") from None
+
+    def symbols(self):
+        path = self._path("symbols.json")
+        if self.source is not None:
+            symbols = self.source.symbols()
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, "w") as file:
+                json.dump(symbols, file)
+            return symbols
+
+        try:
+            with open(path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return []
+
+    def _recorded(self, symbol):
+        """Recorded quotes of a symbol (loaded once)"""
+        if symbol not in self._quotes:
+            try:
+                with open(self._path("quotes", f"{symbol}.jsonl")) as file:
+                    self._quotes[symbol] = [json.loads(line) for line in file if line.strip()]
+            except FileNotFoundError:
+                self._quotes[symbol] = []
+        return self._quotes[symbol]
+
+    def _path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+# backends selectable with QUOTE_PROVIDER ("record" is the replay backend recording from IEX)
+PROVIDERS = {
+    "iex": IEXProvider,
+    "simulator": SimulatedProvider,
+    "replay": ReplayProvider,
+    "record": lambda: ReplayProvider(source=IEXProvider())
+}
+
+class ConfiguredProvider:
+    """
+    Quote provider picked by the application configuration (QUOTE_PROVIDER).
+
+    Calls & attributes are forwarded to the selected backend, so that modules can import
+    the provider before the application is configured.
+    """
+
+    def __init__(self, backend=None):
+        self.name = "iex"
+        self.backend = backend or IEXProvider()
+
+    def init_app(self, app):
+        """Create & configure the backend selected by the application configuration."""
+        name = app.config.get("QUOTE_PROVIDER", self.name)
+        if name not in PROVIDERS:
+            raise RuntimeError(f"unknown quote provider: {name} (expected one of {', '.join(PROVIDERS)})")
+        backend = PROVIDERS[name]()
+        backend.init_app(app)
+        self.name = name
+        self.backend = backend
+
+    def fetch(self, symbols):
+        return self.backend.fetch(symbols)
+
+    def chart(self, symbol, range="1y"):
+        return self.backend.chart(symbol, range)
+
+    def symbols(self):
+        return self.backend.symbols()
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
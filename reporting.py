@@ -0,0 +1,147 @@
+import threading
+import time
+
+import numpy as np
+
+from datetime import datetime
+from sqlalchemy import case, delete, func, insert, or_, select, update
+# local packages
+from fx import fx_rates
+from helpers import lookup_many
+from models import db, DailyVolume, Holding, PortfolioRollup, RollupState, Stock, SymbolRollup, Transaction, User
+
+class Reports:
+    """
+    Firm-wide reporting tables, refreshed in the background or with `flask reports refresh`.
+
+    Each refresh aggregates the transactions added since the last one (id watermark) into the
+    daily traded volume and recounts the holders & shares of the stocks they touched from the
+    holdings table. Ids are allocated before commit, so a transaction can show up after a higher
+    id was aggregated: the ids missing below the watermark are looked up again by the refreshes
+    of the next REPORTS_GAP_WINDOW seconds, and aggregated once when they show up. Held stocks are then valued (USD) with one batched price snapshot, and the
+    portfolio values of every user rebuilt by a single INSERT ... SELECT, so that leaderboard
+    reads are an index scan of k rows.
+    """
+
+    def __init__(self, interval=0, gap_window=600):
+        self.interval = interval
+        self.gap_window = gap_window
+        self._thread = None
+
+    def init_app(self, app):
+        """Start the periodic refresh (REPORTS_REFRESH_INTERVAL seconds, 0 to only refresh on demand) & read the gap window (REPORTS_GAP_WINDOW seconds)."""
+        self.interval = app.config.get("REPORTS_REFRESH_INTERVAL", self.interval)
+        self.gap_window = app.config.get("REPORTS_GAP_WINDOW", self.gap_window)
+        if self.interval and self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(app,), name="reports-refresh", daemon=True)
+            self._thread.start()
+
+    def refresh(self):
+        """Bring the rollups up to date, return the numbers of new transactions, priced stocks & portfolios"""
+        state_db = RollupState.get("transactions")
+        gaps = state_db.get_gaps()
+        new = Transaction.id > state_db.last_id
+        if gaps:
+            new = or_(new, Transaction.id.in_(gaps))
+        # one read of the new transactions, so that the aggregated ids are exactly the ones seen
+        rows = db.session.execute(select(Transaction.id, Transaction.created_on, Transaction.currency, Transaction.stock_id, \
+            Transaction.quantity, Transaction.amount).where(new)).all()
+        trades = [row for row in rows if row.stock_id is not None]
+        self._add_volume(trades)
+        self._count_holders({row.stock_id for row in trades})
+        count = len(rows)
+
+        # ids missing below the new watermark, looked up again until the window is over
+        now = time.time()
+        seen = {row.id for row in rows}
+        gaps = {id: missed for id, missed in gaps.items() if id not in seen and now - missed < self.gap_window}
+        last_id = max(seen, default=state_db.last_id)
+        gaps.update((id, now) for id in range(state_db.last_id + 1, last_id) if id not in seen)
+        state_db.last_id = max(state_db.last_id, last_id)
+        state_db.set_gaps(gaps)
+
+        priced = self._price_symbols()
+        # portfolio values, cash + holdings at the snapshot prices
+        holdings = func.coalesce(func.sum(Holding.quantity * SymbolRollup.price), 0)
+        db.session.execute(delete(PortfolioRollup))
+        db.session.execute(insert(PortfolioRollup).from_select(["user_id", "cash", "holdings", "value"], \
+            select(User.id, User.cash, holdings, User.cash + holdings) \
+            .outerjoin(Holding, (Holding.user_id == User.id) & (Holding.quantity > 0)) \
+            .outerjoin(SymbolRollup, SymbolRollup.stock_id == Holding.stock_id) \
+            .group_by(User.id, User.cash)))
+
+        state_db.refreshed_on = datetime.utcnow()
+        # commit changes
+        db.session.commit()
+        return {"transactions": count, "symbols": priced, "portfolios": db.session.execute(select(func.count()).select_from(PortfolioRollup)).scalar()}
+
+    def _add_volume(self, trades):
+        if not trades:
+            return
+        # trades, shares & amount per day and currency
+        groups = {}
+        for trade in trades:
+            group = groups.setdefault((trade.created_on.date(), trade.currency or "USD"), [0, 0, 0.0])
+            group[0] += 1
+            group[1] += abs(trade.quantity)
+            group[2] += abs(trade.amount)
+        days = [day for day, _ in groups]
+        # traded amounts in USD at the rates of their days (one vectorized conversion)
+        amounts = fx_rates.convert_on([group[2] for group in groups.values()], [currency for _, currency in groups], days)
+        volumes = {}
+        for day, (count, shares, _), amount in zip(days, groups.values(), amounts):
+            volume = volumes.setdefault(day, [0, 0, 0.0])
+            volume[0] += count
+            volume[1] += shares
+            # amounts in a currency without any known rate are left out
+            volume[2] += float(np.nan_to_num(amount))
+        for day, (trades, shares, amount) in volumes.items():
+            volume_db = db.session.get(DailyVolume, day)
+            if volume_db is None:
+                db.session.add(DailyVolume(day=day, trades=trades, shares=shares, amount=amount))
+            else:
+                volume_db.trades += trades
+                volume_db.shares += shares
+                volume_db.amount += amount
+
+    def _count_holders(self, touched):
+        if not touched:
+            return
+        counts = db.session.execute(select(Holding.stock_id, func.sum(case((Holding.quantity > 0, 1), else_=0)), func.sum(Holding.quantity)) \
+            .where(Holding.stock_id.in_(touched)).group_by(Holding.stock_id)).all()
+        existing = set(db.session.execute(select(SymbolRollup.stock_id).where(SymbolRollup.stock_id.in_(touched))).scalars())
+        rows = [{"stock_id": stock_id, "holders": holders, "shares": shares} for stock_id, holders, shares in counts]
+        if any(row["stock_id"] in existing for row in rows):
+            db.session.execute(update(SymbolRollup), [row for row in rows if row["stock_id"] in existing])
+        if any(row["stock_id"] not in existing for row in rows):
+            db.session.execute(insert(SymbolRollup), [row for row in rows if row["stock_id"] not in existing])
+
+    def _price_symbols(self):
+        held = dict(db.session.execute(select(Stock.stock, Stock.id) \
+            .join(SymbolRollup, SymbolRollup.stock_id == Stock.id).where(SymbolRollup.shares > 0)).all())
+        if not held:
+            return 0
+        # one batched lookup for every held stock
+        quotes = lookup_many(held)
+        # valued in USD, like the cash
+        rates = fx_rates.rates({quote.get("currency") or "USD" for quote in quotes.values()})
+        rows = [{"stock_id": held[symbol], "price": float(quote["price"]) * rates[quote.get("currency") or "USD"]} \
+            for symbol, quote in quotes.items() if symbol in held and (quote.get("currency") or "USD") in rates]
+        if rows:
+            db.session.execute(update(SymbolRollup), rows)
+            db.session.execute(update(SymbolRollup).values(value=SymbolRollup.shares * SymbolRollup.price) \
+                .execution_options(synchronize_session=False))
+        return len(rows)
+
+    def _run(self, app):
+        while True:
+            time.sleep(self.interval)
+            try:
+                with app.app_context():
+                    stats = self.refresh()
+                app.logger.debug(f"Reports refreshed: {stats}")
+            except Exception:
+                app.logger.exception("Reports refresh failed, retried on the next interval")
+
+# process-wide reporting, configured by the application
+reports = Reports()
@@ -0,0 +1,69 @@
+import os
+
+from flask_session import Session
+
+try:
+    import redis
+except ImportError:
+    # only needed by the redis backend (requirements-optional.txt)
+    redis = None
+
+try:
+    import fakeredis
+except ImportError:
+    # only needed by fakeredis:// URLs (requirements-optional.txt)
+    fakeredis = None
+
+# session storage selectable with SESSION_BACKEND
+BACKENDS = ("filesystem", "cookie", "sqlalchemy", "redis")
+
+def init_app(app, db=None):
+    """
+    Configure the session storage selected by SESSION_BACKEND.
+
+    - filesystem: server-side files (SESSION_FILE_DIR), one host only
+    - cookie: Flask's signed cookies (SECRET_KEY), nothing stored server-side
+    - sqlalchemy: "sessions" table of the application DB, shared by every worker & node
+    - redis: Redis-compatible server (SESSION_REDIS_URL) through a connection pool,
+      "fakeredis://" selects an in-process stand-in (fakeredis package)
+
+    Server-side sessions expire after PERMANENT_SESSION_LIFETIME. Redis expires them by itself,
+    expired rows are swept every SESSION_CLEANUP_N_REQUESTS requests on average or with
+    `flask session_cleanup` (sqlalchemy) when not set.
+    """
+    backend = app.config.get("SESSION_BACKEND", "filesystem")
+    if backend not in BACKENDS:
+        raise RuntimeError(f"unknown session backend: {backend} (expected one of {', '.join(BACKENDS)})")
+    app.logger.debug(f"Configuring the {backend} session backend...")
+
+    if backend == "cookie":
+        # Flask's default session interface
+        if not app.secret_key:
+            raise RuntimeError("SECRET_KEY not set (required by the cookie session backend)")
+        return
+
+    if backend == "filesystem":
+        app.config["SESSION_TYPE"] = "filesystem"
+        app.config.setdefault("SESSION_FILE_DIR", os.path.join(app.instance_path, "sessions"))
+    elif backend == "sqlalchemy":
+        app.config["SESSION_TYPE"] = "sqlalchemy"
+        app.config["SESSION_SQLALCHEMY"] = db
+        app.config.setdefault("SESSION_SQLALCHEMY_TABLE", "sessions")
+    elif backend == "redis":
+        app.config["SESSION_TYPE"] = "redis"
+        app.config["SESSION_REDIS"] = create_redis(app.config.get("SESSION_REDIS_URL", "redis://localhost:6379/0"),
+            app.config.get("SESSION_REDIS_POOL_SIZE", 10))
+
+    # sign the session ids when a secret key is available
+    app.config.setdefault("SESSION_USE_SIGNER", bool(app.secret_key))
+    Session(app)
+
+def create_redis(url, pool_size=10):
+    """Redis client sharing a bounded connection pool, or the in-process stand-in for fakeredis://"""
+    if url.startswith("fakeredis://"):
+        if fakeredis is None:
+            raise RuntimeError("fakeredis:// session URLs require the fakeredis package")
+        return fakeredis.FakeRedis()
+    if redis is None:
+        raise RuntimeError("the redis session backend requires the redis package")
+    return redis.Redis(connection_pool=redis.ConnectionPool.from_url(url, max_connections=pool_size))
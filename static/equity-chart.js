@@ -0,0 +1,30 @@
+// draw the equity curve of the portfolio
+(function() {
+  "use strict";
+  document.addEventListener("DOMContentLoaded", () => {
+    const CANVAS = document.querySelector("#equity-chart");
+    const request = new XMLHttpRequest();
+    request.open("GET", CANVAS.dataset.source);
+
+    // callback for when request completed
+    request.onload = () => {
+      const data = JSON.parse(request.responseText);
+
+      new Chart(CANVAS, {
+        type: "line",
+        data: {
+          labels: data.dates,
+          datasets: [
+            { label: "Equity", data: data.equity, borderColor: "#007bff", fill: false, pointRadius: 0 },
+            { label: "Cash", data: data.cash, borderColor: "#ffc107", fill: false, pointRadius: 0 }
+          ]
+        },
+        options: {
+          scales: { xAxes: [{ type: "category", ticks: { maxTicksLimit: 12 } }] }
+        }
+      });
+    };
+
+    request.send();
+  }, false);
+})();
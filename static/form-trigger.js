@@ -1,67 +1,95 @@
 // trigger form from button in table
 (function() {
   "use strict";
+  // delays (ms) before each retry of a trade & timeout of a request (ms)
+  const RETRY_DELAYS = [500, 1000, 2000];
+  const REQUEST_TIMEOUT = 10000;
+
+  // random key of a click (UUID v4)
+  const idempotencyKey = () => {
+    if (window.crypto.randomUUID) {
+      return window.crypto.randomUUID();
+    }
+    // randomUUID requires a secure context (https or localhost)
+    const bytes = window.crypto.getRandomValues(new Uint8Array(16));
+    bytes[6] = (bytes[6] & 0x0f) | 0x40;
+    bytes[8] = (bytes[8] & 0x3f) | 0x80;
+    const hex = Array.from(bytes, (byte) => byte.toString(16).padStart(2, "0")).join("");
+    return `${hex.slice(0, 8)}-${hex.slice(8, 12)}-${hex.slice(12, 16)}-${hex.slice(16, 20)}-${hex.slice(20)}`;
+  };
+
   document.addEventListener("DOMContentLoaded", () => {
-    // get the onclick event for the button
-    const LIST = document.querySelectorAll(".btn");
-    Array.prototype.forEach.call(LIST, (button) => {
-      button.onclick = (event) => {
-         // prevent default action
-        event.preventDefault();
-        // get -/+ direction
-        const direction = event.target.getAttribute("value");
-        // create a request with the FormData
-        const request = new XMLHttpRequest();
+    const TABLE = document.querySelector("#portfolio");
+    if (TABLE === null) {
+      return;
+    }
+    // one listener for every button, rows are replaced by the server's fragment
+    TABLE.addEventListener("click", (event) => {
+      const button = event.target.closest("tr[data-symbol] .btn");
+      if (button === null) {
+        return;
+      }
+      // prevent default action
+      event.preventDefault();
+      const tr = button.closest("tr");
+      // get -/+ direction
+      const direction = button.getAttribute("value");
+      // symbol of the row
+      const formData = new FormData();
+      formData.append("symbol", tr.dataset.symbol);
+      // one key per click, sent again by every retry: the server executes the trade once at most
+      const key = idempotencyKey();
 
-        if ( direction === "+") {
-          request.open("POST", "/buy_1");
+      // render the figures of a successful trade
+      const update = (data) => {
+        if (!data.success) {
+          // error message
+          return;
+        }
+        if (data.row === null) {
+          // remove <TR> if quantity is 0
+          tr.parentNode.removeChild(tr);
         } else {
-          request.open("POST", "/sell_1");
+          // replace <TR> with the row rendered by the server
+          tr.outerHTML = data.row;
         }
+        // update cash (<td>)
+        document.querySelector("#td-cash").innerText = data.cash;
+        // update grand total (<th>), computed by the server
+        const TOTAL = document.querySelector("#th-total");
+        TOTAL.innerText = data.grand_total + (TOTAL.title ? " (partial)" : "");
+        TOTAL.dataset.grand_total = data.totals.grand_total;
+      };
 
+      // send the request to the correct route, again on network errors, 5xx & 409 (same key still in flight)
+      const send = (attempt) => {
+        const request = new XMLHttpRequest();
+        request.open("POST", direction === "+" ? "/buy_1" : "/sell_1");
+        request.setRequestHeader("Idempotency-Key", key);
+        request.timeout = REQUEST_TIMEOUT;
+        const retry = () => {
+          if (attempt < RETRY_DELAYS.length) {
+            window.setTimeout(() => send(attempt + 1), RETRY_DELAYS[attempt]);
+          }
+        };
         // callback for when request completed
         request.onload = () => {
-          const data = JSON.parse(request.responseText);
-
-          if (data.success) {
-            if (data.transaction.quantity === 0) {
-              // remove <TR> if quantity is 0
-              let tr = event.target.parentElement.parentElement;
-              tr.parentNode.removeChild(tr);
-            } else {
-              // update quantity
-              let quantity = parseInt(event.target.parentNode.parentNode.querySelector(".quantity").innerText, 10);
-              direction === "+" ? quantity += 1 : quantity -=1;
-              event.target.parentNode.parentNode.querySelector(".quantity").innerText = quantity;
-              // update price
-              event.target.parentNode.parentNode.querySelector(".price").innerText = data.price;
-              // update variation
-              event.target.parentNode.parentNode.querySelector(".variation").innerText = data.variation;
-              // update amount
-              event.target.parentNode.parentNode.querySelector(".amount").innerText = data.amount;
-              // update cash (<td>)
-              document.querySelector("#td-cash").innerText = data.cash;
-              // update grand total (<th>)
-              document.querySelector("#th-total").innerText = data.grand_total;
-              // update transaction data (<tr>)
-              event.target.parentNode.parentNode.setAttribute("data-transaction", JSON.stringify(data.transaction));
-            }
-          } else {
-            // error message
-            const MESSAGE = data.message;
+          if (request.status === 409 || request.status >= 500) {
+            retry();
+            return;
           }
+          // only parse the JSON answers (not the HTML error pages)
+          const type = request.getResponseHeader("Content-Type") || "";
+          if (request.status !== 200 || !type.startsWith("application/json")) {
+            return;
+          }
+          update(JSON.parse(request.responseText));
         };
-
-        // get data-* from input to build a FormData
-        const formData = new FormData();
-        formData.append("transaction", event.target.parentNode.parentNode.dataset.transaction);
-        formData.append("grand_total", document.querySelector("#th-total").dataset.grand_total);
-
-        // send the request to the correct route
+        request.onerror = retry;
+        request.ontimeout = retry;
         request.send(formData);
-        // stop the page from reloading ???
-        return false;
       };
+      send(0);
     });
   }, false);
-})();
\ No newline at end of file
+})();
@@ -0,0 +1,67 @@
+// update the portfolio table with the prices pushed by the server (Server-Sent Events)
+(function() {
+  "use strict";
+  document.addEventListener("DOMContentLoaded", () => {
+    if (!window.EventSource) {
+      return;
+    }
+    // formatters per currency
+    const FORMATS = {};
+    const money = (value, currency) => {
+      if (!(currency in FORMATS)) {
+        FORMATS[currency] = new Intl.NumberFormat("en-US", { style: "currency", currency: currency });
+      }
+      return FORMATS[currency].format(value);
+    };
+    const percentage = (value) => (value >= 0 ? "+" : "") + (value * 100).toFixed(2) + "%";
+    const source = new EventSource("/stream/prices");
+
+    source.addEventListener("prices", (event) => {
+      const prices = JSON.parse(event.data);
+      const TOTAL = document.querySelector("#th-total");
+      const BASE = TOTAL.dataset.currency;
+      let grandTotal = parseFloat(TOTAL.dataset.grand_total);
+
+      Object.keys(prices).forEach((symbol) => {
+        const tr = document.getElementById(symbol);
+        if (tr === null) {
+          return;
+        }
+        // figures of the row
+        const avgPrice = parseFloat(tr.dataset.avg_price);
+        const price = prices[symbol];
+        const quantity = parseInt(tr.querySelector(".quantity").innerText, 10);
+        const variation = avgPrice > 0 ? (price - avgPrice) / avgPrice : 0;
+
+        // base currency per unit of the listing currency
+        const rate = parseFloat(tr.dataset.rate);
+        // the grand total moves by the change of value of the row (rows not quoted at load time are left out)
+        if (!tr.dataset.excluded) {
+          grandTotal += quantity * (price - parseFloat(tr.dataset.price)) * rate;
+        }
+
+        // update price, variation & amount
+        tr.querySelector(".price").innerText = money(price, tr.dataset.currency);
+        const VARIATION = tr.querySelector(".variation");
+        VARIATION.innerText = percentage(variation);
+        VARIATION.classList.remove("table-success", "table-danger", "table-secondary");
+        VARIATION.classList.add(variation > 0 ? "table-success" : (variation < 0 ? "table-danger" : "table-secondary"));
+        tr.querySelector(".amount").innerText = money(quantity * price * rate, BASE);
+        // update the displayed price (<tr>)
+        tr.dataset.price = price;
+      });
+
+      // update grand total (<th>), until the server's total
+      TOTAL.dataset.grand_total = grandTotal;
+      TOTAL.innerText = money(grandTotal, BASE) + (TOTAL.title ? " (partial)" : "");
+    });
+
+    source.addEventListener("total", (event) => {
+      const data = JSON.parse(event.data);
+      const TOTAL = document.querySelector("#th-total");
+      // authoritative grand total (valuation cache of the server)
+      TOTAL.dataset.grand_total = data.grand_total;
+      TOTAL.innerText = money(data.grand_total, TOTAL.dataset.currency) + (TOTAL.title ? " (partial)" : "");
+    });
+  }, false);
+})();
@@ -0,0 +1,44 @@
+// suggest symbols while typing (reference list served by the application, no quote API call)
+(function() {
+  "use strict";
+  document.addEventListener("DOMContentLoaded", () => {
+    const INPUTS = document.querySelectorAll("input[data-suggest]");
+    Array.prototype.forEach.call(INPUTS, (input) => {
+      const list = document.getElementById(input.getAttribute("list"));
+      let timer = null;
+      let last = null;
+
+      input.addEventListener("input", () => {
+        // wait for a pause in the typing
+        clearTimeout(timer);
+        timer = setTimeout(() => {
+          const query = input.value.trim();
+          if (query === last) {
+            return;
+          }
+          last = query;
+          if (query === "") {
+            list.innerHTML = "";
+            return;
+          }
+          fetch("/symbols/suggest?q=" + encodeURIComponent(query), {credentials: "same-origin"})
+            .then((response) => response.json())
+            .then((suggestions) => {
+              // ignore late answers
+              if (query !== last) {
+                return;
+              }
+              list.innerHTML = "";
+              suggestions.forEach((suggestion) => {
+                const option = document.createElement("option");
+                option.value = suggestion.symbol;
+                option.label = suggestion.name;
+                list.appendChild(option);
+              });
+            })
+            .catch(() => {});
+        }, 150);
+      });
+    });
+  }, false);
+})();
@@ -0,0 +1,148 @@
+import queue
+import threading
+import time
+
+from collections import Counter
+# local packages
+from helpers import fetch_quotes, quote_cache
+
+class Subscription:
+    """Price updates for a set of symbols, consumed by one viewer"""
+
+    def __init__(self, symbols, maxsize=100):
+        self.symbols = frozenset(symbols)
+        self.queue = queue.Queue(maxsize=maxsize)
+
+    def get(self, timeout=None):
+        """Next batch of price changes ({symbol: price}), raises queue.Empty on timeout"""
+        return self.queue.get(timeout=timeout)
+
+    def push(self, prices):
+        try:
+            self.queue.put_nowait(prices)
+        except queue.Full:
+            # slow viewer: drop the oldest update, prices are absolute values anyway
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.queue.put_nowait(prices)
+
+class PriceFanout:
+    """
+    Shared price feed for every open viewer.
+
+    One background thread polls the quote provider for the union of the subscribed symbols,
+    once per interval whatever the number of viewers, and pushes the prices that changed to
+    the subscriptions interested in them. Fetched quotes also refresh the quote cache.
+    Listeners (e.g. the order trigger engine, the valuation cache) get every change from the
+    feed thread, before the subscriptions.
+    """
+
+    def __init__(self, interval=5):
+        self.interval = interval
+        self._symbols = Counter()
+        self._subscriptions = set()
+        self._listeners = []
+        self._prices = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._logger = None
+
+    def init_app(self, app):
+        """Read the polling interval (seconds) from the application configuration."""
+        self.interval = app.config.get("PRICE_STREAM_INTERVAL", self.interval)
+        self._logger = app.logger
+
+    def subscribe(self, symbols):
+        """Subscribe to the prices of symbols, the last known prices are pushed right away"""
+        subscription = Subscription(symbol.upper() for symbol in symbols)
+        with self._lock:
+            self._subscriptions.add(subscription)
+            self._symbols.update(subscription.symbols)
+            snapshot = {symbol: self._prices[symbol] for symbol in subscription.symbols if symbol in self._prices}
+            self._start()
+        if snapshot:
+            subscription.push(snapshot)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.discard(subscription)
+                self._symbols.subtract(subscription.symbols)
+                self._symbols += Counter()
+
+    def add_listener(self, listener):
+        """Call listener({symbol: price}) from the feed thread with the changes of every poll"""
+        with self._lock:
+            self._listeners.append(listener)
+
+    def watch(self, symbols):
+        """Poll symbols without a viewer (released with unwatch)"""
+        with self._lock:
+            self._symbols.update(symbol.upper() for symbol in symbols)
+            self._start()
+
+    def unwatch(self, symbols):
+        with self._lock:
+            self._symbols.subtract(symbol.upper() for symbol in symbols)
+            self._symbols += Counter()
+
+    def last_price(self, symbol):
+        """Last price polled for a symbol, None if not polled yet"""
+        with self._lock:
+            return self._prices.get(symbol.upper())
+
+    def poll(self):
+        """Fetch the subscribed symbols once and push the changes"""
+        with self._lock:
+            symbols = sorted(self._symbols)
+        if not symbols:
+            return {}
+
+        quotes = fetch_quotes(symbols)
+        quote_cache.put_many(quotes)
+
+        with self._lock:
+            changes = {symbol: quote["price"] for symbol, quote in quotes.items() if self._prices.get(symbol) != quote["price"]}
+            self._prices.update(changes)
+            subscriptions = list(self._subscriptions)
+            listeners = list(self._listeners)
+
+        if changes:
+            # listeners first: the viewers read state they update (e.g. the cached valuations)
+            for listener in listeners:
+                # a failing listener doesn't keep the others from the changes
+                try:
+                    listener(changes)
+                except Exception:
+                    self._log_exception(f"Price listener {listener!r} failed")
+            for subscription in subscriptions:
+                prices = {symbol: price for symbol, price in changes.items() if symbol in subscription.symbols}
+                if prices:
+                    subscription.push(prices)
+        return changes
+
+    def _start(self):
+        # called with the lock held
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="price-fanout", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                self.poll()
+            except Exception:
+                # keep the feed alive, the next poll will try again
+                self._log_exception("Price poll failed, retried on the next interval")
+            time.sleep(max(0, self.interval - (time.monotonic() - started)))
+
+    def _log_exception(self, message):
+        if self._logger is not None:
+            self._logger.exception(message)
+
+# process-wide price feed, configured by the application
+price_fanout = PriceFanout()
@@ -0,0 +1,96 @@
+import bisect
+import threading
+
+from sqlalchemy import select
+# local packages
+from models import db, ReferenceSymbol, Stock
+
+class SymbolMaster:
+    """
+    In-process symbol master data.
+
+    Keeps the ids of the stocks table by ticker, preloaded at startup and filled on misses.
+    Stocks are never deleted, so a cached id never goes stale, and an inserted stock is dropped
+    from the cache until its insert is visible. Also holds the provider's reference list of
+    symbols, sorted by symbol & name for local validation and prefix (typeahead) searches.
+    """
+
+    def __init__(self, suggest_limit=10):
+        self.suggest_limit = suggest_limit
+        self._ids = {}
+        self._names = {}
+        self._symbols = []
+        self._by_name = []
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Preload the stock ids & the reference list from the DB."""
+        self.suggest_limit = app.config.get("SYMBOLS_SUGGEST_LIMIT", self.suggest_limit)
+        self.load()
+
+    def load(self):
+        ids = dict(db.session.execute(select(Stock.stock, Stock.id)).all())
+        reference = ReferenceSymbol.get_all()
+        with self._lock:
+            self._ids = ids
+        self._set_reference(reference)
+
+    def refresh(self, provider):
+        """Reload the reference list from the quote provider (stored for the other processes), return its size"""
+        rows = [{"symbol": row["symbol"].upper(), "name": row["name"]} for row in provider.symbols()]
+        # one row per symbol
+        rows = list({row["symbol"]: row for row in rows}.values())
+        count = ReferenceSymbol.replace_all(rows)
+        self._set_reference([(row["symbol"], row["name"]) for row in rows])
+        return count
+
+    def get_id(self, symbol):
+        """Id of a stock from the cache, None if unknown"""
+        return self._ids.get(symbol)
+
+    def add(self, symbol, stock_id):
+        """Cache the id of a committed stock"""
+        with self._lock:
+            self._ids[symbol] = stock_id
+
+    def invalidate(self, symbol):
+        """Forget a stock being inserted (looked up again once committed)"""
+        with self._lock:
+            self._ids.pop(symbol, None)
+
+    def known(self, symbol):
+        """Whether the provider supports the symbol, None without a reference list"""
+        if not self._symbols:
+            return None
+        return symbol.upper() in self._names
+
+    def suggest(self, query, limit=None):
+        """Symbols starting with query, then companies whose name starts with it ({symbol, name} dicts)"""
+        query = (query or "").strip()
+        limit = limit or self.suggest_limit
+        if not query:
+            return []
+        symbols, names, by_name = self._symbols, self._names, self._by_name
+
+        matches = []
+        prefix = query.upper()
+        index = bisect.bisect_left(symbols, prefix)
+        while index < len(symbols) and len(matches) < limit and symbols[index].startswith(prefix):
+            matches.append(symbols[index])
+            index += 1
+
+        prefix = query.lower()
+        index = bisect.bisect_left(by_name, (prefix, ""))
+        while index < len(by_name) and len(matches) < limit and by_name[index][0].startswith(prefix):
+            if by_name[index][1] not in matches:
+                matches.append(by_name[index][1])
+            index += 1
+        return [{"symbol": symbol, "name": names[symbol]} for symbol in matches]
+
+    def _set_reference(self, rows):
+        names = {symbol: name for symbol, name in rows}
+        # replaced rather than mutated, so readers don't need the lock
+        self._names, self._symbols, self._by_name = names, sorted(names), sorted((name.lower(), symbol) for symbol, name in names.items())
+
+# process-wide symbol master, loaded by the application
+symbol_master = SymbolMaster()
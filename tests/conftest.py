@@ -0,0 +1,38 @@
+import os
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+# offline configuration, set before the application module is imported
+DATA_DIR = tempfile.mkdtemp(prefix="finance-tests-")
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(DATA_DIR, "finance.db")
+os.environ["QUOTE_PROVIDER"] = "simulator"
+os.environ["QUOTE_SIMULATOR_VOLATILITY"] = "0"
+os.environ["SESSION_FILE_DIR"] = os.path.join(DATA_DIR, "sessions")
+os.environ["PRICE_STORE_DIR"] = os.path.join(DATA_DIR, "prices")
+os.environ["QUOTE_REPLAY_DIR"] = os.path.join(DATA_DIR, "quotes")
+os.environ["ORDERS_ENGINE"] = "0"
+os.environ["REPORTS_REFRESH_INTERVAL"] = "0"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import application
+from models import db, User
+
+@pytest.fixture
+def client():
+    """Test client logged in as a new user (10000 USD of cash)"""
+    client = application.app.test_client()
+    username = f"user-{uuid.uuid4().hex[:12]}"
+    client.post("/register", data={"username": username, "password": "p", "confirmation": "p"})
+    client.user_id = User.get_by_username(username).id
+    return client
+
+@pytest.fixture(autouse=True)
+def fresh_session():
+    """Read the DB state committed by the routes (the application keeps a global app context)"""
+    db.session.expire_all()
+    yield
+    db.session.rollback()
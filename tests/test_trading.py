@@ -0,0 +1,104 @@
+from fx import RateUnavailable, fx_rates
+from helpers import lookup
+from models import db, Holding, IdempotencyKey, Stock, Transaction, User
+
+def cash(user_id):
+    db.session.expire_all()
+    return db.session.get(User, user_id).cash
+
+def holdings(user_id):
+    db.session.expire_all()
+    return {stock: quantity for stock, quantity in db.session.execute(db.select(Stock.stock, Holding.quantity) \
+        .join(Stock, Stock.id == Holding.stock_id).where(Holding.user_id == user_id))}
+
+def transactions(user_id):
+    return db.session.execute(db.select(db.func.count()).select_from(Transaction) \
+        .where(Transaction.user_id == user_id, Transaction.stock_id.isnot(None))).scalar()
+
+def test_buy_debits_cash_and_adds_holding(client):
+    price = lookup("AAPL")["price"]
+    client.post("/buy", data={"symbol": "AAPL", "shares": "3"})
+    assert cash(client.user_id) == 10000 - 3 * price
+    assert holdings(client.user_id) == {"AAPL": 3}
+
+def test_overdraft_is_rejected(client):
+    shares = int(10000 // lookup("MSFT")["price"]) + 1
+    response = client.post("/buy", data={"symbol": "MSFT", "shares": str(shares)}, follow_redirects=True)
+    assert b"balance too low" in response.data
+    assert cash(client.user_id) == 10000
+    assert holdings(client.user_id) == {}
+    assert transactions(client.user_id) == 0
+
+def test_sale_above_holding_is_rejected(client):
+    client.post("/buy", data={"symbol": "AAPL", "shares": "2"})
+    before = cash(client.user_id)
+    response = client.post("/sell_1", data={"symbol": "MSFT"})
+    assert response.json["success"] is False
+    assert cash(client.user_id) == before
+    assert holdings(client.user_id) == {"AAPL": 2}
+
+def test_retried_order_returns_the_stored_response(client):
+    headers = {"Idempotency-Key": "retry-1"}
+    first = client.post("/buy_1", data={"symbol": "AAPL"}, headers=headers)
+    second = client.post("/buy_1", data={"symbol": "AAPL"}, headers=headers)
+    assert first.json["success"] is True
+    assert second.json == first.json
+    assert holdings(client.user_id) == {"AAPL": 1}
+    assert transactions(client.user_id) == 1
+
+def test_order_in_flight_with_the_same_key_is_a_conflict(client):
+    # claimed by an order still running (no response stored yet)
+    db.session.add(IdempotencyKey(user_id=client.user_id, key="in-flight"))
+    db.session.commit()
+    response = client.post("/buy_1", data={"symbol": "AAPL"}, headers={"Idempotency-Key": "in-flight"})
+    assert response.status_code == 409
+    assert cash(client.user_id) == 10000
+    assert transactions(client.user_id) == 0
+
+def test_batch_executes_every_leg(client):
+    response = client.post("/orders/batch", json={"orders": [{"symbol": "AAPL", "shares": 2}, {"symbol": "MSFT", "shares": 1}]})
+    assert response.status_code == 200
+    assert holdings(client.user_id) == {"AAPL": 2, "MSFT": 1}
+    assert cash(client.user_id) == 10000 - 2 * lookup("AAPL")["price"] - lookup("MSFT")["price"]
+
+def test_batch_failing_on_one_leg_changes_nothing(client):
+    client.post("/buy", data={"symbol": "AAPL", "shares": "2"})
+    before = cash(client.user_id)
+    # the buy leg is valid, the sale exceeds the held quantity
+    response = client.post("/orders/batch", json={"orders": [{"symbol": "MSFT", "shares": 1}, \
+        {"symbol": "AAPL", "shares": 5, "side": "sell"}]})
+    assert response.status_code == 400
+    assert response.json["success"] is False
+    assert cash(client.user_id) == before
+    assert holdings(client.user_id) == {"AAPL": 2}
+    assert transactions(client.user_id) == 1
+
+def test_batch_over_the_balance_changes_nothing(client):
+    shares = int(10000 // lookup("MSFT")["price"]) + 1
+    response = client.post("/orders/batch", json={"orders": [{"symbol": "AAPL", "shares": 1}, {"symbol": "MSFT", "shares": shares}]})
+    assert response.status_code == 400
+    assert cash(client.user_id) == 10000
+    assert holdings(client.user_id) == {}
+
+def test_retried_batch_is_executed_once(client):
+    orders = {"orders": [{"symbol": "AAPL", "shares": 1}]}
+    headers = {"Idempotency-Key": "batch-1"}
+    first = client.post("/orders/batch", json=orders, headers=headers)
+    second = client.post("/orders/batch", json=orders, headers=headers)
+    assert second.json == first.json
+    assert holdings(client.user_id) == {"AAPL": 1}
+
+def test_trade_succeeds_without_a_rate_for_the_base_currency(client, monkeypatch):
+    db.session.get(User, client.user_id).base_currency = "EUR"
+    db.session.commit()
+    rate = fx_rates.rate
+    def unavailable(source, target="USD"):
+        if "EUR" in (source, target):
+            raise RateUnavailable("no exchange rate for EUR")
+        return rate(source, target)
+    monkeypatch.setattr(fx_rates, "rate", unavailable)
+    response = client.post("/buy_1", data={"symbol": "AAPL"})
+    # committed trade: figures sent in USD
+    assert response.json["success"] is True
+    assert response.json["totals"]["cash"] == cash(client.user_id)
+    assert holdings(client.user_id) == {"AAPL": 1}
@@ -0,0 +1,302 @@
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import IntegrityError
+# local packages
+from models import db, Holding, IdempotencyKey, Order, Stock, Transaction, User
+from fx import RateUnavailable, fx_rates
+from portfolio import valuations
+from symbols import symbol_master
+
+class TradeError(Exception):
+    """Order rejected, the message is meant for the user"""
+    message = "order rejected"
+
+    def __init__(self, message=None):
+        self.message = message or self.message
+        super().__init__(self.message)
+
+class InvalidQuantity(TradeError):
+    message = "invalid number of shares"
+
+class UnknownStock(TradeError):
+    message = "stock does not exist"
+
+class InsufficientFunds(TradeError):
+    message = "balance too low"
+
+class InsufficientShares(TradeError):
+    message = "quantity is too high"
+
+class DuplicateOrder(TradeError):
+    message = "order already submitted"
+
+# resting orders
+SIDES = ("buy", "sell")
+ORDER_KINDS = ("limit", "stop")
+
+def buy(user_id, quote, quantity, idempotency_key=None):
+    """Buy shares at the quoted price, return the Transaction"""
+    if not isinstance(quantity, int) or quantity <= 0:
+        raise InvalidQuantity()
+    return execute(user_id, quote, quantity, idempotency_key)
+
+def sell(user_id, quote, quantity, idempotency_key=None):
+    """Sell shares at the quoted price, return the Transaction"""
+    if not isinstance(quantity, int) or quantity <= 0:
+        raise InvalidQuantity()
+    return execute(user_id, quote, -quantity, idempotency_key)
+
+def execute(user_id, quote, quantity, idempotency_key=None):
+    """
+    Execute a trade (quantity > 0 to buy, < 0 to sell) in a single DB transaction.
+
+    Prices & amounts are recorded in the currency of the quote, the cash (USD) moves by the
+    amount converted at the current exchange rate.
+
+    Cash & holdings are checked by the conditional UPDATEs that change them, so a concurrent
+    order cannot invalidate the check (no read-check-write). The idempotency key, the cash,
+    the stock master data, the running totals & the trade are committed together, or not at all.
+    """
+    # exchange rate first, before the DB transaction writes anything
+    rate = _rate(quote.get("currency"))
+    try:
+        _claim(user_id, idempotency_key)
+        transaction_db = _trade(user_id, quote, quantity, rate)
+        # commit changes to validate the transaction
+        db.session.commit()
+    except BaseException:
+        db.session.rollback()
+        raise
+    valuations.trade(user_id, quote["symbol"], quantity, float(quote["price"]), rate)
+    return transaction_db
+
+def execute_batch(user_id, orders, quotes, idempotency_key=None):
+    """
+    Execute several trades ({symbol: quantity}, < 0 to sell) in a single DB transaction, all or nothing.
+
+    The quotes come from one batched lookup. Cash & holdings are validated in memory first (sales
+    fund the purchases), then changed by the same conditional UPDATEs as single trades, and every
+    trade is committed at once. Returns the trades by symbol (shares, price & amount).
+    """
+    orders = {symbol: quantity for symbol, quantity in orders.items() if quantity != 0}
+    if not orders:
+        raise InvalidQuantity("no order")
+    for symbol, quantity in orders.items():
+        if not isinstance(quantity, int):
+            raise InvalidQuantity(f"{symbol}: invalid number of shares")
+        if symbol not in quotes:
+            raise UnknownStock(f"{symbol}: stock does not exist")
+
+    held = {stock_db.stock: stock_db.quantity for stock_db in Stock.get_all(user_id=user_id)}
+    for symbol, quantity in orders.items():
+        if quantity < 0 and held.get(symbol, 0) < -quantity:
+            raise InsufficientShares(f"{symbol}: quantity is too high")
+    prices = {symbol: float(quotes[symbol]["price"]) for symbol in orders}
+    currencies = {symbol: quotes[symbol].get("currency") or "USD" for symbol in orders}
+    rates = {symbol: _rate(currency) for symbol, currency in currencies.items()}
+    # cash amount (USD)
+    amount = sum(quantity * prices[symbol] * rates[symbol] for symbol, quantity in orders.items())
+    if amount > db.session.execute(select(User.cash).where(User.id == user_id)).scalar():
+        raise InsufficientFunds()
+
+    try:
+        _claim(user_id, idempotency_key)
+        _debit(user_id, amount)
+
+        stock_ids = get_stock_ids({symbol: quotes[symbol]["name"] for symbol, quantity in orders.items() if quantity > 0})
+        stock_ids.update(get_stock_ids({symbol: None for symbol, quantity in orders.items() if quantity < 0}, create=False))
+        unknown = sorted(orders.keys() - stock_ids.keys())
+        if unknown:
+            raise UnknownStock(f"{unknown[0]}: stock does not exist")
+
+        trades = {symbol: {"shares": quantity, "price": prices[symbol], "amount": quantity * prices[symbol]} \
+            for symbol, quantity in orders.items()}
+        # set-based: one UPDATE for the holdings, one executemany INSERT per table
+        if not Holding.apply_many(user_id, {stock_ids[symbol]: (trade["shares"], trade["amount"]) for symbol, trade in trades.items()}):
+            raise InsufficientShares()
+        db.session.execute(insert(Transaction.__table__), [{"stock_id": stock_ids[symbol], "user_id": user_id, \
+            "quantity": trade["shares"], "price": trade["price"], "amount": trade["amount"], "currency": currencies[symbol]} \
+            for symbol, trade in trades.items()])
+        # commit changes to validate the transactions
+        db.session.commit()
+    except BaseException:
+        db.session.rollback()
+        raise
+    for symbol, trade in trades.items():
+        valuations.trade(user_id, symbol, trade["shares"], trade["price"], rates[symbol])
+    return trades
+
+def plan_rebalance(user_id, targets, quotes):
+    """
+    Orders ({symbol: quantity}) bringing the portfolio to target weights ({symbol: weight}).
+
+    Weights are fractions of the portfolio value (cash + holdings at the quoted prices), the
+    rest stays in cash. Held symbols missing from the targets are sold. Target quantities are
+    rounded down, so the purchases are always funded by the cash & the sales.
+    """
+    if any(weight < 0 for weight in targets.values()) or sum(targets.values()) > 1 + 1e-9:
+        raise TradeError("target weights must be positive and add up to 1 at most")
+    held = {stock_db.stock: stock_db.quantity for stock_db in Stock.get_all(user_id=user_id) if stock_db.quantity}
+    for symbol in held.keys() | targets.keys():
+        if symbol not in quotes:
+            raise UnknownStock(f"{symbol}: stock does not exist")
+
+    # prices in USD, like the cash
+    prices = {symbol: float(quotes[symbol]["price"]) * _rate(quotes[symbol].get("currency")) for symbol in held.keys() | targets.keys()}
+    cash = db.session.execute(select(User.cash).where(User.id == user_id)).scalar()
+    total = cash + sum(quantity * prices[symbol] for symbol, quantity in held.items())
+    orders = {}
+    for symbol in held.keys() | targets.keys():
+        target = int(targets.get(symbol, 0) * total // prices[symbol])
+        orders[symbol] = target - held.get(symbol, 0)
+    return orders
+
+def place_order(user_id, quote, side, kind, quantity, trigger_price):
+    """Store a resting limit or stop order, return the Order (cash & shares are checked again when filled)"""
+    if side not in SIDES or kind not in ORDER_KINDS:
+        raise TradeError("invalid order type")
+    if not isinstance(quantity, int) or quantity <= 0:
+        raise InvalidQuantity()
+    if trigger_price is None or trigger_price <= 0:
+        raise TradeError("invalid price")
+    if side == "sell":
+        stock_id = get_stock_id(quote["symbol"], quote["name"], create=False)
+        held = db.session.execute(select(Holding.quantity) \
+            .where(Holding.user_id == user_id, Holding.stock_id == stock_id)).scalar() if stock_id is not None else None
+        if not held or held < quantity:
+            raise InsufficientShares()
+
+    order_db = Order(user_id=user_id, symbol=quote["symbol"], name=quote["name"], side=side, kind=kind, \
+        quantity=quantity, trigger_price=trigger_price, currency=quote.get("currency") or "USD")
+    db.session.add(order_db)
+    # commit changes to validate the order
+    db.session.commit()
+    return order_db
+
+def fill_order(order_id, price):
+    """
+    Execute a triggered order at price, return the Transaction (None if no longer open).
+
+    The order is closed by a conditional UPDATE in the DB transaction of the trade, so that it is
+    filled once even if several engines trigger it or it is cancelled meanwhile. An order that
+    can't be executed (balance, holding) is closed as rejected and the TradeError raised.
+    """
+    order_db = db.session.get(Order, order_id)
+    if order_db is None:
+        return None
+    user_id = order_db.user_id
+    quote = {"symbol": order_db.symbol, "name": order_db.name, "price": price, "currency": order_db.currency}
+    quantity = order_db.quantity if order_db.side == "buy" else -order_db.quantity
+
+    try:
+        rate = _rate(order_db.currency)
+        if not Order.close(order_id, "filled"):
+            db.session.rollback()
+            return None
+        transaction_db = _trade(user_id, quote, quantity, rate)
+        db.session.flush()
+        order_db.transaction_id = transaction_db.id
+        # commit changes to validate the transaction
+        db.session.commit()
+    except TradeError as e:
+        db.session.rollback()
+        Order.close(order_id, "rejected", message=e.message)
+        db.session.commit()
+        raise
+    except BaseException:
+        db.session.rollback()
+        raise
+    valuations.trade(user_id, quote["symbol"], quantity, price, rate)
+    return transaction_db
+
+def cancel_order(user_id, order_id):
+    """Cancel an open order of the user, return whether it was still open"""
+    cancelled = Order.close(order_id, "cancelled", user_id=user_id)
+    # commit changes
+    db.session.commit()
+    return cancelled
+
+def _trade(user_id, quote, quantity, rate=1.0):
+    """Cash, holding & transaction of a trade (rate: USD per unit of the quote's currency), committed by the caller"""
+    price = float(quote["price"])
+    amount = quantity * price
+
+    _debit(user_id, amount * rate)
+    stock_id = get_stock_id(quote["symbol"], quote["name"], create=quantity > 0)
+    if stock_id is None:
+        raise UnknownStock()
+    if not Holding.apply(user_id=user_id, stock_id=stock_id, quantity=quantity, amount=amount):
+        raise InsufficientShares()
+
+    transaction_db = Transaction(stock_id=stock_id, user_id=user_id, quantity=quantity, price=price, amount=amount, \
+        currency=quote.get("currency") or "USD")
+    db.session.add(transaction_db)
+    return transaction_db
+
+def _rate(currency):
+    """USD per unit of a currency (the cash is held in USD)"""
+    try:
+        return fx_rates.rate(currency or "USD")
+    except RateUnavailable:
+        raise TradeError(f"no exchange rate for {currency}") from None
+
+def _claim(user_id, idempotency_key):
+    """Claim the idempotency key first: a duplicate fails (or waits for the first order) right away"""
+    if idempotency_key:
+        db.session.add(IdempotencyKey(user_id=user_id, key=idempotency_key))
+        try:
+            db.session.flush()
+        except IntegrityError:
+            raise DuplicateOrder() from None
+
+def _debit(user_id, amount):
+    """Take the amount from the cash (if the balance allows it for purchases)"""
+    # cash first, so that every order locks the user before the holdings (same lock order)
+    query = update(User).where(User.id == user_id).values(cash=User.cash - amount)
+    if amount > 0:
+        query = query.where(User.cash >= amount)
+    if db.session.execute(query).rowcount != 1:
+        raise InsufficientFunds()
+
+def get_stock_id(symbol, name, create=True):
+    """Id of a stock (symbol master cache first), added to the master data (in a savepoint) if needed & create is set"""
+    stock_id = symbol_master.get_id(symbol)
+    if stock_id is not None:
+        return stock_id
+    stock_id = db.session.execute(select(Stock.id).where(Stock.stock == symbol)).scalar()
+    if stock_id is not None:
+        symbol_master.add(symbol, stock_id)
+        return stock_id
+    if not create:
+        return None
+    try:
+        with db.session.begin_nested():
+            stock_db = Stock(stock=symbol, name=name)
+            db.session.add(stock_db)
+        symbol_master.invalidate(symbol)
+        return stock_db.id
+    except IntegrityError:
+        # added by a concurrent order (stocks are identified by symbol only)
+        return db.session.execute(select(Stock.id).where(Stock.stock == symbol)).scalar()
+
+def get_stock_ids(stocks, create=True):
+    """Ids of several stocks ({symbol: name}), the missing ones added in one statement if create is set"""
+    cached = {symbol: symbol_master.get_id(symbol) for symbol in stocks}
+    stock_ids = {symbol: stock_id for symbol, stock_id in cached.items() if stock_id is not None}
+    if len(stock_ids) == len(stocks):
+        return stock_ids
+    for symbol, stock_id in db.session.execute(select(Stock.stock, Stock.id).where(Stock.stock.in_(stocks.keys() - stock_ids.keys()))):
+        symbol_master.add(symbol, stock_id)
+        stock_ids[symbol] = stock_id
+    missing = [{"stock": symbol, "name": name} for symbol, name in stocks.items() if symbol not in stock_ids]
+    if missing and create:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(insert(Stock.__table__), missing)
+        except IntegrityError:
+            # added concurrently: one by one
+            return {symbol: get_stock_id(symbol, name) for symbol, name in stocks.items()}
+        for row in missing:
+            symbol_master.invalidate(row["stock"])
+        stock_ids.update(db.session.execute(select(Stock.stock, Stock.id) \
+            .where(Stock.stock.in_([row["stock"] for row in missing]))).all())
+    return stock_ids
@@ -0,0 +1,191 @@
+import threading
+import time
+
+import numpy as np
+
+from collections import OrderedDict
+from sqlalchemy import select
+# local packages
+from fx import fx_rates
+from models import db, Stock, Transaction
+from pricestore import price_store
+
+DAY = 86400
+
+class EquityCurve:
+    """
+    Daily valuation of the portfolio of a user.
+
+    Rows are days (from the first transaction to today), columns are stocks. Daily holdings are
+    the cumulative sum of the traded quantities, valued at the stored closes (or the last traded
+    price when no close is available yet) and added to the cash balance. Amounts & prices are
+    converted to USD (the cash currency) at the rates of their days.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.origin = None
+        self.symbols = []
+        self.columns = {}
+        # listing currency per symbol
+        self.currencies = {}
+        self.last_transaction_id = 0
+        # last stored bar per symbol when the prices were computed
+        self.marks = {}
+        self.quantity_delta = np.zeros((0, 0))
+        self.cash_delta = np.zeros(0)
+        self.trade_price = np.zeros((0, 0))
+        self.holdings = np.zeros((0, 0))
+        self.prices = np.zeros((0, 0))
+        self.cash = np.zeros(0)
+        self.equity = np.zeros(0)
+
+    def update(self, today=None):
+        """Extend the curve with the new transactions, bars & days, recomputing only the affected days"""
+        today = today if today is not None else int(time.time() // DAY)
+        rows = db.session.execute(select(Transaction.id, Transaction.created_on, Stock.stock, Transaction.quantity, \
+            Transaction.price, Transaction.amount, Transaction.currency) \
+            .outerjoin(Stock, Stock.id == Transaction.stock_id) \
+            .where(Transaction.user_id == self.user_id, Transaction.id > self.last_transaction_id) \
+            .order_by(Transaction.created_on, Transaction.id)).all()
+
+        if rows:
+            days = np.array([row.created_on for row in rows], dtype="datetime64[D]").astype(np.int64)
+            if self.origin is not None and days.min() < self.origin:
+                # transactions backdated before the curve: start over
+                self._reset()
+                return self.update(today)
+            if self.origin is None:
+                self.origin = int(days.min())
+            # USD per unit of the currency of each transaction (one vectorized pass)
+            rates = fx_rates.convert_on(np.ones(len(rows)), [row.currency or "USD" for row in rows], days.astype("datetime64[D]"))
+
+        if self.origin is None:
+            return self
+
+        # first row to recompute
+        dirty = len(self.equity)
+        self._grow(today - self.origin + 1, [row.stock for row in rows if row.stock is not None])
+
+        for row, day, rate in zip(rows, days if rows else [], rates if rows else []):
+            index = int(day) - self.origin
+            dirty = min(dirty, index)
+            if row.stock is None:
+                # cash movement
+                self.cash_delta[index] += row.amount * rate
+            else:
+                column = self.columns[row.stock]
+                self.currencies[row.stock] = row.currency or "USD"
+                self.quantity_delta[index, column] += row.quantity
+                self.cash_delta[index] -= row.amount * rate
+                self.trade_price[index, column] = row.price * rate
+            self.last_transaction_id = max(self.last_transaction_id, row.id)
+
+        for symbol in self.symbols:
+            mark = price_store.last_time(symbol)
+            if mark != self.marks.get(symbol):
+                # new bars start after the previous mark
+                previous = self.marks.get(symbol)
+                first = price_store.range(symbol, start=previous + 1 if previous is not None else None)["time"]
+                if len(first):
+                    dirty = min(dirty, max(0, int(first[0] // DAY) - self.origin))
+                self.marks[symbol] = mark
+
+        if dirty < len(self.equity):
+            self._compute(dirty)
+        return self
+
+    def to_dict(self):
+        dates = (np.arange(len(self.equity)) + (self.origin or 0)).astype("datetime64[D]")
+        return {
+            "dates": [str(date) for date in dates],
+            "equity": self.equity.round(2).tolist(),
+            "cash": self.cash.round(2).tolist(),
+            "invested": (self.equity - self.cash).round(2).tolist()
+        }
+
+    def _grow(self, days, symbols):
+        """Add the new days (rows) & stocks (columns)"""
+        for symbol in symbols:
+            if symbol not in self.columns:
+                self.columns[symbol] = len(self.symbols)
+                self.symbols.append(symbol)
+
+        shape = (days, len(self.symbols))
+        rows, columns = self.holdings.shape
+        if shape == (rows, columns) and len(self.equity) == days:
+            return
+
+        def grow(array, fill):
+            grown = np.full(shape if array.ndim == 2 else shape[:1], fill, dtype=float)
+            if array.ndim == 2:
+                grown[:array.shape[0], :array.shape[1]] = array
+            else:
+                grown[:array.shape[0]] = array
+            return grown
+
+        self.quantity_delta = grow(self.quantity_delta, 0)
+        self.trade_price = grow(self.trade_price, np.nan)
+        self.holdings = grow(self.holdings, 0)
+        self.prices = grow(self.prices, np.nan)
+        self.cash_delta = grow(self.cash_delta, 0)
+        self.cash = grow(self.cash, 0)
+        self.equity = grow(self.equity, 0)
+
+    def _compute(self, start):
+        """Recompute the rows from start onward (one vectorized pass)"""
+        days = len(self.equity)
+        # cumulative sums seeded with the previous row
+        previous_holdings = self.holdings[start - 1] if start else 0
+        previous_cash = self.cash[start - 1] if start else 0
+        self.holdings[start:] = previous_holdings + np.cumsum(self.quantity_delta[start:], axis=0)
+        self.cash[start:] = previous_cash + np.cumsum(self.cash_delta[start:])
+
+        # prices: traded prices overridden by the stored closes (in USD at the rates of their days), then carried forward
+        prices = self.trade_price[start:].copy()
+        first_second = (self.origin + start) * DAY
+        for column, symbol in enumerate(self.symbols):
+            bars = price_store.range(symbol, start=first_second)
+            index = bars["time"] // DAY - self.origin - start
+            valid = index < days - start
+            closes = bars["close"][valid]
+            if self.currencies.get(symbol, "USD") != "USD" and len(closes):
+                closes = fx_rates.convert_on(closes, np.full(len(closes), self.currencies[symbol]), \
+                    (bars["time"][valid] // DAY).astype("datetime64[D]"))
+            prices[index[valid], column] = closes
+        seed = self.prices[start - 1] if start else np.full(len(self.symbols), np.nan)
+        self.prices[start:] = _forward_fill(np.vstack([seed, prices]))[1:]
+
+        self.equity[start:] = np.nansum(self.holdings[start:] * self.prices[start:], axis=1) + self.cash[start:]
+
+class EquityCurveCache:
+    """Equity curves per user (least recently used curves are evicted)"""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._curves = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Equity curve of a user, extended with what changed since the last call"""
+        with self._lock:
+            curve = self._curves.pop(user_id, None) or EquityCurve(user_id)
+            self._curves[user_id] = curve
+            while len(self._curves) > self.maxsize:
+                self._curves.popitem(last=False)
+        # users are updated independently
+        with curve.lock:
+            return curve.update()
+
+def _forward_fill(array):
+    """Replace the NaN of each column by the last value above"""
+    index = np.where(np.isnan(array), 0, np.arange(len(array))[:, None])
+    np.maximum.accumulate(index, axis=0, out=index)
+    return array[index, np.arange(array.shape[1])]
+
+# process-wide equity curves
+equity_curves = EquityCurveCache()